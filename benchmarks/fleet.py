@@ -0,0 +1,49 @@
+"""Build a DataCache filled with a realistic fleet of fake CRNs, for the benchmarks."""
+
+import copy
+import json
+import random
+
+from nodes_list import main
+from nodes_list.main import DataCache
+from tests.test_gpu_aggregate import FAKE_GPU_AGGREGATE
+from tests.test_parse_responses import mock_ipv6_check, mock_node_aggr, mock_status_config, mock_usage_system
+
+
+def make_fleet(size: int = 1000, dead_ratio: float = 0.2, seed: int = 0) -> DataCache:
+    """DataCache with `size` CRNs, `dead_ratio` of them unreachable. Also installed as the global data_cache."""
+    rng = random.Random(seed)
+    cache = main.data_cache = DataCache()
+    aggregate = json.loads(mock_node_aggr)
+    template = aggregate["data"]["corechannel"]["resource_nodes"][0]
+    nodes = []
+    for i in range(size):
+        node = copy.deepcopy(template)
+        node["hash"] = f"{i:064x}"
+        node["address"] = f"https://crn-{i}.example.org/"
+        node["score"] = rng.random()
+        node["inactive_since"] = None if rng.random() > 0.1 else 21424667
+        nodes.append(node)
+    aggregate["data"]["corechannel"]["resource_nodes"] = nodes
+    cache.node_list.set_data(aggregate)
+    cache.gpu_aggregate.set_data(json.loads(FAKE_GPU_AGGREGATE))
+
+    for node in nodes:
+        crn = cache.crn_infos[node["hash"]]
+        crn.node_url = node["address"]
+        if rng.random() < dead_ratio:
+            error = TimeoutError("Connection timeout")
+            for cached_response in (crn.config, crn.system, crn.check_ipv6):
+                cached_response.set_error(error)
+            continue
+        system = json.loads(mock_usage_system)
+        system["mem"]["available_kB"] = rng.randrange(system["mem"]["total_kB"])
+        system["disk"]["available_kB"] = rng.randrange(system["disk"]["total_kB"])
+        system["cpu"]["load_average"]["load5"] = rng.random() * 8
+        crn.system.set_data(system)
+        crn.config.set_data(json.loads(mock_status_config))
+        crn.check_ipv6.set_data(json.loads(mock_ipv6_check))
+
+    cache.generation += 1
+    cache.update_sorted_views()
+    return cache
@@ -0,0 +1,73 @@
+"""Import time of the application in a fresh interpreter, against the startup budget.
+
+The program runtime mounts the code read-only, so the bytecode cannot be written at the first start: without
+precompiled bytecode, every cold start compiles the sources again. Both cases are measured."""
+
+import compileall
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+STARTUP_BUDGET_MS = 600
+"Import time of nodes_list.main not to exceed, with the precompiled bytecode"
+RUNS = 5
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(src: Path, write_bytecode: bool) -> dict[str, tuple[int, int, int]]:
+    """Self and cumulative import time in µs, and depth, of each module imported by nodes_list.main"""
+    env = {**os.environ, "PYTHONPATH": str(src)}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    if not write_bytecode:
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import nodes_list.main"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for match in IMPORT_TIME_LINE.finditer(result.stderr):
+        self_us, cumulative_us, indent, module = match.groups()
+        # nodes_list.main is listed twice: imported by the package, then the import statement itself
+        times.setdefault(module, (int(self_us), int(cumulative_us), len(indent) // 2))
+    return times
+
+
+def report(name: str, runs: list[dict[str, tuple[int, int, int]]]) -> float:
+    total_ms = statistics.median(times["nodes_list"][1] for times in runs) / 1000
+    own_ms = statistics.median(
+        sum(self_us for module, (self_us, _, _) in times.items() if module.startswith("nodes_list")) for times in runs
+    ) / 1000
+    print(f"{name}: {total_ms:.0f} ms, of which {own_ms:.0f} ms in nodes_list itself")
+    # Direct imports of nodes_list.main, the package imports it
+    main_depth = runs[0]["nodes_list.main"][2]
+    direct = {module: cumulative for module, (_, cumulative, depth) in runs[-1].items() if depth == main_depth + 1}
+    for module, cumulative_us in sorted(direct.items(), key=lambda item: item[1], reverse=True)[:5]:
+        print(f"{module:>40}: {cumulative_us / 1000:6.1f} ms")
+    return total_ms
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        # A copy of the sources, so the bytecode of the working tree is neither used nor written
+        src = Path(tmp) / "src"
+        shutil.copytree(Path(__file__).parent.parent / "src" / "nodes_list", src / "nodes_list")
+        report("Without bytecode", [import_times(src, write_bytecode=False) for _ in range(RUNS)])
+        compileall.compile_dir(src, quiet=1)
+        total_ms = report("With precompiled bytecode", [import_times(src, write_bytecode=False) for _ in range(RUNS)])
+
+    print(f"Startup budget: {STARTUP_BUDGET_MS} ms, {'OK' if total_ms <= STARTUP_BUDGET_MS else 'EXCEEDED'}")
+    if total_ms > STARTUP_BUDGET_MS:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
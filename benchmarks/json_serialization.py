@@ -0,0 +1,37 @@
+"""Compare the serialization of /crns.json through jsonable_encoder and json, as FastAPI does for a dict,
+with FastJSONResponse.
+
+Run from the repository root with: PYTHONPATH=src python -m benchmarks.json_serialization
+"""
+
+import asyncio
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from nodes_list.serialization import dumps_json
+
+from .fleet import make_fleet
+
+
+def main(size: int = 1000, repeat: int = 5):
+    cache = make_fleet(size)
+    content = asyncio.run(cache.format_response(filter_inactive=False))
+
+    def fastapi_default():
+        return json.dumps(jsonable_encoder(content)).encode()
+
+    def fast_json():
+        return dumps_json(content)
+
+    assert json.loads(fastapi_default()) == json.loads(fast_json())
+    results = {}
+    for name, func in (("jsonable_encoder + json", fastapi_default), ("FastJSONResponse", fast_json)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>24}: {results[name] * 1000:8.1f} ms, {len(func()) / 1024:8.0f} KiB")
+    speedup = results["jsonable_encoder + json"] / results["FastJSONResponse"]
+    print(f"Speedup on {size} CRNs: x{speedup:.1f}")
+
+
+if __name__ == "__main__":
+    main()
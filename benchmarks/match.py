@@ -0,0 +1,55 @@
+"""Time the queries of /crns/match on a large fleet.
+
+Run from the repository root with: PYTHONPATH=src python -m benchmarks.match
+"""
+
+import time
+import timeit
+
+from nodes_list.main import gpu_models
+from nodes_list.match import MatchIndex, Rank
+
+from .fleet import make_fleet
+
+QUERIES = {
+    "any CRN": {},
+    "2 vCPUs, 4 GiB, by load": {"vcpus": 2, "memory_mb": 4096, "rank": Rank.load},
+    "16 vCPUs, 48 GiB, 1 TiB, confidential": {
+        "vcpus": 16,
+        "memory_mb": 48 * 1024,
+        "disk_mb": 2**20,
+        "confidential": True,
+    },
+    "RTX 4000 ADA": {"gpu_model": "RTX 4000 ADA"},
+}
+
+
+def main(size: int = 10_000, number: int = 1000):
+    cache = make_fleet(size)
+    views = cache.sorted_views
+    start = time.perf_counter()
+    index = MatchIndex(
+        views.columns,
+        (cache.crn_infos[crn_hash].compatible_available_gpus for crn_hash in views.columns["hash"]),
+        gpu_models(cache.gpu_aggregate.data),
+    )
+    print(
+        f"Index of {len(index.hashes)} CRNs built in {(time.perf_counter() - start) * 1000:.1f} ms, "
+        "once per generation with the snapshot, in the response builder thread"
+    )
+    queries = {
+        **QUERIES,
+        # Each requirement is met by some CRN, but hardly all of them by the same one: the whole fleet is scanned
+        "worst case, largest free capacity": {
+            "vcpus": index.max_available[0],
+            "memory_mb": index.max_available[1] / 1024,
+            "disk_mb": index.max_available[2] / 1024,
+        },
+    }
+    for name, query in queries.items():
+        duration = timeit.timeit(lambda: index.match(**query), number=number) / number
+        print(f"{name:>40}: {duration * 1e6:7.1f} µs, {len(index.match(**query))} matches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Compare the size and the time to build and serialize /crns.json for each response profile.
+
+Run from the repository root with: PYTHONPATH=src python -m benchmarks.response_profiles
+"""
+
+import asyncio
+import gzip
+import timeit
+
+from nodes_list.main import ResponseProfile
+from nodes_list.serialization import dumps_json
+
+from .fleet import make_fleet
+
+
+def main(size: int = 1000, repeat: int = 5):
+    cache = make_fleet(size)
+
+    for profile in ResponseProfile:
+
+        def build_response():
+            return dumps_json(asyncio.run(cache.format_response(filter_inactive=False, profile=profile)))
+
+        body = build_response()
+        duration = min(timeit.repeat(build_response, number=1, repeat=repeat))
+        print(
+            f"{profile.value:>8}: {len(body) / 1024:6.0f} KiB, {len(gzip.compress(body)) / 1024:5.0f} KiB gzipped, "
+            f"{duration * 1000:6.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Latency of the prebuilt /crns.json responses while snapshots are built, on the event loop or in the worker.
+
+Run from the repository root with: PYTHONPATH=src python -m benchmarks.serve_latency
+"""
+
+import asyncio
+import statistics
+import time
+
+from nodes_list.main import PREBUILT_RESPONSES, response_builder
+from nodes_list.serialization import ResponseFormat
+
+from .fleet import make_fleet
+
+REQUEST_INTERVAL = 0.001
+"Seconds between two requests of the simulated client"
+
+
+async def serve_during_builds(size: int, builds: int, in_worker: bool) -> list[float]:
+    """Latency of the requests in milliseconds, from the time they were due to the response"""
+    cache = make_fleet(size)
+    latencies = []
+    done = False
+
+    async def client():
+        while not done:
+            due = time.perf_counter() + REQUEST_INTERVAL
+            await asyncio.sleep(REQUEST_INTERVAL)
+            await cache.get_encoded_response(ResponseFormat.json, **PREBUILT_RESPONSES[0])
+            latencies.append((time.perf_counter() - due) * 1000)
+
+    client_task = asyncio.create_task(client())
+    for _ in range(builds):
+        if in_worker:
+            views = await asyncio.get_running_loop().run_in_executor(
+                response_builder,
+                cache.build_sorted_views,
+                cache.generation + 1,
+                cache.node_list.data,
+                cache.node_list.fetched_at,
+            )
+        else:
+            views = cache.build_sorted_views(cache.generation + 1, cache.node_list.data, cache.node_list.fetched_at)
+        cache.generation = views.generation
+        cache.publish_sorted_views(views)
+        await asyncio.sleep(0.01)
+    done = True
+    await client_task
+    return latencies
+
+
+def main(size: int = 1000, builds: int = 10):
+    for name, in_worker in (("On the event loop", False), ("In the response builder", True)):
+        latencies = sorted(asyncio.run(serve_during_builds(size, builds, in_worker)))
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"{name:>24}: {len(latencies):5} requests, median {statistics.median(latencies):6.2f} ms, "
+            f"p99 {p99:6.2f} ms, max {latencies[-1]:6.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 #!/bin/python
 import asyncio
+import compileall
 import logging
 import os
+import py_compile
 import sys
 from base64 import b16decode, b32encode
 from pathlib import Path
@@ -48,8 +50,18 @@ def create_archive(path: Path) -> tuple[Path, Encoding]:
         raise FileNotFoundError("No file or directory to create the archive from")
 
 
+def compile_bytecode(path: Path) -> None:
+    """Precompile the bytecode, the runtime mounts the code read-only and would compile it at each cold start.
+
+    Only used by the runtime if it runs the same Python version. The hash is not checked, the archive is immutable.
+    """
+    logger.debug("Compiling bytecode...")
+    compileall.compile_dir(path, quiet=1, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
 async def deploy_program():
     path = Path(__file__).parent / "src"
+    compile_bytecode(path)
     try:
         path_object, encoding = create_archive(path)
     except BadZipFile:
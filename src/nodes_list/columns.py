@@ -0,0 +1,110 @@
+"""Columnar view of the fleet: one row per CRN with flattened scalar columns, and its Arrow and Parquet exports.
+
+pyarrow is an optional dependency, only imported when an export is requested."""
+
+import datetime
+from typing import Any, Callable, Iterable, Mapping, NamedTuple
+
+from nodes_list.response_types import ResourceNodeInfo
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+
+class Column(NamedTuple):
+    name: str
+    type: type
+    get: Callable[[ResourceNodeInfo, Any], Any]
+    "Get the value from the node in the aggregate and its CRNData"
+
+
+COLUMNS: list[Column] = [
+    Column("hash", str, lambda node, crn: node["hash"]),
+    Column("name", str, lambda node, crn: node["name"]),
+    Column("address", str, lambda node, crn: node["address"]),
+    Column("score", float, lambda node, crn: node["score"]),
+    Column("inactive_since", float, lambda node, crn: node["inactive_since"]),
+    Column("version", str, lambda node, crn: crn.config.data["version"]),
+    Column("gpu_support", bool, lambda node, crn: crn.gpu_support),
+    Column("confidential_support", bool, lambda node, crn: crn.confidential_support),
+    Column("qemu_support", bool, lambda node, crn: crn.qemu_support),
+    Column("cpu_count", int, lambda node, crn: crn.system.data["cpu"]["count"]),
+    Column("load1", float, lambda node, crn: crn.system.data["cpu"]["load_average"]["load1"]),
+    Column("load5", float, lambda node, crn: crn.system.data["cpu"]["load_average"]["load5"]),
+    Column("load15", float, lambda node, crn: crn.system.data["cpu"]["load_average"]["load15"]),
+    Column("mem_total_kB", int, lambda node, crn: crn.system.data["mem"]["total_kB"]),
+    Column("mem_available_kB", int, lambda node, crn: crn.system.data["mem"]["available_kB"]),
+    Column("disk_total_kB", int, lambda node, crn: crn.system.data["disk"]["total_kB"]),
+    Column("disk_available_kB", int, lambda node, crn: crn.system.data["disk"]["available_kB"]),
+    Column("gpu_count", int, lambda node, crn: len(crn.system.data["gpu"]["devices"])),
+    Column("gpu_available_count", int, lambda node, crn: len(crn.system.data["gpu"]["available_devices"])),
+    Column("compatible_gpu_count", int, lambda node, crn: crn.system.data and len(crn.compatible_gpus)),
+    Column(
+        "compatible_available_gpu_count",
+        int,
+        lambda node, crn: crn.system.data and len(crn.compatible_available_gpus),
+    ),
+    Column("ipv6_host", bool, lambda node, crn: crn.check_ipv6.data["host"]),
+    Column("ipv6_vm", bool, lambda node, crn: crn.check_ipv6.data["vm"]),
+    Column("config_fetched_at", datetime.datetime, lambda node, crn: crn.config.fetched_at),
+    Column("system_fetched_at", datetime.datetime, lambda node, crn: crn.system.fetched_at),
+    Column("ipv6_fetched_at", datetime.datetime, lambda node, crn: crn.check_ipv6.fetched_at),
+]
+
+
+def _get_value(column: Column, node: ResourceNodeInfo, crn: Any) -> Any:
+    # noinspection PyBroadException
+    try:
+        value = column.get(node, crn)
+        if value is None or isinstance(value, column.type):
+            return value
+        if column.type in (int, float) and not isinstance(value, bool):
+            return column.type(value)
+    except Exception:
+        # Missing data or not in the expected format
+        pass
+    return None
+
+
+def build_columns(nodes: Iterable[ResourceNodeInfo], crn_infos: Mapping[str, Any]) -> dict[str, list]:
+    """One list of values per column, with None for the unknown values"""
+    columns: dict[str, list] = {column.name: [] for column in COLUMNS}
+    for node in nodes:
+        crn = crn_infos[node["hash"]]
+        for column in COLUMNS:
+            columns[column.name].append(_get_value(column, node, crn))
+    return columns
+
+
+def to_arrow_table(columns: dict[str, list]):
+    import pyarrow as pa
+
+    arrow_types = {
+        str: pa.string(),
+        float: pa.float64(),
+        int: pa.int64(),
+        bool: pa.bool_(),
+        datetime.datetime: pa.timestamp("us", tz="UTC"),
+    }
+    schema = pa.schema([(column.name, arrow_types[column.type]) for column in COLUMNS])
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def to_arrow_ipc(columns: dict[str, list]) -> bytes:
+    """Serialize as an Arrow IPC stream"""
+    import pyarrow as pa
+
+    table = to_arrow_table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def to_parquet(columns: dict[str, list]) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(to_arrow_table(columns), sink)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,225 @@
+"""Latency and availability of each CRN over rolling windows, in constant memory per CRN.
+
+Each request to a CRN is recorded with its outcome and, when measured, its connect time, time to first byte and
+total time. When a CRN cannot be reached, the endpoints that are not requested count with the same outcome, so the
+availability of every CRN is over the same number of requests per fetch. The latencies go to log-bucketed
+histograms: their quantiles are estimated with a relative error of at most RELATIVE_ERROR, whatever the number of
+requests. Each window is split in time slots, the slot of a past period is cleared when its time comes again, so the
+windows roll without keeping the individual requests. The counters of all the slots of a window are in a single array,
+so the health is copied at little cost for the snapshots."""
+
+import math
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from enum import Enum
+from typing import Sequence
+
+RELATIVE_ERROR = 0.05
+"Maximum relative error of the latency quantiles"
+MIN_LATENCY = 0.001
+MAX_LATENCY = 120.0
+"Latencies are clamped to this range, in seconds"
+LATENCY_SLOTS = 4
+"Number of slots of the latency windows: a window covers the last 3/4 to 4/4 of its duration"
+OUTCOME_SLOT_DURATIONS = {3600: 5 * 60, 24 * 3600: 3600}
+"Duration of the slots of the outcome counters, by window"
+QUANTILES = (0.5, 0.95, 0.99)
+
+_GAMMA = (1 + RELATIVE_ERROR) / (1 - RELATIVE_ERROR)
+_LOG_GAMMA = math.log(_GAMMA)
+_BUCKETS = math.ceil(math.log(MAX_LATENCY / MIN_LATENCY) / _LOG_GAMMA) + 1
+
+
+class HealthWindow(str, Enum):
+    hour = "1h"
+    day = "24h"
+
+    @property
+    def seconds(self) -> int:
+        return {HealthWindow.hour: 3600, HealthWindow.day: 24 * 3600}[self]
+
+
+class LatencyMetric(str, Enum):
+    connect = "connect"
+    "Time to open the connection, not recorded when an open connection was reused"
+    ttfb = "ttfb"
+    "Time to first byte: from the start of the request to the response headers"
+    total = "total"
+    "Time to receive and decode the whole response"
+
+
+class Outcome(str, Enum):
+    ok = "ok"
+    error = "error"
+    "The CRN answered with an error or an invalid response"
+    timeout = "timeout"
+    unreachable = "unreachable"
+    "The connection could not be established"
+
+
+def latency_bucket(latency: float) -> int:
+    """Index of the bucket of the latency in the log-sized buckets, for quantiles with a bounded relative error"""
+    latency = min(MAX_LATENCY, max(MIN_LATENCY, latency))
+    return min(_BUCKETS - 1, math.ceil(math.log(latency / MIN_LATENCY) / _LOG_GAMMA))
+
+
+def quantiles(counts: Sequence[int]) -> dict[str, float | None]:
+    """QUANTILES of the latencies counted by bucket, in milliseconds"""
+    cumulative = list(accumulate(counts))
+    if not cumulative or not cumulative[-1]:
+        return {f"p{round(q * 100)}": None for q in QUANTILES}
+    result: dict[str, float | None] = {}
+    for q in QUANTILES:
+        index = bisect_left(cumulative, q * cumulative[-1])
+        # Middle of the bucket (gamma^(i-1), gamma^i], in relative terms
+        value = MIN_LATENCY * 2 * _GAMMA**index / (_GAMMA + 1) if index else MIN_LATENCY
+        result[f"p{round(q * 100)}"] = round(value * 1000, 1)
+    return result
+
+
+class RollingSlots:
+    """A window split in time slots of `width` counters, the slot of a past period is reset when its time comes again.
+
+    The counters of all the slots are in a single array, allocated on first use. They saturate instead of
+    overflowing."""
+
+    duration: float
+    "Seconds covered by each slot"
+    width: int
+    "Number of counters of each slot"
+    typecode: str
+    "array type code of the counters"
+    periods: array
+    "Period of each slot, -1 if never used"
+    counts: array | None
+    "Counters of each slot, one after the other"
+
+    def __init__(self, window: float, count: int, width: int, typecode: str):
+        self.duration = window / count
+        self.width = width
+        self.typecode = typecode
+        self.periods = array("q", [-1]) * count
+        self.counts = None
+
+    def increment(self, index: int, now: float) -> None:
+        """Increment the counter `index` of the current slot"""
+        if self.counts is None:
+            self.counts = array(self.typecode, [0]) * (len(self.periods) * self.width)
+        period = int(now // self.duration)
+        slot = period % len(self.periods)
+        start = slot * self.width
+        if self.periods[slot] != period:
+            self.counts[start : start + self.width] = array(self.typecode, [0]) * self.width
+            self.periods[slot] = period
+        if self.counts[start + index] < 2 ** (8 * self.counts.itemsize) - 1:
+            self.counts[start + index] += 1
+
+    def totals(self, now: float, start: int = 0, stop: int | None = None) -> list[int]:
+        """Sum of each counter from `start` to `stop` over the slots within the window"""
+        stop = self.width if stop is None else stop
+        period = int(now // self.duration)
+        slots = [
+            slot
+            for slot, slot_period in enumerate(self.periods)
+            if slot_period >= 0 and period - slot_period < len(self.periods)
+        ]
+        if self.counts is None or not slots:
+            return [0] * (stop - start)
+        counts, width = self.counts, self.width
+        return list(map(sum, zip(*(counts[slot * width + start : slot * width + stop] for slot in slots))))
+
+    def copy(self) -> "RollingSlots":
+        slots = RollingSlots.__new__(RollingSlots)
+        slots.duration = self.duration
+        slots.width = self.width
+        slots.typecode = self.typecode
+        slots.periods = self.periods[:]
+        slots.counts = None if self.counts is None else self.counts[:]
+        return slots
+
+
+class CrnHealth:
+    """Latency and availability of a CRN over each HealthWindow.
+
+    The latency counters are allocated on first use, so a CRN that never answers only costs its outcome counters."""
+
+    latency: dict[HealthWindow, RollingSlots]
+    "Number of requests by LatencyMetric and latency_bucket(), the buckets of each metric one after the other"
+    outcomes: dict[HealthWindow, RollingSlots]
+    "Number of requests by Outcome"
+
+    def __init__(self):
+        self.latency = {
+            window: RollingSlots(window.seconds, LATENCY_SLOTS, len(LatencyMetric) * _BUCKETS, "H")
+            for window in HealthWindow
+        }
+        self.outcomes = {
+            window: RollingSlots(
+                window.seconds, window.seconds // OUTCOME_SLOT_DURATIONS[window.seconds], len(Outcome), "I"
+            )
+            for window in HealthWindow
+        }
+
+    def record(
+        self,
+        outcome: Outcome,
+        connect: float | None = None,
+        ttfb: float | None = None,
+        total: float | None = None,
+        now: float | None = None,
+    ) -> None:
+        """Record a request, with the latencies that were measured"""
+        now = time.time() if now is None else now
+        outcome_index = list(Outcome).index(outcome)
+        latencies = (connect, ttfb, total)
+        for window in HealthWindow:
+            self.outcomes[window].increment(outcome_index, now)
+            for metric_index, latency in enumerate(latencies):
+                if latency is not None:
+                    self.latency[window].increment(metric_index * _BUCKETS + latency_bucket(latency), now)
+
+    def copy(self) -> "CrnHealth":
+        """Copy not modified by the requests recorded later, to read it from another thread"""
+        health = CrnHealth.__new__(CrnHealth)
+        health.latency = {window: slots.copy() for window, slots in self.latency.items()}
+        health.outcomes = {window: slots.copy() for window, slots in self.outcomes.items()}
+        return health
+
+    def outcome_counts(self, window: HealthWindow, now: float) -> dict[str, int]:
+        return dict(zip((outcome.value for outcome in Outcome), self.outcomes[window].totals(now)))
+
+    def availability(self, window: HealthWindow, now: float) -> float | None:
+        """Share of the requests that got a valid response, None without requests"""
+        counts = self.outcome_counts(window, now)
+        requests = sum(counts.values())
+        return counts[Outcome.ok.value] / requests if requests else None
+
+    def latency_quantiles(self, window: HealthWindow, metric: LatencyMetric, now: float) -> dict[str, float | None]:
+        index = list(LatencyMetric).index(metric)
+        return quantiles(self.latency[window].totals(now, index * _BUCKETS, (index + 1) * _BUCKETS))
+
+    def window_report(self, window: HealthWindow, now: float | None = None) -> dict:
+        """Requests by outcome, availability and latency quantiles in milliseconds, over the window"""
+        now = time.time() if now is None else now
+        outcomes = self.outcome_counts(window, now)
+        return {
+            "requests": sum(outcomes.values()),
+            "availability": self.availability(window, now),
+            "outcomes": outcomes,
+            "latency_ms": {metric.value: self.latency_quantiles(window, metric, now) for metric in LatencyMetric},
+        }
+
+    def report(self, now: float | None = None) -> dict:
+        now = time.time() if now is None else now
+        return {window.value: self.window_report(window, now) for window in HealthWindow}
+
+    def summary(self, now: float | None = None) -> dict:
+        """Availability over each window and quantiles of the total time over the last 24h, for the CRN entries"""
+        now = time.time() if now is None else now
+        total = self.latency_quantiles(HealthWindow.day, LatencyMetric.total, now)
+        return {
+            **{f"availability_{window.value}": self.availability(window, now) for window in HealthWindow},
+            **{f"latency_{name}_ms": value for name, value in total.items()},
+        }
@@ -0,0 +1,206 @@
+"""Bounded history of the system usage of each CRN.
+
+Samples are stored in fixed-size ring buffers of typed arrays, one array per field, instead of a list of dicts:
+26 bytes per sample, plus the array headers of each CRN. The total memory is capped by reducing the number of samples
+kept per CRN."""
+
+import datetime
+import math
+import sys
+from array import array
+from typing import Iterable
+
+from nodes_list.response_types import CRNSystemInfo
+
+UNKNOWN_UINT = 2**32 - 1
+"Value stored in the unsigned integer fields when it is unknown"
+
+FIELDS: dict[str, str] = {
+    "timestamp": "I",  # seconds since epoch
+    "load1": "f",
+    "load5": "f",
+    "load15": "f",
+    "mem_available_MiB": "I",
+    "disk_available_MiB": "I",
+    "gpu_available": "h",  # -1 when unknown
+}
+"Array typecode of each field of a sample"
+
+SAMPLE_BYTES = sum(array(typecode).itemsize for typecode in FIELDS.values())
+CRN_BYTES = sum(sys.getsizeof(array(typecode)) for typecode in FIELDS.values())
+"Memory of the arrays of a CRN without samples"
+
+
+def _to_uint(value: float | None) -> int:
+    if value is None or not 0 <= value < UNKNOWN_UINT:
+        return UNKNOWN_UINT
+    return int(value)
+
+
+def _from_stored(field: str, value: float) -> float | None:
+    if FIELDS[field] == "I":
+        return None if value == UNKNOWN_UINT else value
+    if FIELDS[field] == "h":
+        return None if value < 0 else value
+    return None if math.isnan(value) else value
+
+
+class UsageHistory:
+    """Ring buffer of the usage samples of a CRN, oldest first once read"""
+
+    capacity: int
+    start: int
+    "Index of the oldest sample once the buffer is full"
+    columns: dict[str, array]
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.start = 0
+        # The arrays grow with the samples until the capacity is reached, so new or dead CRNs cost little
+        self.columns = {field: array(typecode) for field, typecode in FIELDS.items()}
+
+    def __len__(self) -> int:
+        return len(self.columns["timestamp"])
+
+    @property
+    def last_timestamp(self) -> int | None:
+        if not len(self):
+            return None
+        return self.columns["timestamp"][(self.start - 1) % len(self)]
+
+    def append(self, sample: dict[str, float]) -> None:
+        if len(self) < self.capacity:
+            for field, column in self.columns.items():
+                column.append(sample[field])
+            if len(self) == self.capacity:
+                # Without the room the arrays keep to grow
+                self.columns = {field: column[:] for field, column in self.columns.items()}
+        else:
+            for field, column in self.columns.items():
+                column[self.start] = sample[field]
+            self.start = (self.start + 1) % self.capacity
+
+    def column(self, field: str) -> list[float]:
+        """Values of a field, oldest first"""
+        column = self.columns[field]
+        return (column[self.start :] + column[: self.start]).tolist()
+
+    def resize(self, capacity: int) -> None:
+        """Change the capacity, dropping the oldest samples if needed"""
+        if capacity == self.capacity:
+            return
+        self.columns = {
+            field: array(FIELDS[field], self.column(field)[-capacity:] if capacity else [])
+            for field in self.columns
+        }
+        self.capacity = capacity
+        self.start = 0
+
+    def memory_bytes(self) -> int:
+        return sum(sys.getsizeof(column) for column in self.columns.values())
+
+    def downsample(self, step: int = 0, since: int = 0) -> dict[str, list]:
+        """Samples since the `since` timestamp, averaged over buckets of `step` seconds if set.
+
+        Returns one list per field, unknown values are None."""
+        timestamps = self.column("timestamp")
+        first = next((i for i, timestamp in enumerate(timestamps) if timestamp >= since), len(timestamps))
+        columns = {field: self.column(field)[first:] for field in FIELDS}
+        if step <= 0:
+            return {
+                field: [_from_stored(field, value) for value in values] for field, values in columns.items()
+            }
+
+        result: dict[str, list] = {field: [] for field in FIELDS}
+        buckets: dict[int, list[int]] = {}
+        for i, timestamp in enumerate(columns["timestamp"]):
+            buckets.setdefault(int(timestamp) // step * step, []).append(i)
+        for bucket, indexes in buckets.items():
+            result["timestamp"].append(bucket)
+            for field in FIELDS:
+                if field == "timestamp":
+                    continue
+                known = [value for i in indexes if (value := _from_stored(field, columns[field][i])) is not None]
+                result[field].append(sum(known) / len(known) if known else None)
+        return result
+
+
+class UsageHistoryStore:
+    """Usage history of all the CRNs, with a cap on the total memory"""
+
+    interval: int
+    "Minimum seconds between two samples of a CRN"
+    max_samples: int
+    "Maximum number of samples per CRN, if the memory cap allows it"
+    max_bytes: int
+    histories: dict[str, UsageHistory]
+
+    def __init__(self, interval: int, max_samples: int, max_bytes: int):
+        self.interval = interval
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.histories = {}
+
+    @property
+    def capacity(self) -> int:
+        """Samples kept per CRN, reduced when there are too many CRNs to fit in the memory cap"""
+        crn_bytes = self.max_bytes // max(1, len(self.histories))
+        return min(self.max_samples, max(0, crn_bytes - CRN_BYTES) // SAMPLE_BYTES)
+
+    def set_crns(self, crn_hashes: Iterable[str]) -> None:
+        """Keep the history of these CRNs only, and adjust the capacity of each to their number"""
+        crn_hashes = set(crn_hashes)
+        for crn_hash in self.histories.keys() - crn_hashes:
+            del self.histories[crn_hash]
+        for crn_hash in crn_hashes - self.histories.keys():
+            self.histories[crn_hash] = UsageHistory(0)
+        capacity = self.capacity
+        for history in self.histories.values():
+            history.resize(capacity)
+
+    def forget(self, crn_hash: str) -> None:
+        """Drop the samples of a CRN, its history starts again from the next sample"""
+        history = self.histories.get(crn_hash)
+        if history is not None:
+            self.histories[crn_hash] = UsageHistory(history.capacity)
+
+    def record(self, crn_hash: str, system: CRNSystemInfo, fetched_at: datetime.datetime) -> bool:
+        """Add a sample, unless the last one of this CRN is more recent than the interval"""
+        history = self.histories.get(crn_hash)
+        timestamp = int(fetched_at.timestamp())
+        if history is None or not history.capacity:
+            return False
+        last_timestamp = history.last_timestamp
+        if last_timestamp is not None and timestamp - last_timestamp < self.interval:
+            return False
+
+        try:
+            load_average = system.get("cpu", {}).get("load_average", {})
+            gpu = system.get("gpu")
+            sample = {
+                "timestamp": timestamp,
+                "load1": float(load_average.get("load1", math.nan)),
+                "load5": float(load_average.get("load5", math.nan)),
+                "load15": float(load_average.get("load15", math.nan)),
+                "mem_available_MiB": _to_uint(system.get("mem", {}).get("available_kB", -1) / 1024),
+                "disk_available_MiB": _to_uint(system.get("disk", {}).get("available_kB", -1) / 1024),
+                "gpu_available": len(gpu["available_devices"]) if gpu else -1,
+            }
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # Usage not in the expected format
+            return False
+        history.append(sample)
+        return True
+
+    def memory_bytes(self) -> int:
+        return sum(history.memory_bytes() for history in self.histories.values())
+
+    def stats(self) -> dict:
+        return {
+            "crns": len(self.histories),
+            "samples": sum(len(history) for history in self.histories.values()),
+            "capacity_per_crn": self.capacity,
+            "interval_seconds": self.interval,
+            "memory_bytes": self.memory_bytes(),
+            "max_memory_bytes": self.max_bytes,
+        }
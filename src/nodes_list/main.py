@@ -1,18 +1,32 @@
 import asyncio
+import base64
+import contextlib
 import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
 import logging
+import math
+import os
+import re
 import resource
-from collections import defaultdict
+import secrets
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+import json
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, NamedTuple, Sequence
 from typing import TypeVar, Generic
-from urllib.parse import ParseResult, urlparse
+from urllib.parse import ParseResult, urlencode, urlparse
 
 import aiohttp
 import fastapi
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 
 from nodes_list.response_types import (
     CrnConfig,
@@ -20,21 +34,130 @@ from nodes_list.response_types import (
     NodeAggregate,
     SettingsAggregate,
     CheckIPv6,
+    ResourceNodeInfo,
 )
+from nodes_list.columns import ARROW_MEDIA_TYPE, PARQUET_MEDIA_TYPE, build_columns, to_arrow_ipc, to_parquet
+from nodes_list.health import CrnHealth, HealthWindow, LatencyMetric, Outcome
+from nodes_list.history import UsageHistoryStore
+from nodes_list.match import MatchIndex, Rank
+from nodes_list.node_diff import NodeListDiff, diff_nodes
+from nodes_list.profiling import Profiler, ProfileTarget
+from nodes_list.resolver import CachedResolver, host_port
+from nodes_list.serialization import MEDIA_TYPES, FastJSONResponse, ResponseFormat, dumps, negotiate_format
+from nodes_list.startup import StartupTimes
+from nodes_list.stats import compute_stats, count_gpus_by_model
+from nodes_list.subscriber import AggregateSubscriber
+from nodes_list.upstream import ApiHosts, ApiUnavailable, aggregate_time
+from nodes_list.watchdog import LoopWatchdog
 
 logger = logging.getLogger(__name__)
 
-# API_HOST = "https://api2.aleph.im"
-API_HOST = "https://official.aleph.cloud"
-SETTING_AGGREGATE_URL = (
-    API_HOST.rstrip("/")
-    + "/api/v0/aggregates/0xA07B1214bAe0D5ccAA25449C3149c0aC83658874.json?keys=settings"
-)
+API_HOSTS = [
+    host.strip()
+    for host in os.environ.get("API_HOSTS", "https://official.aleph.cloud,https://api2.aleph.im").split(",")
+    if host.strip()
+]
+"aleph API servers, the first one is preferred while the latencies are unknown"
+API_HOST = API_HOSTS[0]
+NODE_AGGREGATE_ADDRESS = "0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10"
+SETTINGS_AGGREGATE_ADDRESS = "0xA07B1214bAe0D5ccAA25449C3149c0aC83658874"
+NODE_AGGREGATE_PATH = f"/api/v0/aggregates/{NODE_AGGREGATE_ADDRESS}.json?keys=corechannel&with_info=true"
+SETTINGS_AGGREGATE_PATH = f"/api/v0/aggregates/{SETTINGS_AGGREGATE_ADDRESS}.json?keys=settings&with_info=true"
+"Aggregates with the time of their last update, to compare the freshness of the API hosts"
+API_TIMEOUT = float(os.environ.get("API_TIMEOUT", 15))
+"Seconds before a request to an API host is abandoned"
+API_HEDGE_MIN_DELAY = float(os.environ.get("API_HEDGE_MIN_DELAY", 0.5))
+API_HEDGE_MAX_DELAY = float(os.environ.get("API_HEDGE_MAX_DELAY", 3))
+"""Seconds after which an unanswered API request is sent to the next host as well: the 95th percentile of the
+latency of the host, clamped"""
+AGGREGATE_WS_URL = os.environ.get("AGGREGATE_WS_URL")
+"""Message stream websocket of an aleph API server, e.g. wss://official.aleph.cloud/api/ws0/messages.
+When set, the aggregates are only fetched when a message updates them, or every AGGREGATE_RECONCILE_INTERVAL."""
+AGGREGATE_RECONCILE_INTERVAL = int(os.environ.get("AGGREGATE_RECONCILE_INTERVAL", 15 * 60))
+"Seconds between two fetches of an aggregate while subscribed to the message stream, in case a message was missed"
+API_FAILURE_BACKOFF = 30
+API_FAILURE_MAX_BACKOFF = 10 * 60
+"Seconds during which a failing API host is only used after the others, doubled at each failure"
 
 PATH_STATUS_CONFIG = "/status/config"
 PATH_ABOUT_USAGE_SYSTEM = "/about/usage/system"
 PATH_IPv6_CHECK = "/status/check/ipv6"
 
+CRN_MAX_RESPONSE_BYTES = {
+    PATH_STATUS_CONFIG: 256 * 1024,
+    PATH_ABOUT_USAGE_SYSTEM: 1024 * 1024,  # Grows with the number of GPUs
+    PATH_IPv6_CHECK: 4 * 1024,
+}
+"Maximum size of the decoded body of each CRN endpoint, larger responses are aborted while they are read"
+CRN_DEFAULT_MAX_RESPONSE_BYTES = 1024 * 1024
+CRN_MAX_TIMEOUT = 30
+"Seconds before a CRN request is aborted, when its latency is not known yet"
+CRN_MIN_TIMEOUT = 2
+"Lower bound of the timeout derived from the latency of a CRN"
+CRN_TIMEOUT_FACTOR = 3
+"Multiple of the 95th percentile of the latency of a CRN endpoint used as its timeout"
+CRN_LATENCY_SAMPLES = 20
+"Number of latencies kept per CRN endpoint to compute its timeout"
+CRN_LATENCY_MIN_SAMPLES = 3
+"Number of latencies needed before the timeout is derived from them"
+CRN_CONNECT_TIMEOUT = 5
+"Seconds to establish a connection to a CRN, including the TLS handshake"
+CRN_READ_IDLE_TIMEOUT = 10
+"Seconds without receiving any data from a CRN after which the request is aborted"
+CRN_MIN_THROUGHPUT = 1024
+"Bytes per second under which a CRN response is aborted, once CRN_THROUGHPUT_GRACE_PERIOD has passed"
+CRN_THROUGHPUT_GRACE_PERIOD = 5
+"Seconds of reading a CRN response before its throughput is checked, so a slow start is tolerated"
+CRN_THREAD_DECODE_BYTES = 64 * 1024
+"CRN responses larger than this are decoded in a thread, not to block the event loop"
+
+REFRESH_INTERVAL = 31
+"Seconds between the start of two refresh cycles of the background loop"
+REFRESH_RESTART_DELAY = 5
+"Seconds to wait before restarting the refresh loop after a crash"
+CACHE_STALE_WHILE_REVALIDATE = int(os.environ.get("CACHE_STALE_WHILE_REVALIDATE", 4 * REFRESH_INTERVAL))
+"Seconds a CDN may keep serving a stale response while it revalidates it in the background"
+MAX_DATA_AGE = int(os.environ.get("MAX_DATA_AGE", 15 * 60))
+"Data older than this many seconds is not served anymore, an error is returned instead"
+INACTIVE_POLL_CYCLES = int(os.environ.get("INACTIVE_POLL_CYCLES", 10))
+"Inactive CRNs are fetched once every this many refresh cycles"
+FAILING_POLL_MAX_CYCLES = int(os.environ.get("FAILING_POLL_MAX_CYCLES", 16))
+"CRNs that keep failing are fetched less and less often, down to once every this many refresh cycles"
+REFRESH_DEADLINE = int(os.environ.get("REFRESH_DEADLINE", REFRESH_INTERVAL - 6))
+"Seconds after the start of a refresh cycle at which the CRN fetches still running are cancelled"
+FORCE_REFRESH_MIN_INTERVAL = int(os.environ.get("FORCE_REFRESH_MIN_INTERVAL", 60))
+"Minimum seconds between two refreshes forced from the debug endpoints, the refresh loop does not count"
+GPU_AGGREGATE_TTL = 5 * 60
+"Seconds before the settings aggregate (compatible GPUs) is fetched again"
+CURSOR_GENERATIONS = 3
+"Number of data generations for which the pagination cursors remain valid"
+HISTORY_INTERVAL = int(os.environ.get("HISTORY_INTERVAL", 60))
+"Minimum seconds between two samples in the usage history of a CRN"
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", 24 * 3600 // HISTORY_INTERVAL))
+"Number of samples kept in the usage history of each CRN, 24h by default"
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", 128 * 1024 * 1024))
+"Memory cap of the usage history of all the CRNs, fewer samples are kept per CRN if needed"
+LOOP_LAG_INTERVAL = 0.1
+"Seconds between two measures of the event loop lag"
+LOOP_SLOW_THRESHOLD = float(os.environ.get("LOOP_SLOW_THRESHOLD", 0.1))
+"Seconds a callback or task step must block the event loop to be reported in /debug/loop"
+PROFILE_TOKEN = os.environ.get("DEBUG_PROFILE_TOKEN")
+"Bearer token required by the /debug/profile endpoints, which are disabled when not set"
+PROFILE_RING_SIZE = 5
+"Number of finished profiles kept in memory"
+PROFILE_MAX_COUNT = 20
+"Maximum number of refresh cycles or requests captured by a profile"
+ENCODED_RESPONSES_CACHE_SIZE = 8
+"Number of encoded /crns.json variants (format, sort, profile...) kept for the current generation"
+DNS_CACHE_TTL = int(os.environ.get("DNS_CACHE_TTL", 5 * 60))
+"Seconds the resolved addresses of a CRN hostname are kept"
+DNS_NEGATIVE_CACHE_TTL = int(os.environ.get("DNS_NEGATIVE_CACHE_TTL", 60))
+"Seconds before a CRN hostname that could not be resolved is tried again"
+DNS_CONCURRENCY = 32
+"Maximum number of DNS lookups in flight at the start of a refresh cycle"
+CRN_CONNECTIONS_PER_HOST = int(os.environ.get("CRN_CONNECTIONS_PER_HOST", 4))
+"Maximum number of CRNs fetched at the same time from the same address and port, e.g. behind a reverse proxy"
+
 # Some users had fun adding URLs that are obviously not CRNs.
 # If you work for one of these companies, please send a large check to the Aleph team,
 # and we may consider removing your domain from the blacklist. Or just use a subdomain.
@@ -51,7 +174,39 @@ FORBIDDEN_HOSTS = [
     "youtube.com",
 ]
 
-app = fastapi.FastAPI(debug=True)
+
+@functools.cache
+def configure_logging() -> None:
+    """Configure the logging once, on the first start instead of at import time"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s %(name)s:%(lineno)s | %(message)s ",
+    )
+    logger.info("Open files limit: soft %s, hard %s", soft_limit, hard_limit)
+
+
+def start_background_tasks() -> None:
+    """Configure the logging and start the loop watchdog and the refresh loop, if not already done.
+
+    Called from the application lifespan, and as a fallback from the request handlers
+    for runtimes that do not send the lifespan events."""
+    configure_logging()
+    watchdog.start()
+    data_cache.start()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    """Run the refresh loop and the loop watchdog for the whole lifetime of the application"""
+    start_background_tasks()
+    try:
+        yield
+    finally:
+        await data_cache.stop()
+        await watchdog.stop()
+
+
+app = fastapi.FastAPI(debug=True, lifespan=lifespan)
 
 # This is a  pure readonly API service without auth, allow all CORS so frontends can use it without restrictions
 app.add_middleware(
@@ -69,13 +224,22 @@ app.add_middleware(
 # resource.setrlimit(resource.RLIMIT_NOFILE, (1000, 1048576))
 # Get the system's open file descriptor limit
 soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
-print(f"Soft limit: {soft_limit}, Hard limit: {hard_limit}")
 
 # Limit the number of concurrent open file descriptors
 MAX_CONCURRENT_FILES = min(soft_limit // 2, 100)  # Safety margin
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
 "Semaphore to limit conccurent connection to CRN as to not reach Too many open file errors"
 
+RESPONSE_BUILDER_THREAD_NAME = "response-builder"
+
+startup = StartupTimes()
+profiler = Profiler(PROFILE_RING_SIZE, worker_prefixes=(RESPONSE_BUILDER_THREAD_NAME,))
+watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_SLOW_THRESHOLD)
+response_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix=RESPONSE_BUILDER_THREAD_NAME)
+"""Thread building the snapshots and encoding the responses, so it doesn't block the request handling.
+
+It still holds the GIL while it runs, but the event loop gets it back every sys.getswitchinterval()."""
+
 
 def find_in_aggr(aggr: SettingsAggregate, gpu_device_id) -> bool:
     """Find if gpu is present in the Settings aggregate compatible gpus list"""
@@ -86,6 +250,13 @@ def find_in_aggr(aggr: SettingsAggregate, gpu_device_id) -> bool:
     return False
 
 
+def gpu_models(aggr: SettingsAggregate | None) -> dict[str, str]:
+    """Model of each compatible GPU device id of the Settings aggregate"""
+    if not aggr:
+        return {}
+    return {gpu["device_id"]: gpu["model"] for gpu in aggr["data"]["settings"]["compatible_gpus"]}
+
+
 def sanitize_url(url: str) -> str:
     """Ensure that the URL is valid and not obviously irrelevant.
 
@@ -108,62 +279,143 @@ def sanitize_url(url: str) -> str:
     return url
 
 
-def is_url_valid(url: str) -> bool:
-    """Ensure that the URL is valid and not obviously irrelevant.
+def api_hosts() -> ApiHosts:
+    return ApiHosts(
+        API_HOSTS, API_TIMEOUT, API_HEDGE_MIN_DELAY, API_HEDGE_MAX_DELAY, API_FAILURE_BACKOFF, API_FAILURE_MAX_BACKOFF
+    )
 
-    Args:
-        url: URL to sanitize.
-    Returns:
-        Sanitized URL.
-    """
-    # noinspection PyBroadException
+
+async def _fetch_node_list(api: ApiHosts | None = None) -> NodeAggregate | None:
+    """Fetch node aggregates, from the first API host to answer"""
+    api = api or api_hosts()
+    logger.info("Fetching node list from %s", api.ranked()[0].url)
     try:
-        sanitize_url(url)
-        return True
-    except Exception:
-        return False
+        data: NodeAggregate = await api.get_json(NODE_AGGREGATE_PATH, "corechannel")  # type: ignore
+    except ApiUnavailable as e:
+        logger.error("Unable to fetch node information: %s", e)
+        return None
+    return data
+
+
+CONNECTION_ERRORS = (aiohttp.InvalidURL, aiohttp.ClientConnectionError, TimeoutError)
+"Errors meaning the CRN could not be reached at all, as opposed to it returning an invalid response"
+
+
+def fetch_outcome(error: Exception) -> Outcome:
+    if isinstance(error, TimeoutError):
+        return Outcome.timeout
+    if isinstance(error, CONNECTION_ERRORS):
+        return Outcome.unreachable
+    return Outcome.error
+
+
+class ResponseTooLarge(aiohttp.ClientPayloadError):
+    """The CRN response is larger than the maximum size of the endpoint"""
+
+
+class SlowResponse(TimeoutError):
+    """The CRN sends its response too slowly"""
+
 
+class RefreshDeadline(TimeoutError):
+    """The CRN did not answer before the deadline of the refresh cycle"""
 
-async def _fetch_node_list() -> NodeAggregate | None:
-    """Fetch node aggregates"""
-    aggregate_endpoint = "/api/v0/aggregates/0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10.json?keys=corechannel"
-    node_link = API_HOST.rstrip("/") + aggregate_endpoint
-    logger.info("Fetching node list from %s", node_link)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(node_link) as resp:
-            if resp.status != 200:
-                logger.error("Unable to fetch node information")
-                return None
+class RequestTiming:
+    """Timings of a CRN request, filled by the trace of crn_session() when passed as `trace_request_ctx`"""
 
-            data = await resp.json()
-            return data
+    started_at: float | None = None
+    connect_started_at: float | None = None
+    connect: float | None = None
+    "Seconds to open the connection, None if an open connection was reused"
+    ttfb: float | None = None
+    "Seconds from the start of the request to the response headers"
 
 
-async def fetch_crn_endpoint(node_url: str, endpoint: str) -> dict:
+def request_timing_trace() -> aiohttp.TraceConfig:
+    """Trace filling the RequestTiming of the requests"""
+
+    def timing(trace_config_ctx) -> RequestTiming | None:
+        timing = trace_config_ctx.trace_request_ctx
+        return timing if isinstance(timing, RequestTiming) else None
+
+    async def on_request_start(session, trace_config_ctx, params) -> None:
+        if request_timing := timing(trace_config_ctx):
+            request_timing.started_at = time.monotonic()
+
+    async def on_connection_create_start(session, trace_config_ctx, params) -> None:
+        if request_timing := timing(trace_config_ctx):
+            request_timing.connect_started_at = time.monotonic()
+
+    async def on_connection_create_end(session, trace_config_ctx, params) -> None:
+        if (request_timing := timing(trace_config_ctx)) and request_timing.connect_started_at is not None:
+            request_timing.connect = time.monotonic() - request_timing.connect_started_at
+
+    async def on_request_end(session, trace_config_ctx, params) -> None:
+        if (request_timing := timing(trace_config_ctx)) and request_timing.started_at is not None:
+            request_timing.ttfb = time.monotonic() - request_timing.started_at
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_create_start.append(on_connection_create_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+def crn_session(**kwargs) -> aiohttp.ClientSession:
+    """Client session used to query CRNs"""
+    timeout = aiohttp.ClientTimeout(
+        total=CRN_MAX_TIMEOUT, sock_connect=CRN_CONNECT_TIMEOUT, sock_read=CRN_READ_IDLE_TIMEOUT
+    )
+    return aiohttp.ClientSession(timeout=timeout, trace_configs=[request_timing_trace()], **kwargs)
+
+
+def crn_timeout(latencies: Sequence[float]) -> aiohttp.ClientTimeout:
+    """Timeout of a CRN request: a multiple of the 95th percentile of the recent latencies of the endpoint, clamped.
+
+    Args:
+        latencies: duration of the last requests to the endpoint, in seconds.
+    """
+    if len(latencies) < CRN_LATENCY_MIN_SAMPLES:
+        total = float(CRN_MAX_TIMEOUT)
+    else:
+        p95 = sorted(latencies)[math.ceil(0.95 * len(latencies)) - 1]
+        total = min(float(CRN_MAX_TIMEOUT), max(float(CRN_MIN_TIMEOUT), p95 * CRN_TIMEOUT_FACTOR))
+    return aiohttp.ClientTimeout(
+        total=total, sock_connect=min(CRN_CONNECT_TIMEOUT, total), sock_read=min(CRN_READ_IDLE_TIMEOUT, total)
+    )
+
+
+async def fetch_crn_endpoint(
+    node_url: str,
+    endpoint: str,
+    session: aiohttp.ClientSession | None = None,
+    timeout: aiohttp.ClientTimeout | None = None,
+    timing: RequestTiming | None = None,
+) -> dict:
     """
     Call api endpoint on CRN
 
     Args:
         node_url: URL of the compute node.
         endpoint: endpoint to call.
+        session: session to reuse. If not set, a new one is opened, limited by the semaphore.
+        timeout: timeout of the request, the one of the session if not set.
+        timing: filled with the timings of the request, if the session comes from crn_session().
     Returns:
         CRN information.
     """
     url = ""
+    max_bytes = CRN_MAX_RESPONSE_BYTES.get(endpoint, CRN_DEFAULT_MAX_RESPONSE_BYTES)
     try:
         base_url: str = sanitize_url(node_url.rstrip("/"))
-        async with semaphore:  # Ensures limited concurrency
-            url = base_url + endpoint
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                logger.debug(f"Fetching node information from {url}")
-                info: dict
-                async with session.get(url) as resp:
-                    resp.raise_for_status()
-                    info = await resp.json()  # type: ignore
-                    logger.debug(f"Received response from node {url}")
-                    return info
+        url = base_url + endpoint
+        if session is None:
+            async with semaphore:  # Ensures limited concurrency
+                async with crn_session() as session:
+                    return await _get_crn_json(session, url, max_bytes, timeout, timing)
+        return await _get_crn_json(session, url, max_bytes, timeout, timing)
     except aiohttp.InvalidURL as e:
         logger.info(f"Invalid CRN URL: {url}: {e}")
         raise
@@ -176,6 +428,9 @@ async def fetch_crn_endpoint(node_url: str, endpoint: str) -> dict:
     except aiohttp.ClientResponseError as e:
         logger.info(f"Error on CRN response: {url}: {e}")
         raise
+    except ResponseTooLarge as e:
+        logger.info(f"CRN response too large: {url}: {e}")
+        raise
     except JSONDecodeError as e:
         logger.info(f"Error decoding CRN JSON: {url}: {e}")
         raise
@@ -184,29 +439,76 @@ async def fetch_crn_endpoint(node_url: str, endpoint: str) -> dict:
         raise
 
 
-async def fetch_crn_config(node_url: str) -> CrnConfig:
+async def _get_crn_json(
+    session: aiohttp.ClientSession,
+    url: str,
+    max_bytes: int,
+    timeout: aiohttp.ClientTimeout | None = None,
+    timing: RequestTiming | None = None,
+) -> dict:
+    logger.debug(f"Fetching node information from {url}")
+    info: dict
+    async with session.get(url, timeout=timeout or session.timeout, trace_request_ctx=timing) as resp:
+        resp.raise_for_status()
+        if "json" not in resp.content_type:
+            raise aiohttp.ContentTypeError(
+                resp.request_info,
+                resp.history,
+                status=resp.status,
+                message=f"Attempt to decode JSON with unexpected mimetype: {resp.content_type}",
+                headers=resp.headers,
+            )
+        body = await _read_capped(resp, max_bytes)
+        info = json.loads(body) if len(body) <= CRN_THREAD_DECODE_BYTES else await asyncio.to_thread(json.loads, body)
+        logger.debug(f"Received response from node {url}")
+        return info
+
+
+async def _read_capped(resp: aiohttp.ClientResponse, max_bytes: int) -> bytes:
+    """Read the body of a CRN response, aborting as soon as it exceeds `max_bytes` or comes too slowly.
+
+    CRNs are run by third parties, a misbehaving one must not be able to use a lot of memory or hold
+    a connection slot until the total timeout."""
+    if resp.content_length is not None and resp.content_length > max_bytes:
+        raise ResponseTooLarge(f"Content-Length {resp.content_length} exceeds {max_bytes} bytes")
+    body = bytearray()
+    started_at = time.monotonic()
+    # Chunks are decompressed, so the limit also applies to compressed responses
+    async for chunk in resp.content.iter_chunked(64 * 1024):
+        body += chunk
+        if len(body) > max_bytes:
+            raise ResponseTooLarge(f"Response exceeds {max_bytes} bytes")
+        elapsed = time.monotonic() - started_at
+        if elapsed > CRN_THROUGHPUT_GRACE_PERIOD and len(body) / elapsed < CRN_MIN_THROUGHPUT:
+            raise SlowResponse(f"Response slower than {CRN_MIN_THROUGHPUT} bytes/s")
+    return bytes(body)
+
+
+async def fetch_crn_config(node_url: str, session: aiohttp.ClientSession | None = None) -> CrnConfig:
     """
     Fetches compute node config.
 
     Args:
         node_url: URL of the compute node.
+        session: session to reuse, optional.
     Returns:
         CRN information.
     """
-    data: CrnConfig = await fetch_crn_endpoint(node_url, PATH_STATUS_CONFIG)  # type: ignore
+    data: CrnConfig = await fetch_crn_endpoint(node_url, PATH_STATUS_CONFIG, session)  # type: ignore
     return data
 
 
-async def fetch_crn_system(node_url: str) -> CRNSystemInfo:
+async def fetch_crn_system(node_url: str, session: aiohttp.ClientSession | None = None) -> CRNSystemInfo:
     """
     Fetches compute node  system information: resource and usage.
 
     Args:
         node_url: URL of the compute node.
+        session: session to reuse, optional.
     Returns:
         CRN dict.
     """
-    data: CRNSystemInfo = await fetch_crn_endpoint(node_url, PATH_ABOUT_USAGE_SYSTEM)  # type: ignore
+    data: CRNSystemInfo = await fetch_crn_endpoint(node_url, PATH_ABOUT_USAGE_SYSTEM, session)  # type: ignore
     return data
 
 
@@ -219,7 +521,7 @@ class CachedResponse(Generic[T]):
     data: T | None = None
     fetched_at: datetime.datetime | None = None
     error: Exception | None = None
-    error_at: datetime.datetime | None
+    error_at: datetime.datetime | None = None
 
     def set_data(self, new_data: T):
         self.data = new_data
@@ -249,40 +551,167 @@ class CRNData:
     config_fetched_at: datetime.datetime | None = None  # Last successful data
     error: Exception | None = None
     error_at: datetime.datetime | None
-    node_url: str
+    _node_url: str | None = None
+    url_error: Exception | None = None
+    "Result of sanitize_url() on the node URL, memoized until the URL changes"
+    latencies: dict[str, deque[float]]
+    "Duration in seconds of the last requests to each endpoint, to adapt their timeout"
+    health: CrnHealth
+    "Latency and availability over the last hour and day, of the requests to all the endpoints"
+    failures: int = 0
+    "Number of consecutive fetches in which the config could not be fetched"
+    next_refresh_cycle: int = 0
+    "Refresh cycle (data generation) from which the CRN is due to be fetched again"
+    fetching: bool = False
+    "Whether the endpoints are being fetched, as opposed to waiting for a slot of the semaphores"
     system_data: CRNSystemInfo | None = None
     system_data_fetched_at: datetime.datetime | None = None  # Last successful data
     system_error: Exception | None = None
     system_error_at: datetime.datetime | None
 
-    def __init__(self):
+    def __init__(self, node_url: str = ""):
         self.config = CachedResponse()
         self.system = CachedResponse()
         self.check_ipv6 = CachedResponse()
+        self.latencies = {}
+        self.health = CrnHealth()
+        self.node_url = node_url
+
+    @property
+    def node_url(self) -> str:
+        return self._node_url or ""
+
+    @node_url.setter
+    def node_url(self, url: str) -> None:
+        if url == self._node_url:
+            return
+        self._node_url = url
+        try:
+            sanitize_url(url)
+            self.url_error = None
+        except Exception as e:
+            self.url_error = e
 
     @property
     def is_valid(self):
-        return is_url_valid(self.node_url)
+        return self.url_error is None
+
+    def set_error(self, e: Exception) -> None:
+        """Record the error on all the endpoints, when the CRN cannot be queried at all.
+
+        Each endpoint counts as an unreachable request in the health, as many as the requests to a CRN that answers.
+        """
+        for cached_response in (self.config, self.system, self.check_ipv6):
+            cached_response.set_error(e)
+            self.health.record(Outcome.unreachable)
 
-    async def fetch_config(self) -> None:
+    async def fetch_all(
+        self, session: aiohttp.ClientSession | None = None, host_slot: asyncio.Semaphore | None = None
+    ) -> None:
+        """Fetch the config, system usage and IPv6 check of the CRN.
+
+        The config is fetched first as a probe: if the CRN cannot be reached, the other endpoints
+        fail right away with the same error instead of each waiting for its own timeout.
+
+        Args:
+            session: session shared with the other CRNs. If not set, a new one with a single connection is opened.
+            host_slot: semaphore shared with the other CRNs on the same address, acquired before the global one.
+        """
+        if self.url_error:
+            self.set_error(self.url_error)
+        elif session is None:
+            async with semaphore:  # A single slot and connection for the whole CRN
+                async with crn_session(connector=aiohttp.TCPConnector(limit=1)) as session:
+                    await self._fetch_endpoints(session)
+        else:
+            # Waiting for a busy host must not hold a slot of the global semaphore
+            async with host_slot or contextlib.nullcontext():
+                async with semaphore:
+                    await self._fetch_endpoints(session)
+        self.failures = 0 if self.config.error is None else self.failures + 1
+
+    def refresh_every(self, node: ResourceNodeInfo) -> int:
+        """Number of refresh cycles between two fetches of the CRN.
+
+        Active CRNs are fetched on each cycle. Inactive ones and the ones that keep failing less often,
+        the interval doubling with each consecutive failure."""
+        every = min(2 ** max(0, self.failures - 1), FAILING_POLL_MAX_CYCLES)
+        if node["inactive_since"] is not None:
+            every = max(every, INACTIVE_POLL_CYCLES)
+        return every
+
+    async def _fetch_endpoints(self, session: aiohttp.ClientSession) -> None:
+        self.fetching = True
+        config_fetched = False
+        try:
+            await self.fetch_config(session)
+            config_fetched = True
+            if isinstance(self.config.error, CONNECTION_ERRORS):
+                # The skipped endpoints count as failed with the same outcome, as if they had been requested
+                outcome = fetch_outcome(self.config.error)
+                for cached_response in (self.system, self.check_ipv6):
+                    cached_response.set_error(self.config.error)
+                    self.health.record(outcome)
+                return
+            await asyncio.gather(self.fetch_system(session), self.fetch_ipv6(session))
+        except asyncio.CancelledError:
+            # Cancelled by the deadline of the refresh: counts as a failure, so a CRN that is always too slow
+            # is backed off instead of being fetched first again in each cycle
+            if not config_fetched:
+                error = RefreshDeadline("Refresh deadline reached")
+                self.config.set_error(error)
+                for cached_response in (self.system, self.check_ipv6):
+                    cached_response.set_error(error)
+                    self.health.record(Outcome.timeout)
+            self.failures += 1
+            raise
+        finally:
+            self.fetching = False
+
+    async def fetch_endpoint(self, endpoint: str, session: aiohttp.ClientSession | None = None) -> dict:
+        """Fetch an endpoint with a timeout adapted to its recent latency, and record the latency and outcome"""
+        latencies = self.latencies.setdefault(endpoint, deque(maxlen=CRN_LATENCY_SAMPLES))
+        timeout = crn_timeout(latencies)
+        timing = RequestTiming()
+        started_at = time.monotonic()
+        try:
+            result = await fetch_crn_endpoint(self.node_url, endpoint, session, timeout, timing)
+        except Exception as e:
+            outcome = fetch_outcome(e)
+            # The total time is only known when the CRN answered
+            total = time.monotonic() - started_at if outcome == Outcome.error else None
+            self.health.record(outcome, timing.connect, timing.ttfb, total)
+            if isinstance(e, TimeoutError):
+                # The latency is at least the timeout, so a CRN that got slower gets a longer timeout next time
+                latencies.append(timeout.total or CRN_MAX_TIMEOUT)
+            raise
+        except asyncio.CancelledError:
+            # The refresh deadline was reached first: the latency is at least the time waited
+            self.health.record(Outcome.timeout, timing.connect, timing.ttfb)
+            latencies.append(time.monotonic() - started_at)
+            raise
+        total = time.monotonic() - started_at
+        latencies.append(total)
+        self.health.record(Outcome.ok, timing.connect, timing.ttfb, total)
+        return result
+
+    async def fetch_config(self, session: aiohttp.ClientSession | None = None) -> None:
         try:
-            fetched_info = await fetch_crn_config(self.node_url)
+            fetched_info: CrnConfig = await self.fetch_endpoint(PATH_STATUS_CONFIG, session)  # type: ignore
             self.config.set_data(fetched_info)
         except Exception as e:
             self.config.set_error(e)
 
-    async def fetch_ipv6(self) -> None:
+    async def fetch_ipv6(self, session: aiohttp.ClientSession | None = None) -> None:
         try:
-            fetched_info: CheckIPv6 = await fetch_crn_endpoint(
-                self.node_url, PATH_IPv6_CHECK
-            )  # type: ignore
+            fetched_info: CheckIPv6 = await self.fetch_endpoint(PATH_IPv6_CHECK, session)  # type: ignore
             self.check_ipv6.set_data(fetched_info)
         except Exception as e:
             self.check_ipv6.set_error(e)
 
-    async def fetch_system(self) -> None:
+    async def fetch_system(self, session: aiohttp.ClientSession | None = None) -> None:
         try:
-            fetched_info = await fetch_crn_system(self.node_url)
+            fetched_info: CRNSystemInfo = await self.fetch_endpoint(PATH_ABOUT_USAGE_SYSTEM, session)  # type: ignore
             self.system.set_data(fetched_info)
         except Exception as e:
             self.system.set_error(e)
@@ -306,13 +735,13 @@ class CRNData:
         )
 
     @property
-    async def compatible_gpus(self) -> list[dict]:
+    def compatible_gpus(self) -> list[dict]:
         if not (self.system.data and "gpu" in self.system.data):
             return []
 
         devices: list[Any] = self.system.data["gpu"]["devices"]
 
-        aggr = await data_cache.get_gpu_aggregate()
+        aggr = data_cache.get_gpu_aggregate()
         if not aggr:
             logger.error("No settings aggregate, cannot filter devices.")
             return []
@@ -322,13 +751,13 @@ class CRNData:
         return compatible_gpu
 
     @property
-    async def compatible_available_gpus(self) -> list[dict]:
+    def compatible_available_gpus(self) -> list[dict]:
         if not (self.system.data and "gpu" in self.system.data):
             return []
 
         devices: list[Any] = self.system.data["gpu"]["available_devices"]
 
-        aggr = await data_cache.get_gpu_aggregate()
+        aggr = data_cache.get_gpu_aggregate()
         if not aggr:
             logger.error("No settings aggregate, cannot filter devices.")
             return []
@@ -338,160 +767,1102 @@ class CRNData:
         return compatible_gpu
 
 
+class SortKey(str, Enum):
+    score = "score"
+    memory = "memory"
+    disk = "disk"
+    cpu = "cpu"
+    load = "load"
+    gpu = "gpu"
+    version = "version"
+
+
+class SortOrder(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+
+def version_key(version: str) -> tuple[int, ...]:
+    """Comparable key for CRN versions such as `1.3.0` or `1.3.0-41-g7303587` (41 commits after 1.3.0)"""
+    return tuple(int(number) for number in re.findall(r"\d+", version.split("-g")[0]))
+
+
+SORT_KEYS: dict[SortKey, Callable[[ResourceNodeInfo, "CRNData"], Any]] = {
+    SortKey.score: lambda node, crn: node["score"],
+    SortKey.memory: lambda node, crn: crn.system.data["mem"]["available_kB"],  # type: ignore
+    SortKey.disk: lambda node, crn: crn.system.data["disk"]["available_kB"],  # type: ignore
+    SortKey.cpu: lambda node, crn: crn.system.data["cpu"]["count"],  # type: ignore
+    SortKey.load: lambda node, crn: crn.system.data["cpu"]["load_average"]["load5"],  # type: ignore
+    SortKey.gpu: lambda node, crn: len(crn.compatible_available_gpus) if crn.system.data else None,
+    SortKey.version: lambda node, crn: version_key(crn.config.data["version"]),  # type: ignore
+}
+"How to get the value to sort the CRNs by for each sort key. A value of None means unknown."
+
+
+def _sort_value(sort_key: SortKey, node: ResourceNodeInfo, crn: "CRNData") -> Any:
+    # noinspection PyBroadException
+    try:
+        return SORT_KEYS[sort_key](node, crn)
+    except Exception:
+        # The CRN data is missing or not in the expected format
+        return None
+
+
+class ResponseProfile(str, Enum):
+    compact = "compact"
+    "Without the debug fields and null errors, with a summary of the system usage"
+    full = "full"
+    debug = "debug"
+    "With the fetch time and error of each CRN endpoint"
+
+
+PREBUILT_RESPONSES = [
+    {
+        "filter_inactive": filter_inactive,
+        "sort": SortKey.score,
+        "order": SortOrder.desc,
+        "limit": None,
+        "cursor": None,
+        "profile": profile,
+    }
+    for filter_inactive in (False, True)
+    for profile in (ResponseProfile.full, ResponseProfile.compact)
+]
+"Parameters of the /crns.json responses encoded in JSON with each snapshot, the default sort in each profile"
+
+
+def summarize_usage(system: CRNSystemInfo | None) -> dict | None:
+    """Main numbers of the CRN system usage, for the compact response profile"""
+    if not system:
+        return None
+    # noinspection PyBroadException
+    try:
+        return {
+            "cpu_count": system["cpu"]["count"],
+            "load1": system["cpu"]["load_average"]["load1"],
+            "load5": system["cpu"]["load_average"]["load5"],
+            "load15": system["cpu"]["load_average"]["load15"],
+            "mem_total_kB": system["mem"]["total_kB"],
+            "mem_available_kB": system["mem"]["available_kB"],
+            "disk_total_kB": system["disk"]["total_kB"],
+            "disk_available_kB": system["disk"]["available_kB"],
+            "gpu_count": len(system["gpu"]["devices"]) if "gpu" in system else 0,
+            "gpu_available_count": len(system["gpu"]["available_devices"]) if "gpu" in system else 0,
+            "active": system.get("active"),
+        }
+    except Exception:
+        return None
+
+
+class SortedViews:
+    """Snapshot of one generation of the data: order of the CRNs for each sort key, order and inactive filter,
+    the CRNs formatted in each response profile, the prebuilt /crns.json responses, the fleet columns and stats and
+    the index of /crns/match.
+
+    Not modified once built, so it can be read from the response builder thread while a refresh runs."""
+
+    generation: int
+    nodes_by_hash: dict[str, ResourceNodeInfo]
+    orders: dict[tuple[SortKey, SortOrder, bool], list[str]]
+    last_refresh: datetime.datetime | None
+    entries: dict[ResponseProfile, dict[str, dict]]
+    "CRNs of the /crns.json responses, by profile and hash"
+    bodies: dict[tuple, bytes]
+    "Encoded responses of PREBUILT_RESPONSES, by response_key()"
+    columns: dict[str, list]
+    "Columnar view of the fleet, one row per CRN by descending score"
+    stats: dict
+    "Network totals and distributions over the active CRNs"
+    health: dict[str, CrnHealth]
+    "Copy of the latency and availability of each CRN, by hash"
+    match_index: MatchIndex
+    "Capacity of the CRNs, to find the CRNs able to host a VM"
+
+    def __init__(
+        self,
+        generation: int,
+        nodes_by_hash: dict[str, ResourceNodeInfo],
+        orders: dict,
+        last_refresh: datetime.datetime | None = None,
+        entries: dict[ResponseProfile, dict[str, dict]] | None = None,
+        bodies: dict[tuple, bytes] | None = None,
+        columns: dict[str, list] | None = None,
+        stats: dict | None = None,
+        health: dict[str, CrnHealth] | None = None,
+        match_index: MatchIndex | None = None,
+    ):
+        self.generation = generation
+        self.nodes_by_hash = nodes_by_hash
+        self.orders = orders
+        self.last_refresh = last_refresh
+        self.entries = entries or {profile: {} for profile in ResponseProfile}
+        self.bodies = bodies or {}
+        self.columns = columns or build_columns([], {})
+        self.stats = stats or compute_stats(self.columns, {})
+        self.health = health or {}
+        self.match_index = match_index or MatchIndex(self.columns, [], {})
+
+
+def response_key(response_format: ResponseFormat, kwargs: dict[str, Any]) -> tuple:
+    """Key of an encoded /crns.json response, by format and parameters"""
+    return (response_format, *sorted(kwargs.items()))
+
+
+def _view_params(kwargs: dict[str, Any]) -> dict[str, Any]:
+    """Parameters of format_views() from the /crns.json parameters, the cursor is resolved separately"""
+    defaults = {"filter_inactive": False, "sort": SortKey.score, "order": SortOrder.desc}
+    return {**defaults, **{name: value for name, value in kwargs.items() if name != "cursor"}}
+
+
+def format_views(
+    views: SortedViews,
+    filter_inactive: bool,
+    sort: SortKey = SortKey.score,
+    order: SortOrder = SortOrder.desc,
+    start: int = 0,
+    limit: int | None = None,
+    profile: ResponseProfile = ResponseProfile.full,
+    paginated: bool = False,
+) -> dict[str, Any]:
+    """The CRN list of a snapshot, or a page of it from `start` if `paginated`"""
+    hashes = views.orders.get((sort, order, filter_inactive), [])
+    end = len(hashes) if limit is None else start + limit
+    entries = views.entries[profile]
+    resp: dict[str, Any] = {
+        "last_refresh": views.last_refresh,
+        "crns": [entries[crn_hash] for crn_hash in hashes[start:end] if crn_hash in entries],
+    }
+    if paginated:
+        resp["total"] = len(hashes)
+        resp["next_cursor"] = (
+            Cursor(views.generation, sort, order, filter_inactive, end).encode() if end < len(hashes) else None
+        )
+    return resp
+
+
+class Cursor(NamedTuple):
+    """Position in a sorted view, for pagination"""
+
+    generation: int
+    sort: SortKey
+    order: SortOrder
+    filter_inactive: bool
+    offset: int
+
+    def encode(self) -> str:
+        payload = json.dumps([self.generation, self.sort.value, self.order.value, self.filter_inactive, self.offset])
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str) -> "Cursor":
+        try:
+            payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            generation, sort, order, filter_inactive, offset = json.loads(payload)
+            position = cls(int(generation), SortKey(sort), SortOrder(order), bool(filter_inactive), int(offset))
+        except Exception as e:
+            raise InvalidCursor("Invalid cursor") from e
+        if position.offset < 0:
+            raise InvalidCursor("Invalid cursor")
+        return position
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ExpiredCursor(InvalidCursor):
+    pass
+
+
+def _log_refresh_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        logger.error("Refresh cycle failed: %r", task.exception())
+
+
 class DataCache:
     node_list: CachedResponse[NodeAggregate]
     gpu_aggregate: CachedResponse[SettingsAggregate]
-    crn_infos: defaultdict[str, CRNData] = defaultdict(CRNData)
+    crn_infos: defaultdict[str, CRNData]
+    sorted_views: SortedViews
+    "CRN order for the current generation, updated when a refresh completes"
+    recent_views: OrderedDict[int, SortedViews]
+    "Sorted views of the last generations, so the pagination cursors stay valid while a refresh lands"
+    derived: dict[str, Any]
+    "Data derived from the current generation on first request, the health reports and exports, by name"
+    encoded_responses: OrderedDict[tuple, bytes]
+    "Most recently used encoded /crns.json responses of the current generation"
+    usage_history: UsageHistoryStore
+    resolver: CachedResolver
+    "DNS cache of the CRN hostnames, kept across refresh cycles"
+    api: ApiHosts
+    "aleph API servers the aggregates are fetched from"
+    subscriber: AggregateSubscriber | None = None
+    "Subscription to the aggregate updates, if AGGREGATE_WS_URL is set"
+    changed_aggregates: dict[str, float | None]
+    "Aggregate keys updated by a message since they were last fetched, with the time of the latest update if known"
+    aggregate_fetched_at: dict[str, float]
+    "time.monotonic() of the last successful fetch of each aggregate key"
+    node_list_diff: NodeListDiff | None = None
+    "Changes in the node list at the last refresh"
+    carried_over: set[str]
+    "CRNs still waiting for a slot at the deadline of the last refresh, fetched first in the next one"
 
     refresh_task: asyncio.Task | None = None
+    forced_refresh_at: float | None = None
+    "time.monotonic() at the start of the last refresh forced from /debug/node"
+    loop_task: asyncio.Task | None = None
+    generation: int = 0
+    "Incremented each time a refresh cycle completes"
 
     def __init__(self):
         self.gpu_aggregate = CachedResponse()
         self.node_list = CachedResponse()
-
-    async def ensure_fresh_data(self) -> tuple[NodeAggregate | None, dict]:
-        """Ensure we refresh the data and return it
-
-        1. if data is older than big threshold. Wait till we have refreshed the whole data set or max 10s
-        2. if data is older than small threshold, launch cache refresh in background and use data already in cache
-        3. else return data directly
-        """
-        if self.node_list.is_older_than(seconds=120):
-            if not self.refresh_task_is_running():
-                self.refresh_task = asyncio.create_task(
-                    self.fetch_node_list_and_node_data()
-                )
-
-            done, pending = await asyncio.wait(
-                [self.refresh_task],
-                timeout=10,
+        self.crn_infos = defaultdict(CRNData)
+        self.sorted_views = SortedViews(generation=0, nodes_by_hash={}, orders={})
+        self.recent_views = OrderedDict()
+        self.derived = {}
+        self.encoded_responses = OrderedDict()
+        self.usage_history = UsageHistoryStore(HISTORY_INTERVAL, HISTORY_SIZE, HISTORY_MAX_BYTES)
+        self.resolver = CachedResolver(DNS_CACHE_TTL, DNS_NEGATIVE_CACHE_TTL, DNS_CONCURRENCY)
+        self.api = api_hosts()
+        self.changed_aggregates = {}
+        self.aggregate_fetched_at = {}
+        if AGGREGATE_WS_URL:
+            addresses = f"{NODE_AGGREGATE_ADDRESS},{SETTINGS_AGGREGATE_ADDRESS}"
+            query = urlencode({"msgType": "AGGREGATE", "addresses": addresses})
+            self.subscriber = AggregateSubscriber(
+                f"{AGGREGATE_WS_URL}?{query}",
+                {NODE_AGGREGATE_ADDRESS: {"corechannel"}, SETTINGS_AGGREGATE_ADDRESS: {"settings"}},
+                self.aggregate_changed,
             )
-            logger.debug("done %s pending %s", done, pending)
-            if pending:
-                logger.info(
-                    "Returning data from cache, continue fetch in background task %s",
-                    pending,
-                )
-        elif self.node_list.is_older_than(seconds=31):
-            if not self.refresh_task_is_running():
-                logger.info("Launching background refresh task")
-                self.refresh_task = asyncio.create_task(
-                    self.fetch_node_list_and_node_data()
-                )
-        else:
-            logger.info("Getting data from cache")
-        return self.node_list.data, self.crn_infos
+        self.carried_over = set()
+
+    def start(self) -> None:
+        """Start the supervised refresh loop in the background, if not already running.
+
+        Called by start_background_tasks()."""
+        if self.loop_task and not self.loop_task.done():
+            return
+        self.loop_task = asyncio.create_task(self.supervise_refresh_loop(), name="refresh-loop")
+        if self.subscriber:
+            self.subscriber.start()
+
+    async def stop(self) -> None:
+        """Stop the refresh loop, cancelling the fetches in flight"""
+        for task in (self.loop_task, self.refresh_task):
+            if task and not task.done():
+                task.cancel()
+        for task in (self.loop_task, self.refresh_task):
+            if task:
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await task
+        self.loop_task = None
+        self.refresh_task = None
+        if self.subscriber:
+            await self.subscriber.stop()
+
+    async def supervise_refresh_loop(self) -> None:
+        """Keep the refresh loop running, restart it if it crashes"""
+        while True:
+            try:
+                await self.refresh_loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Refresh loop crashed, restarting in %ss", REFRESH_RESTART_DELAY)
+                await asyncio.sleep(REFRESH_RESTART_DELAY)
+
+    async def refresh_loop(self) -> None:
+        """Refresh the node list and node data every REFRESH_INTERVAL seconds"""
+        while True:
+            started_at = time.monotonic()
+            # A failed cycle keeps the previous data, try again on the next one
+            await asyncio.wait([self.start_refresh()])
+            elapsed = time.monotonic() - started_at
+            await asyncio.sleep(max(0.0, REFRESH_INTERVAL - elapsed))
 
     def refresh_task_is_running(self):
         return self.refresh_task and not self.refresh_task.done()
 
+    def start_refresh(self) -> asyncio.Task:
+        """Start a refresh, or return the one already running so refreshes never overlap"""
+        if not self.refresh_task or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.fetch_node_list_and_node_data(), name="refresh")
+            self.refresh_task.add_done_callback(_log_refresh_failure)
+        return self.refresh_task
+
+    def force_refresh(self) -> asyncio.Task:
+        """Start a refresh outside of the refresh loop, or join the one already running"""
+        if not self.refresh_task_is_running():
+            self.forced_refresh_at = time.monotonic()
+        return self.start_refresh()
+
+    def force_refresh_retry_after(self) -> float:
+        """Seconds to wait before a forced refresh is allowed, 0 if it is allowed now.
+
+        Only the forced refreshes count: the refresh loop starts one every REFRESH_INTERVAL, which is shorter."""
+        if self.forced_refresh_at is None:
+            return 0
+        return max(0.0, self.forced_refresh_at + FORCE_REFRESH_MIN_INTERVAL - time.monotonic())
+
+    @profiler.profiled(ProfileTarget.refresh)
     async def fetch_node_list_and_node_data(self):
         """Retrieve the node list and data from each node"""
         logger.info("%s , fetch_node_list_and_node_data start", asyncio.current_task())
-        node_list = await _fetch_node_list()
-        if node_list:
-            self.node_list.set_data(node_list)
+        deadline = time.monotonic() + REFRESH_DEADLINE
+        if self.aggregate_is_due("settings", GPU_AGGREGATE_TTL):
+            node_list, _ = await asyncio.gather(self.fetch_node_list(), self.fetch_gpu_aggregate())
+        else:
+            node_list = await self.fetch_node_list()
         assert node_list
+        previous_crns = self.node_list.data["data"]["corechannel"]["resource_nodes"] if self.node_list.data else []
         crns = node_list["data"]["corechannel"]["resource_nodes"]
-        # sort by score
-        crns.sort(key=lambda crn: crn["score"], reverse=True)
 
         # crns = crns[:10]
         # self.node_list.data["data"]["corechannel"]["resource_nodes"] = crns = [
         #     crn for crn in crns if "nerg" in crn["address"]
         # ]
-        futures = []
+        try:
+            diff = diff_nodes(previous_crns, crns)
+            self.apply_node_list_diff(diff, crns)
+            scheduled = self.refresh_schedule(crns, diff)
+            await self.fetch_crns(scheduled, deadline)
+            self.schedule_next_refresh(crns, scheduled)
+            self.record_usage_history(crns)
+            refreshed_at = datetime.datetime.now(datetime.UTC)
+            # The refresh task waits for the build, so the CRN data is not modified while it runs
+            views = await asyncio.get_running_loop().run_in_executor(
+                response_builder, self.build_sorted_views, self.generation + 1, node_list, refreshed_at
+            )
+        except BaseException:
+            if node_list is not self.node_list.data:
+                # Not stored, so it must be fetched again by the next cycle
+                self.aggregate_fetched_at.pop("corechannel", None)
+            raise
+        # Only once the cycle completed: a failed cycle keeps the previous node list, the next one diffs against it
+        self.node_list.set_data(node_list)
+        self.generation = views.generation
+        self.publish_sorted_views(views)
+        startup.mark("first_snapshot_at")
+        logger.info("%s , fetch_node_list_and_node_data end", asyncio.current_task())
+
+    def aggregate_is_due(self, key: str, poll_interval: float) -> bool:
+        """Whether the aggregate must be fetched in this refresh cycle.
+
+        It is polled every `poll_interval` seconds, unless subscribed to the message stream: it is then only fetched
+        when a message updates it, and every AGGREGATE_RECONCILE_INTERVAL in case a message was missed."""
+        fetched_at = self.aggregate_fetched_at.get(key)
+        if fetched_at is None:
+            return True
+        age = time.monotonic() - fetched_at
+        if self.subscriber is None or not self.subscriber.connected:
+            return age >= poll_interval
+        return key in self.changed_aggregates or age >= max(poll_interval, AGGREGATE_RECONCILE_INTERVAL)
+
+    def aggregate_changed(self, key: str, updated: float | None) -> None:
+        """Called by the subscriber when a message updates the aggregate, at `updated` if known"""
+        previous = self.changed_aggregates.get(key)
+        self.changed_aggregates[key] = updated if previous is None else max(previous, updated or previous)
+
+    def aggregate_fetched(self, key: str, response: dict) -> None:
+        """Record a successful fetch of the aggregate.
+
+        A hedged request may be answered by an API server that did not process the update message yet: the key
+        stays changed until the fetched aggregate is at least as recent as the message."""
+        self.aggregate_fetched_at[key] = time.monotonic()
+        updated = self.changed_aggregates.get(key)
+        fetched = aggregate_time(response, key)
+        if updated is None or fetched is None or fetched >= updated:
+            self.changed_aggregates.pop(key, None)
+
+    async def fetch_node_list(self) -> NodeAggregate | None:
+        """Node list, fetched from the API if due, otherwise the cached one"""
+        if self.node_list.data and not self.aggregate_is_due("corechannel", 0):
+            return self.node_list.data
+        node_list = await _fetch_node_list(self.api)
+        if node_list is None:
+            return None
+        self.aggregate_fetched("corechannel", node_list)  # type: ignore
+        return node_list
+
+    def refresh_schedule(self, crns: list[ResourceNodeInfo], diff: NodeListDiff) -> list[str]:
+        """CRNs due to be fetched in this refresh cycle, most important first.
+
+        The order is: CRNs carried over from the last cycle, CRNs that changed in the node list,
+        then the active CRNs before the inactive ones, the reachable ones before the failing ones,
+        and by descending score. A change of the score only does not make a CRN due, as the scoring
+        updates most of them. As the semaphores are FIFO, the first CRNs are fetched first
+        when the concurrency is limited, and before the deadline of the cycle."""
+        cycle = self.generation + 1
+        changed = diff.added | diff.address_changed | diff.metadata_changed
+        due = [
+            node
+            for node in crns
+            if node["hash"] in changed
+            or node["hash"] in self.carried_over
+            or self.crn_infos[node["hash"]].next_refresh_cycle <= cycle
+        ]
+        due.sort(
+            key=lambda node: (
+                node["hash"] not in self.carried_over,
+                node["hash"] not in changed,
+                node["inactive_since"] is not None,
+                self.crn_infos[node["hash"]].failures > 0,
+                -(node["score"] or 0),
+            )
+        )
+        return [node["hash"] for node in due]
+
+    def schedule_next_refresh(self, crns: list[ResourceNodeInfo], fetched: list[str]) -> None:
+        """Set the cycle at which the CRNs fetched in this cycle are due again"""
+        cycle = self.generation + 1
+        nodes_by_hash = {node["hash"]: node for node in crns}
+        for crn_hash in fetched:
+            if crn_hash not in self.carried_over:
+                crn = self.crn_infos[crn_hash]
+                crn.next_refresh_cycle = cycle + crn.refresh_every(nodes_by_hash[crn_hash])
+
+    def apply_node_list_diff(self, diff: NodeListDiff, crns: list[ResourceNodeInfo]) -> None:
+        """Update the CRN data of the nodes that changed only: the others keep their URL and its validation.
+
+        The data of the CRNs whose address changed is reset, as it may now be a different machine."""
+        logger.info("Node list changes: %s", diff.counts())
+        self.node_list_diff = diff
+        for crn_hash in diff.removed:
+            self.crn_infos.pop(crn_hash, None)
         for node in crns:
             crn_hash = node["hash"]
-            crn_config = self.crn_infos[crn_hash]
-            crn_config.node_url = node["address"]
-            futures.append(crn_config.fetch_system())
-            futures.append(crn_config.fetch_config())
-            futures.append(crn_config.fetch_ipv6())
+            if crn_hash in diff.added or crn_hash in diff.address_changed or crn_hash not in self.crn_infos:
+                self.crn_infos[crn_hash] = CRNData(node["address"])
+            if crn_hash in diff.address_changed:
+                self.usage_history.forget(crn_hash)
+        # Against the whole node list: the CRNs not due in this cycle keep their cached addresses
+        self.resolver.retain(
+            address.host for crn in self.crn_infos.values() if (address := host_port(crn.node_url))
+        )
 
-        await asyncio.gather(*futures)
-        logger.info("%s , fetch_node_list_and_node_data end", asyncio.current_task())
+    async def fetch_crns(self, crn_hashes: list[str], deadline: float | None = None) -> None:
+        """Fetch the data of the CRNs, sharing the DNS lookups and connections between the CRNs on the same host.
+
+        All the hostnames are resolved first, concurrently, and the CRNs whose hostname cannot be resolved
+        are skipped before taking a slot of the semaphore.
+
+        Args:
+            crn_hashes: CRNs to fetch, the first ones first.
+            deadline: time.monotonic() at which the fetches still running are cancelled. The CRNs being fetched
+                count as timed out, the ones still waiting for a slot keep their previous data and are fetched first
+                in the next refresh, see refresh_schedule().
+        """
+        addresses = {
+            crn_hash: host_port(self.crn_infos[crn_hash].node_url)
+            for crn_hash in crn_hashes
+            if self.crn_infos[crn_hash].is_valid
+        }
+        unresolvable = await self.resolver.resolve_all(address.host for address in addresses.values() if address)
+        host_slots: defaultdict[tuple[str, int], asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(CRN_CONNECTIONS_PER_HOST)
+        )
+
+        tasks: dict[asyncio.Task, str] = {}
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONCURRENT_FILES,
+            limit_per_host=CRN_CONNECTIONS_PER_HOST,
+            resolver=self.resolver,
+            use_dns_cache=False,  # Cached by the resolver
+        )
+        try:
+            async with crn_session(connector=connector) as session:
+                try:
+                    # The semaphores are FIFO, so the CRNs started first are fetched first
+                    for crn_hash in crn_hashes:
+                        crn = self.crn_infos[crn_hash]
+                        address = addresses.get(crn_hash)
+                        if address and address.host in unresolvable:
+                            crn.set_error(unresolvable[address.host])
+                            crn.failures += 1
+                            continue
+                        host_slot = host_slots[self.resolver.address(address.host), address.port] if address else None
+                        tasks[asyncio.create_task(crn.fetch_all(session, host_slot))] = crn_hash
+                    if tasks:
+                        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                        done, pending = await asyncio.wait(tasks, timeout=timeout)
+                        # Only the CRNs still waiting for a slot, the ones being fetched are counted as timed out
+                        self.carried_over = {
+                            tasks[task] for task in pending if not self.crn_infos[tasks[task]].fetching
+                        }
+                        if pending:
+                            logger.warning(
+                                "Refresh deadline reached, %d CRNs timed out and %d carried over",
+                                len(pending) - len(self.carried_over),
+                                len(self.carried_over),
+                            )
+                        for task in done:
+                            task.result()
+                finally:
+                    # Also when the refresh itself is cancelled
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # The cached addresses are kept, only the underlying resolver is bound to the event loop
+            await self.resolver.close()
+
+    def record_usage_history(self, crns: list[ResourceNodeInfo]) -> None:
+        """Add the system usage fetched during the refresh to the history of each CRN"""
+        self.usage_history.set_crns(crn["hash"] for crn in crns)
+        for crn in crns:
+            system = self.crn_infos[crn["hash"]].system
+            if system.data and system.fetched_at:
+                self.usage_history.record(crn["hash"], system.data, system.fetched_at)
+
+    def update_sorted_views(self) -> None:
+        """Build the snapshot of the current generation and publish it, on the calling thread"""
+        self.publish_sorted_views(
+            self.build_sorted_views(self.generation, self.node_list.data, self.node_list.fetched_at)
+        )
+
+    def build_sorted_views(
+        self, generation: int, node_list: NodeAggregate | None, refreshed_at: datetime.datetime | None
+    ) -> SortedViews:
+        """Snapshot of the data: sort the CRNs for each sort key and order, format them and encode the most
+        requested responses, once when the data changes instead of on each request.
 
-    async def format_response(self, filter_inactive: bool):
-        resp: dict[str, list[Any] | datetime.datetime | None]
-        crns_resp: list[dict] = []
-        resp = {"last_refresh": self.node_list.fetched_at, "crns": crns_resp}
+        Ties are broken by hash, so the order stays stable across refreshes. CRNs without a value come last.
+        Runs in the response builder thread during a refresh: it must only read the data, the snapshot is
+        published by publish_sorted_views() on the event loop.
 
-        if not self.node_list.data:
-            return resp
-        for crn in self.node_list.data["data"]["corechannel"]["resource_nodes"]:
+        Args:
+            generation: generation of the snapshot.
+            node_list: node list the CRN data was fetched for.
+            refreshed_at: time at which the CRN data was fetched, the `last_refresh` of the responses.
+        """
+        if not node_list:
+            return SortedViews(generation, {}, {})
+        nodes = node_list["data"]["corechannel"]["resource_nodes"]
+        nodes_by_hash = {node["hash"]: node for node in nodes}
+        hashes = sorted(nodes_by_hash)
+        crn_infos = {crn_hash: self.crn_infos[crn_hash] for crn_hash in hashes}
+        orders = {}
+        for sort_key in SortKey:
+            values = {
+                crn_hash: _sort_value(sort_key, nodes_by_hash[crn_hash], crn_infos[crn_hash]) for crn_hash in hashes
+            }
+            known = [crn_hash for crn_hash in hashes if values[crn_hash] is not None]
+            unknown = [crn_hash for crn_hash in hashes if values[crn_hash] is None]
+            # sorted() is stable, also with reverse=True, so ties stay in hash order
+            for order, ordered in (
+                (SortOrder.asc, sorted(known, key=values.__getitem__) + unknown),
+                (SortOrder.desc, sorted(known, key=values.__getitem__, reverse=True) + unknown),
+            ):
+                orders[sort_key, order, False] = ordered
+                orders[sort_key, order, True] = [
+                    crn_hash for crn_hash in ordered if nodes_by_hash[crn_hash]["inactive_since"] is None
+                ]
+        entries: dict[ResponseProfile, dict[str, dict]] = {profile: {} for profile in ResponseProfile}
+        health = {crn_hash: crn_infos[crn_hash].health.copy() for crn_hash in hashes}
+        now = time.time()
+        for crn_hash in hashes:
             try:
-                if filter_inactive and crn["inactive_since"] is not None:
-                    continue
-                crn_hash = crn["hash"]
-                crn_info = self.crn_infos[crn_hash]
-                crn_resp = {
-                    **crn,
-                    "config_from_crn": crn_info.config is not None,
-                    "debug_config_from_crn_at": crn_info.config.fetched_at,
-                    "debug_config_from_crn_error": str(crn_info.config.error),
-                    "debug_usage_from_crn_at": crn_info.config.fetched_at,
-                    "usage_from_crn_error": str(crn_info.config.error),
-                    "version": crn_info.config.data and crn_info.config.data["version"],
-                    "payment_receiver_address": crn_info.config.data
-                    and crn_info.config.data["payment"]["PAYMENT_RECEIVER_ADDRESS"],
-                    "gpu_support": crn_info.gpu_support,
-                    "confidential_support": crn_info.confidential_support,
-                    "qemu_support": crn_info.qemu_support,
-                    "system_usage": crn_info.system.data,
-                    "compatible_gpus": await crn_info.compatible_gpus,
-                    "compatible_available_gpus": await crn_info.compatible_available_gpus,
-                    "ipv6_check": crn_info.check_ipv6.data,
-                }
-                crns_resp.append(crn_resp)
+                summary = health[crn_hash].summary(now)
+                for profile in ResponseProfile:
+                    entry = self.format_crn(nodes_by_hash[crn_hash], crn_infos[crn_hash], profile)
+                    entry["health"] = summary
+                    entries[profile][crn_hash] = entry
             except Exception as e:
-                logger.error("Error formatting crn %s: %s", crn.get("hash"), e)
-
-        return resp
+                logger.error("Error formatting crn %s: %s", crn_hash, e)
+                for profile in ResponseProfile:
+                    entries[profile].pop(crn_hash, None)
+        columns = build_columns(
+            (nodes_by_hash[crn_hash] for crn_hash in orders[SortKey.score, SortOrder.desc, False]), crn_infos
+        )
+        gpus_by_model = count_gpus_by_model(
+            (
+                (crn_infos[crn_hash].compatible_gpus, crn_infos[crn_hash].compatible_available_gpus)
+                for crn_hash in orders[SortKey.score, SortOrder.desc, True]
+            ),
+            gpu_models(self.gpu_aggregate.data),
+        )
+        stats = compute_stats(columns, gpus_by_model)
+        match_index = MatchIndex(
+            columns,
+            (crn_infos[crn_hash].compatible_available_gpus for crn_hash in columns["hash"]),
+            gpu_models(self.gpu_aggregate.data),
+        )
+        views = SortedViews(
+            generation,
+            nodes_by_hash,
+            orders,
+            refreshed_at,
+            entries,
+            columns=columns,
+            stats=stats,
+            health=health,
+            match_index=match_index,
+        )
+        for kwargs in PREBUILT_RESPONSES:
+            views.bodies[response_key(ResponseFormat.json, kwargs)] = dumps(
+                format_views(views, **_view_params(kwargs)), ResponseFormat.json
+            )
+        return views
+
+    def publish_sorted_views(self, views: SortedViews) -> None:
+        """Make the snapshot the current one, the request handlers switch to it at once"""
+        self.sorted_views = views
+        self.derived = {}
+        self.encoded_responses = OrderedDict()
+        self.recent_views[views.generation] = views
+        while len(self.recent_views) > CURSOR_GENERATIONS:
+            self.recent_views.popitem(last=False)
+
+    async def get_encoded_response(self, response_format: ResponseFormat, **kwargs) -> bytes:
+        """Encoded response of format_response().
+
+        The most requested variants are prebuilt with the snapshot. The other ones are encoded in the response
+        builder thread, full lists once per generation: the most recently used variants are kept."""
+        views = self.sorted_views
+        key = response_key(response_format, kwargs)
+        body = views.bodies.get(key)
+        if body is not None:
+            return body
+        paginated = kwargs.get("limit") is not None or bool(kwargs.get("cursor"))
+        if not paginated:
+            body = self.encoded_responses.get(key)
+            if body is not None:
+                self.encoded_responses.move_to_end(key)
+                return body
+
+        params = _view_params(kwargs)
+        page_views, params["start"] = self.cursor_position(
+            params["filter_inactive"], params["sort"], params["order"], kwargs.get("cursor")
+        )
+        body = await asyncio.get_running_loop().run_in_executor(
+            response_builder,
+            lambda: dumps(format_views(page_views, **params, paginated=paginated), response_format),
+        )
+        # Not kept if a new snapshot was published meanwhile
+        if not paginated and self.sorted_views is views:
+            self.encoded_responses[key] = body
+            while len(self.encoded_responses) > ENCODED_RESPONSES_CACHE_SIZE:
+                self.encoded_responses.popitem(last=False)
+        return body
+
+    async def health_reports(self) -> dict[str, dict]:
+        """Latency and availability report of each CRN of the current generation, built in the response builder
+        thread from the copy in the snapshot on first use and kept until the next generation"""
+        if "health" in self.derived:
+            return self.derived["health"]
+        views = self.sorted_views
+        now = time.time()
+        reports = await asyncio.get_running_loop().run_in_executor(
+            response_builder,
+            lambda: {
+                crn_hash: health.report(now)
+                for crn_hash in views.nodes_by_hash
+                if (health := views.health.get(crn_hash)) is not None
+            },
+        )
+        if self.sorted_views is views:
+            self.derived["health"] = reports
+        return reports
+
+    async def export(self, key: str, serialize: Callable[[dict], bytes]) -> bytes:
+        """Columns of the current snapshot serialized by `serialize`, in the response builder thread on first use
+        and kept until the next generation"""
+        if key in self.derived:
+            return self.derived[key]
+        views = self.sorted_views
+        body = await asyncio.get_running_loop().run_in_executor(response_builder, serialize, views.columns)
+        if self.sorted_views is views:
+            self.derived[key] = body
+        return body
+
+    async def format_response(
+        self,
+        filter_inactive: bool,
+        sort: SortKey = SortKey.score,
+        order: SortOrder = SortOrder.desc,
+        limit: int | None = None,
+        cursor: str | None = None,
+        profile: ResponseProfile = ResponseProfile.full,
+    ):
+        """Format the CRN list, or a page of it if `limit` or `cursor` is set.
+
+        Pages are served from the snapshot of the generation in the cursor, so they stay consistent
+        even if a refresh completed since the first page.
+        """
+        views, start = self.cursor_position(filter_inactive, sort, order, cursor)
+        paginated = limit is not None or bool(cursor)
+        return format_views(views, filter_inactive, sort, order, start, limit, profile, paginated)
+
+    def cursor_position(
+        self, filter_inactive: bool, sort: SortKey, order: SortOrder, cursor: str | None
+    ) -> tuple[SortedViews, int]:
+        """Snapshot and offset at which a page starts, the current snapshot if there is no cursor"""
+        if not cursor:
+            return self.sorted_views, 0
+        position = Cursor.decode(cursor)
+        if (position.sort, position.order, position.filter_inactive) != (sort, order, filter_inactive):
+            raise InvalidCursor("Cursor does not match the sort, order and filter_inactive parameters")
+        if position.generation not in self.recent_views:
+            raise ExpiredCursor("Cursor expired, restart from the first page")
+        views = self.recent_views[position.generation]
+        # A next_cursor always points to a CRN of the view
+        if position.offset >= len(views.orders.get((sort, order, filter_inactive), [])):
+            raise InvalidCursor("Invalid cursor")
+        return views, position.offset
+
+    @staticmethod
+    def format_crn(crn: ResourceNodeInfo, crn_info: CRNData, profile: ResponseProfile) -> dict:
+        crn_resp = {
+            **crn,
+            "config_from_crn": crn_info.config is not None,
+            "version": crn_info.config.data and crn_info.config.data["version"],
+            "payment_receiver_address": crn_info.config.data
+            and crn_info.config.data["payment"]["PAYMENT_RECEIVER_ADDRESS"],
+            "gpu_support": crn_info.gpu_support,
+            "confidential_support": crn_info.confidential_support,
+            "qemu_support": crn_info.qemu_support,
+            "compatible_gpus": crn_info.compatible_gpus,
+            "compatible_available_gpus": crn_info.compatible_available_gpus,
+            "ipv6_check": crn_info.check_ipv6.data,
+        }
+        if profile == ResponseProfile.compact:
+            crn_resp["usage"] = summarize_usage(crn_info.system.data)
+            if crn_info.system.error is not None:
+                crn_resp["usage_from_crn_error"] = str(crn_info.system.error)
+            return crn_resp
+
+        crn_resp.update(
+            {
+                "debug_config_from_crn_at": crn_info.config.fetched_at,
+                "debug_config_from_crn_error": str(crn_info.config.error),
+                "debug_usage_from_crn_at": crn_info.system.fetched_at,
+                "usage_from_crn_error": str(crn_info.system.error),
+                "system_usage": crn_info.system.data,
+            }
+        )
+        if profile == ResponseProfile.debug:
+            crn_resp.update(
+                {
+                    "debug_config_from_crn_error_at": crn_info.config.error_at,
+                    "debug_usage_from_crn_error_at": crn_info.system.error_at,
+                    "debug_ipv6_check_at": crn_info.check_ipv6.fetched_at,
+                    "debug_ipv6_check_error": str(crn_info.check_ipv6.error),
+                    "debug_ipv6_check_error_at": crn_info.check_ipv6.error_at,
+                }
+            )
+        return crn_resp
 
     async def fetch_gpu_aggregate(self):
         try:
-            async with aiohttp.ClientSession() as session:
-                resp = await session.get(SETTING_AGGREGATE_URL)
-                resp.raise_for_status()
-
-                data = await resp.json()
-                self.gpu_aggregate.set_data(data)
+            data = await self.api.get_json(SETTINGS_AGGREGATE_PATH, "settings")
+            self.gpu_aggregate.set_data(data)  # type: ignore
+            self.aggregate_fetched("settings", data)
         except Exception as e:
             logger.warning("error fetching gpu aggregate: %s", e)
             self.gpu_aggregate.set_error(e)
 
-    async def get_gpu_aggregate(self) -> SettingsAggregate | None:
-        if self.gpu_aggregate.is_older_than(minutes=5):
-            await self.fetch_gpu_aggregate()
+    def get_gpu_aggregate(self) -> SettingsAggregate | None:
+        """Settings aggregate from cache, refreshed by the refresh loop"""
         return self.gpu_aggregate.data
 
 
+class Template(NamedTuple):
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+@functools.cache
+def load_template(name: str) -> Template:
+    """HTML page from the templates directory, read and compressed once"""
+    body = (Path(__file__).parent / "templates" / name).read_bytes()
+    return Template(body, gzip.compress(body, mtime=0), f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+
+
+def template_response(name: str, accept_encoding: str | None, if_none_match: str | None) -> fastapi.Response:
+    template = load_template(name)
+    headers = {"ETag": template.etag, "Vary": "Accept-Encoding"}
+    if if_none_match == template.etag:
+        return fastapi.Response(status_code=304, headers=headers)
+    if accept_encoding and "gzip" in accept_encoding:
+        return HTMLResponse(template.gzipped, headers={**headers, "Content-Encoding": "gzip"})
+    return HTMLResponse(template.body, headers=headers)
+
+
 @app.get("/", response_class=HTMLResponse)
-def index() -> str:
-    return (Path(__file__).parent / "templates/index.html").read_text()
+def index(
+    accept_encoding: str | None = fastapi.Header(default=None), if_none_match: str | None = fastapi.Header(default=None)
+):
+    return template_response("index.html", accept_encoding, if_none_match)
+
+
+@app.get("/ready")
+async def ready(response: fastapi.Response):
+    """Readiness probe: 503 until the first refresh cycle completed, as the data endpoints would be empty"""
+    start_background_tasks()
+    is_ready = data_cache.generation > 0
+    if not is_ready:
+        response.status_code = 503
+        response.headers["Retry-After"] = str(REFRESH_INTERVAL)
+    return {"ready": is_ready, "generation": data_cache.generation, "startup": startup.to_dict()}
+
+
+async def data_cache_headers(response: fastapi.Response) -> None:
+    """Add HTTP caching headers to the endpoints serving the cached data, so they can be fronted by a CDN.
+
+    The age is the one of the published snapshot the body is served from.
+    Raise a 503 error until the first refresh cycle completed, like /ready, instead of serving an empty fleet,
+    and instead of serving data older than MAX_DATA_AGE."""
+    start_background_tasks()
+    views = data_cache.sorted_views
+    refreshed_at = views.last_refresh
+    if views.generation == 0 or refreshed_at is None:
+        raise fastapi.HTTPException(
+            status_code=503,
+            detail="No data yet, the first refresh is in progress",
+            headers={"Cache-Control": "no-store", "Retry-After": str(REFRESH_INTERVAL)},
+        )
+    age = max(0, int((datetime.datetime.now(datetime.UTC) - refreshed_at).total_seconds()))
+    if age > MAX_DATA_AGE:
+        raise fastapi.HTTPException(
+            status_code=503,
+            detail=f"Data is stale, last refresh {age}s ago",
+            headers={"Cache-Control": "no-store", "Retry-After": str(REFRESH_INTERVAL)},
+        )
+    response.headers["Cache-Control"] = (
+        f"public, max-age={REFRESH_INTERVAL}, "
+        f"stale-while-revalidate={CACHE_STALE_WHILE_REVALIDATE}, stale-if-error={MAX_DATA_AGE}"
+    )
+    response.headers["Age"] = str(age)
+    response.headers["Last-Modified"] = email.utils.format_datetime(refreshed_at, usegmt=True)
+    response.headers["X-Data-Generation"] = str(views.generation)
+
+
+@app.get("/crns.json", response_class=FastJSONResponse, dependencies=[fastapi.Depends(data_cache_headers)])
+@profiler.profiled(ProfileTarget.requests)
+async def root(
+    response: fastapi.Response,
+    filter_inactive: bool = False,
+    sort: SortKey = SortKey.score,
+    order: SortOrder = SortOrder.desc,
+    limit: int | None = fastapi.Query(default=None, ge=1),
+    cursor: str | None = None,
+    profile: ResponseProfile = ResponseProfile.full,
+    format: ResponseFormat | None = None,
+    accept: str | None = fastapi.Header(default=None),
+):
+    """List the CRNs with their data.
+
+    Set `limit` to paginate, then pass the `next_cursor` of the response as `cursor` to get the next page.
+    Use `profile=compact` to get a smaller response without the debug fields and the raw system usage.
+    The response is also available as MessagePack or CBOR, with the `Accept` header or the `format` parameter.
+    """
+    response_format = format or negotiate_format(accept)
+    try:
+        body = await data_cache.get_encoded_response(
+            response_format,
+            filter_inactive=filter_inactive,
+            sort=sort,
+            order=order,
+            limit=limit,
+            cursor=cursor,
+            profile=profile,
+        )
+    except ExpiredCursor as e:
+        raise fastapi.HTTPException(status_code=410, detail=str(e))
+    except InvalidCursor as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    except ImportError as e:
+        raise fastapi.HTTPException(status_code=501, detail=f"Format not available: {e}")
+
+    if data_cache.generation:
+        startup.mark("first_response_at")
+    # Returned directly to skip jsonable_encoder, so the headers set by the dependencies must be copied
+    response.headers["Vary"] = "Accept"
+    return fastapi.Response(body, media_type=MEDIA_TYPES[response_format], headers=response.headers)
+
+
+async def export_response(
+    response: fastapi.Response, key: str, serialize: Callable[[dict], bytes], media_type: str
+) -> fastapi.Response:
+    """Response with the columnar view of the fleet, serialized once per generation"""
+    try:
+        body = await data_cache.export(key, serialize)
+    except ImportError as e:
+        raise fastapi.HTTPException(status_code=501, detail=f"Export not available: {e}")
+    return fastapi.Response(body, media_type=media_type, headers=response.headers)
+
+
+@app.get("/crns.arrow", response_class=fastapi.Response, dependencies=[fastapi.Depends(data_cache_headers)])
+async def crns_arrow(response: fastapi.Response):
+    """One row per CRN with flattened scalar columns, as an Apache Arrow IPC stream"""
+    return await export_response(response, "arrow", to_arrow_ipc, ARROW_MEDIA_TYPE)
 
 
-@app.get("/crns.json")
-async def root(filter_inactive: bool = False):
-    await data_cache.ensure_fresh_data()
-    response = await data_cache.format_response(filter_inactive=filter_inactive)
+@app.get("/crns.parquet", response_class=fastapi.Response, dependencies=[fastapi.Depends(data_cache_headers)])
+async def crns_parquet(response: fastapi.Response):
+    """One row per CRN with flattened scalar columns, as a Parquet file"""
+    return await export_response(response, "parquet", to_parquet, PARQUET_MEDIA_TYPE)
 
-    return response
+
+@app.get("/stats.json", response_class=FastJSONResponse, dependencies=[fastapi.Depends(data_cache_headers)])
+async def stats(response: fastapi.Response):
+    """Network totals over the active CRNs: capacity, GPUs by model, supported features and versions.
+
+    Also percentiles of the load and of the free capacity. Computed once per data generation."""
+    return FastJSONResponse(data_cache.sorted_views.stats, headers=response.headers)
+
+
+@app.get("/crns/match", response_class=FastJSONResponse, dependencies=[fastapi.Depends(data_cache_headers)])
+async def crns_match(
+    response: fastapi.Response,
+    vcpus: float = fastapi.Query(default=0, ge=0),
+    memory_mb: float = fastapi.Query(default=0, ge=0),
+    disk_mb: float = fastapi.Query(default=0, ge=0),
+    gpu_model: str | None = None,
+    confidential: bool = False,
+    ipv6: bool = False,
+    rank: Rank = Rank.headroom,
+    limit: int = fastapi.Query(default=10, ge=1, le=100),
+):
+    """Active CRNs with enough free capacity to host a VM, best ranked first.
+
+    Available vCPUs are estimated as the number of CPUs minus the 5 minutes load average.
+    `gpu_model` is a model of the settings aggregate such as `RTX 4090`, one must be available on the CRN.
+    The CRNs are returned in the compact profile, with their `rank_value`.
+    """
+    views = data_cache.sorted_views
+    matches = views.match_index.match(
+        vcpus=vcpus,
+        memory_mb=memory_mb,
+        disk_mb=disk_mb,
+        gpu_model=gpu_model,
+        confidential=confidential,
+        ipv6=ipv6,
+        rank=rank,
+        limit=limit,
+    )
+    entries = views.entries[ResponseProfile.compact]
+    crns = [{**entries[crn_hash], "rank_value": rank_value} for crn_hash, rank_value in matches if crn_hash in entries]
+    return FastJSONResponse({"rank": rank, "crns": crns}, headers=response.headers)
+
+
+class HealthSortKey(str, Enum):
+    availability = "availability"
+    requests = "requests"
+    p50 = "p50"
+    p95 = "p95"
+    p99 = "p99"
+    "Quantiles of the latency `metric`"
+
+
+@app.get("/crns/health", response_class=FastJSONResponse, dependencies=[fastapi.Depends(data_cache_headers)])
+async def crns_health(
+    response: fastapi.Response,
+    window: HealthWindow = HealthWindow.day,
+    sort: HealthSortKey = HealthSortKey.availability,
+    order: SortOrder = SortOrder.asc,
+    metric: LatencyMetric = LatencyMetric.total,
+    limit: int | None = fastapi.Query(default=None, ge=1),
+):
+    """Latency and availability of the requests to each CRN, over the last hour and day.
+
+    Sorted by the availability or the latency quantiles over `window`, by default the least available first.
+    The latencies are the connect time, time to first byte and total time, in milliseconds.
+    CRNs without a value come last, ties are ordered by hash.
+    """
+    reports = await data_cache.health_reports()
+    nodes_by_hash = data_cache.sorted_views.nodes_by_hash
+
+    def sort_value(crn_hash: str) -> float | None:
+        report = reports[crn_hash][window.value]
+        if sort == HealthSortKey.availability:
+            return report["availability"]
+        if sort == HealthSortKey.requests:
+            return report["requests"]
+        return report["latency_ms"][metric.value][sort.value]
+
+    values = {crn_hash: sort_value(crn_hash) for crn_hash in sorted(reports) if crn_hash in nodes_by_hash}
+    known = sorted(
+        (crn_hash for crn_hash, value in values.items() if value is not None),
+        key=values.__getitem__,
+        reverse=order == SortOrder.desc,
+    )
+    ordered = known + [crn_hash for crn_hash, value in values.items() if value is None]
+    crns = [
+        {
+            "hash": crn_hash,
+            "name": nodes_by_hash[crn_hash].get("name"),
+            "address": nodes_by_hash[crn_hash].get("address"),
+            **reports[crn_hash],
+        }
+        for crn_hash in ordered[:limit]
+    ]
+    return FastJSONResponse({"window": window, "sort": sort, "order": order, "crns": crns}, headers=response.headers)
+
+
+@app.get(
+    "/crns/{crn_hash}/history", response_class=FastJSONResponse, dependencies=[fastapi.Depends(data_cache_headers)]
+)
+async def crn_history(
+    response: fastapi.Response, crn_hash: str, step: int = fastapi.Query(default=0, ge=0), since: int = 0
+):
+    """Usage history of a CRN, one list per field, oldest first.
+
+    Set `step` to average the samples over buckets of `step` seconds, and `since` to a timestamp
+    to only get the samples after it."""
+    history = data_cache.usage_history.histories.get(crn_hash)
+    if history is None:
+        raise fastapi.HTTPException(status_code=404, detail="Unknown CRN")
+    return FastJSONResponse(
+        {"hash": crn_hash, "step": step, **history.downsample(step=step, since=since)}, headers=response.headers
+    )
+
+
+@app.get("/debug/history")
+async def debug_history():
+    """Size and memory used by the usage history"""
+    return data_cache.usage_history.stats()
+
+
+@app.get("/debug/api")
+async def debug_api():
+    """Health and latency of the aleph API hosts, in the order they are tried, and the message stream subscription"""
+    return {
+        **data_cache.api.stats(),
+        "subscription": data_cache.subscriber.stats() if data_cache.subscriber else None,
+        "changed_aggregates": dict(sorted(data_cache.changed_aggregates.items())),
+    }
 
 
 @app.get("/debug/nodes_aggregate")
 async def debug_node_aggregate():
     """Raw data"""
-    await data_cache.fetch_node_list_and_node_data()
     return data_cache.node_list
 
 
-@app.get("/debug/node")
+@app.get("/debug/node", status_code=202)
 async def debug_node_list():
-    """Force refersh"""
-    await data_cache.fetch_node_list_and_node_data()
-    return data_cache.node_list
+    """Force refresh
+
+    Join the refresh already running if any, otherwise start one unless the last forced one started less than
+    FORCE_REFRESH_MIN_INTERVAL seconds ago. Poll /debug/task until `generation` reaches `wait_for_generation`.
+    """
+    if not data_cache.refresh_task_is_running():
+        retry_after = data_cache.force_refresh_retry_after()
+        if retry_after > 0:
+            raise fastapi.HTTPException(
+                status_code=429,
+                detail="A refresh was forced recently, try again later",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+    data_cache.force_refresh()
+    return {
+        "status": "running",
+        "generation": data_cache.generation,
+        "wait_for_generation": data_cache.generation + 1,
+    }
 
 
 @app.get("/debug/task")
@@ -505,18 +1876,81 @@ async def debug_task():
         "task_is_cancelled": str(
             data_cache.refresh_task.cancelled() if data_cache.refresh_task else None
         ),
+        "refresh_running": bool(data_cache.refresh_task_is_running()),
+        "generation": data_cache.generation,
+        "last_refresh": data_cache.sorted_views.last_refresh,
+        "node_list_changes": data_cache.node_list_diff.counts() if data_cache.node_list_diff else None,
+        "carried_over": len(data_cache.carried_over),
+        "loop_lag_max_ms": watchdog.lag.max_ms,
+        "startup": startup.to_dict(),
     }
     return data
 
 
+@app.get("/debug/loop")
+async def debug_loop(limit: int = fastapi.Query(default=10, ge=1, le=50)):
+    """Event loop lag histogram and the code that blocked the loop the longest, with a stack snapshot"""
+    return watchdog.stats(limit)
+
+
+def profile_auth(authorization: str | None = fastapi.Header(default=None)) -> None:
+    """Require the DEBUG_PROFILE_TOKEN bearer token, the profiles expose the internals of the service"""
+    if not PROFILE_TOKEN:
+        raise fastapi.HTTPException(status_code=404, detail="Profiling is disabled")
+    if authorization is None or not secrets.compare_digest(authorization, f"Bearer {PROFILE_TOKEN}"):
+        raise fastapi.HTTPException(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+
+
+class ProfileFormat(str, Enum):
+    collapsed = "collapsed"
+    "Collapsed stacks, for flamegraph.pl, speedscope, inferno..."
+    speedscope = "speedscope"
+
+
+@app.post("/debug/profile", status_code=202, dependencies=[fastapi.Depends(profile_auth)])
+async def debug_profile_start(
+    target: ProfileTarget,
+    count: int = fastapi.Query(default=1, ge=1, le=PROFILE_MAX_COUNT),
+    interval_ms: float = fastapi.Query(default=5, ge=1, le=100),
+):
+    """Profile the next `count` refresh cycles or /crns.json requests, sampling the stack every `interval_ms`"""
+    try:
+        profile = profiler.arm(target, count, interval_ms / 1000)
+    except RuntimeError as e:
+        raise fastapi.HTTPException(status_code=409, detail=str(e))
+    return profile.summary()
+
+
+@app.get("/debug/profile", dependencies=[fastapi.Depends(profile_auth)])
+async def debug_profiles():
+    """Armed profile and last finished ones"""
+    return {
+        "armed": profiler.armed.summary() if profiler.armed else None,
+        "profiles": [profile.summary() for profile in profiler.profiles],
+    }
+
+
+@app.get("/debug/profile/{profile_id}", dependencies=[fastapi.Depends(profile_auth)])
+async def debug_profile(profile_id: int, format: ProfileFormat = ProfileFormat.speedscope):
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise fastapi.HTTPException(status_code=404, detail="Profile not found or not finished")
+    filename = f"profile-{profile.id}-{profile.target.value}"
+    if format == ProfileFormat.collapsed:
+        return PlainTextResponse(
+            profile.collapsed(), headers={"Content-Disposition": f'attachment; filename="{filename}.txt"'}
+        )
+    return FastJSONResponse(
+        profile.speedscope(), headers={"Content-Disposition": f'attachment; filename="{filename}.speedscope.json"'}
+    )
+
+
 @app.get("/debug.html", response_class=HTMLResponse)
-def debug_page() -> str:
-    return (Path(__file__).parent / "templates/debug.html").read_text()
+def debug_page(
+    accept_encoding: str | None = fastapi.Header(default=None), if_none_match: str | None = fastapi.Header(default=None)
+):
+    return template_response("debug.html", accept_encoding, if_none_match)
 
 
 data_cache = DataCache()
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s %(name)s:%(lineno)s | %(message)s ",
-)
+startup.mark("imported_at")
@@ -0,0 +1,142 @@
+"""Find the CRNs able to host a given VM, from a columnar index of the fleet built once per generation."""
+
+from array import array
+from enum import Enum
+from typing import Iterable
+
+from nodes_list.response_types import GPUDevice
+
+
+class Rank(str, Enum):
+    headroom = "headroom"
+    "Largest share of free capacity on the most used resource (CPU, memory or disk)"
+    load = "load"
+    "Lowest 5 minutes load average per CPU"
+    score = "score"
+    "Highest score"
+
+
+CAPACITY_COLUMNS = ("cpu_count", "load5", "mem_total_kB", "mem_available_kB", "disk_total_kB", "disk_available_kB")
+
+BEST_FIRST = {Rank.headroom: True, Rank.load: False, Rank.score: True}
+"Whether the rank values are sorted in descending order"
+
+
+class MatchIndex:
+    """Capacity of the active and reachable CRNs, one typed array per column.
+
+    The rows are also pre-sorted for each rank, so a query can stop after the first matching rows."""
+
+    hashes: list[str]
+    available_vcpus: array
+    mem_available_kB: array
+    disk_available_kB: array
+    confidential: array
+    ipv6: array
+    rows_by_gpu_model: dict[str, list[int]]
+    "Rows with an available compatible GPU of each model, model names in lowercase"
+    rank_values: dict[Rank, array]
+    orders: dict[tuple[Rank, bool, bool], array]
+    "Rows by rank, best first, for all the CRNs or only those with confidential computing and/or IPv6 support"
+    max_available: tuple[float, float, float]
+    "Largest available vCPUs, memory and disk, to skip the queries no CRN can satisfy"
+
+    def __init__(self, columns: dict[str, list], available_gpus: Iterable[list[GPUDevice]], gpu_models: dict[str, str]):
+        """
+        Args:
+            columns: columnar view of the fleet, see columns.build_columns().
+            available_gpus: compatible available GPUs of each row of the columns.
+            gpu_models: model of each compatible GPU device id.
+        """
+        self.hashes = []
+        self.available_vcpus = array("d")
+        self.mem_available_kB = array("d")
+        self.disk_available_kB = array("d")
+        self.confidential = array("b")
+        self.ipv6 = array("b")
+        self.rows_by_gpu_model = {}
+        self.rank_values = {rank: array("d") for rank in Rank}
+
+        for i, gpus in enumerate(available_gpus):
+            cpu_count, load5, mem_total, mem_available, disk_total, disk_available = values = [
+                columns[name][i] for name in CAPACITY_COLUMNS
+            ]
+            is_active = columns["inactive_since"][i] is None
+            if not is_active or None in values or not (cpu_count and mem_total and disk_total):
+                # Inactive, or its usage could not be fetched
+                continue
+            row = len(self.hashes)
+            self.hashes.append(columns["hash"][i])
+            available_vcpus = max(0.0, cpu_count - load5)
+            self.available_vcpus.append(available_vcpus)
+            self.mem_available_kB.append(mem_available)
+            self.disk_available_kB.append(disk_available)
+            self.confidential.append(bool(columns["confidential_support"][i]))
+            self.ipv6.append(bool(columns["ipv6_vm"][i]))
+            for model in {gpu_models.get(gpu["device_id"], gpu["device_id"]).lower() for gpu in gpus}:
+                self.rows_by_gpu_model.setdefault(model, []).append(row)
+            self.rank_values[Rank.headroom].append(
+                min(available_vcpus / cpu_count, mem_available / mem_total, disk_available / disk_total)
+            )
+            self.rank_values[Rank.load].append(load5 / cpu_count)
+            self.rank_values[Rank.score].append(columns["score"][i] or 0)
+
+        self.orders = {}
+        for rank, values in self.rank_values.items():
+            ordered = sorted(range(len(self.hashes)), key=values.__getitem__, reverse=BEST_FIRST[rank])
+            for confidential in (False, True):
+                for ipv6 in (False, True):
+                    self.orders[rank, confidential, ipv6] = array(
+                        "l",
+                        (
+                            row
+                            for row in ordered
+                            if (self.confidential[row] or not confidential) and (self.ipv6[row] or not ipv6)
+                        ),
+                    )
+        self.max_available = (
+            max(self.available_vcpus, default=0),
+            max(self.mem_available_kB, default=0),
+            max(self.disk_available_kB, default=0),
+        )
+
+    def match(
+        self,
+        vcpus: float = 0,
+        memory_mb: float = 0,
+        disk_mb: float = 0,
+        gpu_model: str | None = None,
+        confidential: bool = False,
+        ipv6: bool = False,
+        rank: Rank = Rank.headroom,
+        limit: int = 10,
+    ) -> list[tuple[str, float]]:
+        """Best `limit` CRNs with enough free capacity for the VM, with their rank value"""
+        memory_kB = memory_mb * 1024
+        disk_kB = disk_mb * 1024
+        rank_values = self.rank_values[rank]
+        if any(required > available for required, available in zip((vcpus, memory_kB, disk_kB), self.max_available)):
+            return []
+        if gpu_model is not None:
+            # Few CRNs have a given GPU model, sort them instead of going through the whole fleet
+            rows: Iterable[int] = sorted(
+                self.rows_by_gpu_model.get(gpu_model.lower(), []),
+                key=rank_values.__getitem__,
+                reverse=BEST_FIRST[rank],
+            )
+        else:
+            rows = self.orders[rank, confidential, ipv6]
+
+        matches = []
+        for row in rows:
+            if (
+                self.available_vcpus[row] >= vcpus
+                and self.mem_available_kB[row] >= memory_kB
+                and self.disk_available_kB[row] >= disk_kB
+                and (self.confidential[row] or not confidential)
+                and (self.ipv6[row] or not ipv6)
+            ):
+                matches.append((self.hashes[row], rank_values[row]))
+                if len(matches) >= limit:
+                    break
+        return matches
@@ -0,0 +1,50 @@
+"""Changes between two versions of the resource nodes of the corechannel aggregate."""
+
+from typing import Iterable, NamedTuple
+
+from nodes_list.response_types import ResourceNodeInfo
+
+SCORE_FIELDS = ("score", "performance", "decentralization", "score_updated")
+"Fields updated on most nodes at each scoring"
+
+
+class NodeListDiff(NamedTuple):
+    added: set[str]
+    removed: set[str]
+    address_changed: set[str]
+    metadata_changed: set[str]
+    "Nodes with the same address but other changes: name, status..."
+    score_changed: set[str]
+    "Nodes whose only changes are in SCORE_FIELDS"
+
+    def counts(self) -> dict[str, int]:
+        return {change: len(hashes) for change, hashes in self._asdict().items()}
+
+
+def _without_scores(node: ResourceNodeInfo) -> dict:
+    return {field: value for field, value in node.items() if field not in SCORE_FIELDS}
+
+
+def diff_nodes(previous: Iterable[ResourceNodeInfo], current: Iterable[ResourceNodeInfo]) -> NodeListDiff:
+    """Compare the nodes by hash"""
+    previous_by_hash = {node["hash"]: node for node in previous}
+    current_by_hash = {node["hash"]: node for node in current}
+    address_changed = set()
+    metadata_changed = set()
+    score_changed = set()
+    for crn_hash in previous_by_hash.keys() & current_by_hash.keys():
+        old, new = previous_by_hash[crn_hash], current_by_hash[crn_hash]
+        if old["address"] != new["address"]:
+            address_changed.add(crn_hash)
+        elif old != new:
+            if _without_scores(old) == _without_scores(new):
+                score_changed.add(crn_hash)
+            else:
+                metadata_changed.add(crn_hash)
+    return NodeListDiff(
+        added=current_by_hash.keys() - previous_by_hash.keys(),
+        removed=previous_by_hash.keys() - current_by_hash.keys(),
+        address_changed=address_changed,
+        metadata_changed=metadata_changed,
+        score_changed=score_changed,
+    )
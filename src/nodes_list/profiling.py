@@ -0,0 +1,261 @@
+"""On-demand sampling profiler of the refresh cycles and of the /crns.json requests.
+
+A profile is armed for the next N refresh cycles or requests. While one of them runs, a thread samples the stack
+of the event loop thread at a fixed interval, and of the worker threads the loop hands work to, such as the response
+builder. The stacks of a worker thread start with a `[thread <name>]` frame, the loop stacks with their own frames.
+Nothing runs when no profile is armed: the profiled functions only check an attribute. The sampler is stopped
+without waiting for it, so the event loop is never blocked: it merges its samples into the profile when it exits.
+The finished profiles are kept in a small ring and exported as collapsed stacks (flamegraph.pl, speedscope, ...)
+or as speedscope JSON."""
+
+import contextlib
+import datetime
+import functools
+import sys
+import threading
+import time
+from collections import Counter, deque
+from enum import Enum
+from types import FrameType
+from typing import Any, Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+MAX_STACK_DEPTH = 128
+
+
+class ProfileTarget(str, Enum):
+    refresh = "refresh"
+    "Refresh cycles of the data cache"
+    requests = "requests"
+    "/crns.json requests"
+
+
+def _stack(frame: FrameType | None) -> tuple[str, ...]:
+    """Names of the functions of the stack, outermost first"""
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class Sampler(threading.Thread):
+    """Thread sampling the stack of another thread until stopped, then merging its samples into the profile"""
+
+    def __init__(self, thread_id: int, profile: "Profile", worker_prefixes: tuple[str, ...] = ()):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.worker_prefixes = worker_prefixes
+        "Name prefixes of the worker threads also sampled"
+        self.profile = profile
+        self.interval = profile.interval
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        "Number of samples of each stack, outermost frame first"
+        self.idle_samples = 0
+        "Samples in which the event loop was waiting for I/O"
+        self._stop_event = threading.Event()
+        with profile.lock:
+            profile.samplers += 1
+
+    def run(self) -> None:
+        try:
+            while not self._stop_event.wait(self.interval):
+                self.sample()
+        finally:
+            self.profile.merge(self.stacks, self.idle_samples)
+
+    def sample(self) -> None:
+        frames = sys._current_frames()
+        frame = frames.get(self.thread_id)
+        if frame is not None:
+            if frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle_samples += 1
+            else:
+                self.stacks[_stack(frame)] += 1
+        if not self.worker_prefixes:
+            return
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident) if thread.name.startswith(self.worker_prefixes) else None
+            # An idle worker waits for work in the executor loop
+            if frame is not None and frame.f_code.co_qualname != "_worker":
+                self.stacks[(f"[thread {thread.name}]", *_stack(frame))] += 1
+
+    def stop(self) -> None:
+        """Stop sampling, without waiting for the thread to exit"""
+        self._stop_event.set()
+
+
+class Profile:
+    """Samples of the stack during the profiled refresh cycles or requests"""
+
+    id: int
+    target: ProfileTarget
+    count: int
+    "Number of refresh cycles or requests to profile"
+    interval: float
+    "Seconds between two samples"
+    started_at: datetime.datetime | None = None
+    duration: float = 0
+    "Seconds during which the sampler ran"
+    profiled: int = 0
+    "Number of refresh cycles or requests profiled so far"
+    stacks: Counter[tuple[str, ...]]
+    idle_samples: int = 0
+    samplers: int = 0
+    "Samplers that did not merge their samples yet"
+    lock: threading.Lock
+    "Held to merge the samples, as the samplers merge them from their own thread"
+
+    def __init__(self, profile_id: int, target: ProfileTarget, count: int, interval: float):
+        self.id = profile_id
+        self.target = target
+        self.count = count
+        self.interval = interval
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self) -> bool:
+        """Whether all the refresh cycles or requests were profiled and their samples merged"""
+        return self.profiled >= self.count and not self.samplers
+
+    def merge(self, stacks: Counter[tuple[str, ...]], idle_samples: int) -> None:
+        """Add the samples of a sampler that stopped"""
+        with self.lock:
+            self.stacks.update(stacks)
+            self.idle_samples += idle_samples
+            self.samplers -= 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            samples = sum(self.stacks.values())
+        return {
+            "id": self.id,
+            "target": self.target,
+            "count": self.count,
+            "profiled": self.profiled,
+            "complete": self.complete,
+            "interval_ms": self.interval * 1000,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "samples": samples,
+            "idle_samples": self.idle_samples,
+        }
+
+    def collapsed(self) -> str:
+        """Collapsed stacks, one line per stack with its number of samples"""
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
+
+    def speedscope(self) -> dict:
+        """Sampled profile in the speedscope file format, weights in milliseconds"""
+        frames: dict[str, int] = {}
+        samples = []
+        weights = []
+        with self.lock:
+            stacks = list(self.stacks.items())
+        for stack, count in stacks:
+            samples.append([frames.setdefault(name, len(frames)) for name in stack])
+            weights.append(count * self.interval * 1000)
+        name = f"{self.target.value} profile {self.id}"
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "aleph-nodes-list",
+            "shared": {"frames": [{"name": frame_name} for frame_name in frames]},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+
+
+class Profiler:
+    """Arms the profiles and keeps the last finished ones"""
+
+    armed: Profile | None = None
+    "Profile waiting for, or capturing, its refresh cycles or requests"
+    profiles: deque[Profile]
+    _next_id: int = 1
+    _started: int = 0
+    "Number of refresh cycles or requests of the armed profile that started"
+    _in_flight: int = 0
+    worker_prefixes: tuple[str, ...]
+    "Name prefixes of the worker threads sampled with the event loop"
+    _sampler: Sampler | None = None
+    _sampler_started_at: float = 0
+
+    def __init__(self, ring_size: int, worker_prefixes: tuple[str, ...] = ()):
+        self.profiles = deque(maxlen=ring_size)
+        self.worker_prefixes = worker_prefixes
+
+    def arm(self, target: ProfileTarget, count: int, interval: float) -> Profile:
+        """Profile the next `count` refresh cycles or requests. Raises RuntimeError if a profile is already armed."""
+        if self.armed is not None:
+            raise RuntimeError(f"Profile {self.armed.id} is already armed")
+        self.armed = Profile(self._next_id, target, count, interval)
+        self._next_id += 1
+        self._started = 0
+        return self.armed
+
+    def get(self, profile_id: int) -> Profile | None:
+        """Finished profile, None if unknown or if its samples are not all merged yet"""
+        return next((profile for profile in self.profiles if profile.id == profile_id and profile.complete), None)
+
+    @contextlib.contextmanager
+    def section(self, target: ProfileTarget):
+        """Sample the stack while in this section, if a profile of this target is armed and not complete"""
+        profile = self.armed
+        if profile is None or profile.target != target or self._started >= profile.count:
+            yield
+            return
+
+        self._started += 1
+        if self._sampler is None:
+            profile.started_at = profile.started_at or datetime.datetime.now(datetime.UTC)
+            self._sampler = Sampler(threading.get_ident(), profile, self.worker_prefixes)
+            self._sampler_started_at = time.monotonic()
+            self._sampler.start()
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            profile.profiled += 1
+            if not self._in_flight:
+                # Stop sampling between two sections, the time in between is not profiled
+                self._stop_sampler(profile)
+            if profile.profiled >= profile.count:
+                self.armed = None
+                self.profiles.append(profile)
+
+    def _stop_sampler(self, profile: Profile) -> None:
+        assert self._sampler
+        # Not joined: the sampler merges its samples into the profile when it exits
+        self._sampler.stop()
+        profile.duration += time.monotonic() - self._sampler_started_at
+        self._sampler = None
+
+    def profiled(self, target: ProfileTarget) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+        """Decorator of the coroutine functions to profile when a profile of the target is armed"""
+
+        def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+            @functools.wraps(func)
+            async def wrapper(*args: Any, **kwargs: Any) -> T:
+                if self.armed is None:
+                    return await func(*args, **kwargs)
+                with self.section(target):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
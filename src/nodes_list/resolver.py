@@ -0,0 +1,135 @@
+"""DNS resolution of the CRN hostnames, done in bulk at the start of each refresh cycle.
+
+The results are cached and served to the aiohttp connector, so each hostname is resolved once per TTL instead of
+once per request, and the CRNs that share an address can share its concurrency cap."""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from typing import Iterable, NamedTuple
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp.abc import AbstractResolver, ResolveResult
+
+logger = logging.getLogger(__name__)
+
+
+class UnresolvableHost(aiohttp.ClientConnectionError):
+    """The hostname of the CRN could not be resolved"""
+
+
+class HostPort(NamedTuple):
+    host: str
+    port: int
+
+
+def host_port(url: str) -> HostPort | None:
+    """Hostname and port of the URL, None if it has no hostname"""
+    parsed_url = urlparse(url)
+    if not parsed_url.hostname:
+        return None
+    try:
+        port = parsed_url.port
+    except ValueError:
+        return None
+    return HostPort(parsed_url.hostname, port or (443 if parsed_url.scheme == "https" else 80))
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class _Entry(NamedTuple):
+    addresses: list[ResolveResult]
+    error: Exception | None
+    expires_at: float
+    "time.monotonic() after which the host must be resolved again"
+
+
+class CachedResolver(AbstractResolver):
+    """Resolver keeping the addresses of each hostname for `ttl` seconds, and the failures for `negative_ttl`.
+
+    getaddrinfo() does not expose the TTL of the DNS records, so the same TTL is used for all the hostnames."""
+
+    ttl: float
+    negative_ttl: float
+    concurrency: int
+    "Maximum number of lookups in flight during resolve_all()"
+    entries: dict[str, _Entry]
+    _resolver: AbstractResolver | None = None
+
+    def __init__(self, ttl: float, negative_ttl: float, concurrency: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.concurrency = concurrency
+        self.entries = {}
+
+    async def _getaddrinfo(self, host: str) -> list[ResolveResult]:
+        if self._resolver is None:
+            self._resolver = aiohttp.DefaultResolver()
+        return await self._resolver.resolve(host, 0, family=socket.AF_UNSPEC)
+
+    async def lookup(self, host: str) -> _Entry:
+        """Entry of the hostname, resolved again if missing or expired"""
+        entry = self.entries.get(host)
+        now = time.monotonic()
+        if entry and entry.expires_at > now:
+            return entry
+        try:
+            addresses = await self._getaddrinfo(host)
+            if not addresses:
+                raise OSError(f"No address for {host}")
+            entry = _Entry(addresses, None, now + self.ttl)
+        except OSError as e:
+            logger.info(f"Could not resolve CRN host {host}: {e}")
+            entry = _Entry([], UnresolvableHost(f"Could not resolve {host}: {e}"), now + self.negative_ttl)
+        self.entries[host] = entry
+        return entry
+
+    async def resolve_all(self, hosts: Iterable[str]) -> dict[str, Exception]:
+        """Resolve the hostnames concurrently, each only once. Returns the hostnames that could not be resolved."""
+        hosts = {host for host in hosts if not is_ip_address(host)}
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def lookup(host: str) -> _Entry:
+            async with slots:
+                return await self.lookup(host)
+
+        entries = await asyncio.gather(*(lookup(host) for host in hosts))
+        return {host: entry.error for host, entry in zip(hosts, entries) if entry.error}
+
+    def retain(self, hosts: Iterable[str]) -> None:
+        """Forget the hostnames not in `hosts`, the ones of the CRNs not in the node list anymore"""
+        for host in self.entries.keys() - set(hosts):
+            del self.entries[host]
+
+    def address(self, host: str) -> str:
+        """First cached address of the hostname, or the hostname itself if unknown"""
+        entry = self.entries.get(host)
+        if entry and entry.addresses:
+            return entry.addresses[0]["host"]
+        return host
+
+    async def resolve(
+        self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET
+    ) -> list[ResolveResult]:
+        entry = await self.lookup(host)
+        if entry.error:
+            raise entry.error
+        return [
+            ResolveResult(**{**address, "port": port})  # type: ignore[typeddict-item]
+            for address in entry.addresses
+            if family in (socket.AF_UNSPEC, address["family"])
+        ]
+
+    async def close(self) -> None:
+        if self._resolver is not None:
+            await self._resolver.close()
+            self._resolver = None
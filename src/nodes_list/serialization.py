@@ -0,0 +1,109 @@
+"""Serialization of the responses, bypassing FastAPI's jsonable_encoder for the large payloads.
+
+MessagePack and CBOR are optional dependencies, their formats are only available when installed."""
+
+import datetime
+import json
+from enum import Enum
+from typing import Any
+
+import fastapi
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def dumps_json(content: Any) -> bytes:
+    """Serialize to JSON, with orjson if it is installed.
+
+    Datetimes are serialized in ISO format, as jsonable_encoder does."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, default=_default)
+        except orjson.JSONEncodeError:
+            # Integers larger than 64 bits, sent by some CRNs, are not supported by orjson
+            pass
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(fastapi.responses.Response):
+    """JSON response serialized with orjson.
+
+    Return it directly from the endpoint: when a dict is returned, FastAPI runs jsonable_encoder
+    on it first, which is slower than the serialization itself."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+class ResponseFormat(str, Enum):
+    json = "json"
+    msgpack = "msgpack"
+    cbor = "cbor"
+
+
+MEDIA_TYPES = {
+    ResponseFormat.json: "application/json",
+    ResponseFormat.msgpack: "application/msgpack",
+    ResponseFormat.cbor: "application/cbor",
+}
+ACCEPTED_MEDIA_TYPES = {
+    "application/json": ResponseFormat.json,
+    "application/msgpack": ResponseFormat.msgpack,
+    "application/x-msgpack": ResponseFormat.msgpack,
+    "application/vnd.msgpack": ResponseFormat.msgpack,
+    "application/cbor": ResponseFormat.cbor,
+}
+
+
+def negotiate_format(accept: str | None) -> ResponseFormat:
+    """Format preferred in the Accept header, JSON if none of the supported formats is accepted"""
+    if not accept:
+        return ResponseFormat.json
+    candidates = []
+    for position, media_range in enumerate(accept.split(",")):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if media_type.lower() in ACCEPTED_MEDIA_TYPES and quality > 0:
+            # Highest quality first, then in the order of the header
+            candidates.append((-quality, position, ACCEPTED_MEDIA_TYPES[media_type.lower()]))
+    return min(candidates)[2] if candidates else ResponseFormat.json
+
+
+def dumps_msgpack(content: Any) -> bytes:
+    """Serialize to MessagePack, datetimes as native timestamps"""
+    import msgpack
+
+    return msgpack.packb(content, datetime=True, default=str)
+
+
+def dumps_cbor(content: Any) -> bytes:
+    """Serialize to CBOR, datetimes as native timestamps"""
+    import cbor2
+
+    return cbor2.dumps(content, datetime_as_timestamp=True, default=lambda encoder, obj: encoder.encode(str(obj)))
+
+
+def dumps(content: Any, response_format: ResponseFormat) -> bytes:
+    if response_format == ResponseFormat.msgpack:
+        return dumps_msgpack(content)
+    if response_format == ResponseFormat.cbor:
+        return dumps_cbor(content)
+    return dumps_json(content)
@@ -0,0 +1,51 @@
+"""Startup milestones, to track the cold start time of the service.
+
+The program runtime starts the service on demand, so the time from the start of the process to the first
+response with data is paid often."""
+
+import os
+import time
+
+
+def process_started_at() -> float | None:
+    """time.monotonic() at which the process started, None if unknown (not on Linux)"""
+    try:
+        with open("/proc/self/stat") as stat_file:
+            # The command name, in parentheses, may contain spaces
+            start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    # The uptime is the time since boot, as time.monotonic() on Linux
+    return time.monotonic() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+class StartupTimes:
+    """time.monotonic() of each startup milestone"""
+
+    process_started_at: float | None
+    imported_at: float | None = None
+    "The application module is imported"
+    first_snapshot_at: float | None = None
+    "The first refresh cycle completed, the service is ready"
+    first_response_at: float | None = None
+    "The first response with data was sent"
+
+    def __init__(self):
+        self.process_started_at = process_started_at()
+
+    def mark(self, milestone: str) -> None:
+        """Record the time of the milestone, if not already recorded"""
+        if getattr(self, milestone) is None:
+            setattr(self, milestone, time.monotonic())
+
+    def to_dict(self) -> dict[str, float | None]:
+        """Seconds from the start of the process to each milestone"""
+        origin = self.process_started_at
+        return {
+            f"{milestone}_seconds": (
+                None if origin is None or getattr(self, milestone) is None else getattr(self, milestone) - origin
+            )
+            for milestone in ("imported_at", "first_snapshot_at", "first_response_at")
+        }
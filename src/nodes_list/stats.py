@@ -0,0 +1,108 @@
+"""Fleet-wide statistics, computed from the columnar view of the fleet (see columns.py)."""
+
+import math
+from array import array
+from collections import Counter
+from typing import Iterable
+
+from nodes_list.response_types import GPUDevice
+
+PERCENTILES = (10, 50, 90, 99)
+
+
+def percentiles(values: array) -> dict[str, float | None]:
+    """Percentiles of the values, with linear interpolation between the closest ranks"""
+    ordered = sorted(values)
+    result: dict[str, float | None] = {}
+    for percentile in PERCENTILES:
+        if not ordered:
+            result[f"p{percentile}"] = None
+            continue
+        rank = (len(ordered) - 1) * percentile / 100
+        low, high = math.floor(rank), math.ceil(rank)
+        result[f"p{percentile}"] = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return result
+
+
+def _column(columns: dict[str, list], name: str, mask: list[bool]) -> array:
+    """Known values of a numeric column for the rows selected by the mask"""
+    return array("d", (value for value, keep in zip(columns[name], mask) if keep and value is not None))
+
+
+def _summary(values: array) -> dict:
+    return {"total": math.fsum(values), **percentiles(values)}
+
+
+def count_gpus_by_model(
+    crn_gpus: Iterable[tuple[list[GPUDevice], list[GPUDevice]]], models: dict[str, str]
+) -> dict[str, dict[str, int]]:
+    """Number of compatible GPUs and available compatible GPUs for each model of the settings aggregate.
+
+    Args:
+        crn_gpus: compatible GPUs and compatible available GPUs of each CRN.
+        models: model of each compatible GPU device id.
+    """
+    total: Counter = Counter()
+    available: Counter = Counter()
+    for compatible, compatible_available in crn_gpus:
+        total.update(models.get(gpu["device_id"], gpu["device_id"]) for gpu in compatible)
+        available.update(models.get(gpu["device_id"], gpu["device_id"]) for gpu in compatible_available)
+    return {model: {"total": count, "available": available[model]} for model, count in sorted(total.items())}
+
+
+def compute_stats(columns: dict[str, list], gpus_by_model: dict[str, dict[str, int]]) -> dict:
+    """Network totals and distributions over the active CRNs.
+
+    Capacity totals and percentiles only cover the active CRNs whose usage could be fetched."""
+    active = [inactive_since is None for inactive_since in columns["inactive_since"]]
+    reachable = [is_active and cpu_count is not None for is_active, cpu_count in zip(active, columns["cpu_count"])]
+
+    vcpus = _column(columns, "cpu_count", reachable)
+    load5 = _column(columns, "load5", reachable)
+    # Estimated as the number of CPUs minus the 5 minutes load average
+    available_vcpus = array(
+        "d",
+        (
+            max(0.0, cpu_count - load)
+            for cpu_count, load, keep in zip(columns["cpu_count"], columns["load5"], reachable)
+            if keep and load is not None
+        ),
+    )
+
+    def count(name: str) -> int:
+        return sum(1 for value, is_active in zip(columns[name], active) if is_active and value)
+
+    return {
+        "crns": {
+            "total": len(active),
+            "active": sum(active),
+            "reachable": sum(reachable),
+        },
+        "vcpus": {"total": math.fsum(vcpus), "available": _summary(available_vcpus)},
+        "load5": percentiles(load5),
+        "memory_kB": {
+            "total": math.fsum(_column(columns, "mem_total_kB", reachable)),
+            "available": _summary(_column(columns, "mem_available_kB", reachable)),
+        },
+        "disk_kB": {
+            "total": math.fsum(_column(columns, "disk_total_kB", reachable)),
+            "available": _summary(_column(columns, "disk_available_kB", reachable)),
+        },
+        "gpus": {
+            "total": int(math.fsum(_column(columns, "compatible_gpu_count", active))),
+            "available": int(math.fsum(_column(columns, "compatible_available_gpu_count", active))),
+            "by_model": gpus_by_model,
+        },
+        "support": {
+            "gpu": count("gpu_support"),
+            "confidential": count("confidential_support"),
+            "qemu": count("qemu_support"),
+            "ipv6_host": count("ipv6_host"),
+            "ipv6_vm": count("ipv6_vm"),
+        },
+        "versions": dict(
+            Counter(
+                version or "unknown" for version, is_active in zip(columns["version"], active) if is_active
+            ).most_common()
+        ),
+    }
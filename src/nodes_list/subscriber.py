@@ -0,0 +1,126 @@
+"""Subscription to the aleph message stream, to know when the aggregates change instead of downloading them each time.
+
+The subscriber only signals which aggregate keys changed, the aggregates are then fetched from the API as before:
+a message holds an update of the aggregate, not its merged content. While the subscriber is disconnected, the
+aggregates are polled at each refresh cycle, and after it reconnects they are all fetched again, as messages may
+have been missed."""
+
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+from typing import Callable
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+"Seconds before reconnecting after a disconnection, doubled at each failed attempt"
+HEARTBEAT = 30
+"Seconds between two pings, to detect a dead connection"
+
+
+class AggregateSubscriber:
+    url: str
+    "URL of the message stream websocket, filtered on the AGGREGATE messages of the watched addresses"
+    watched: dict[str, set[str]]
+    "Aggregate keys watched for each owner address, lowercase"
+    on_change: Callable[[str, float | None], None]
+    "Called when an aggregate may have changed, with its key and the time of the update message if known"
+    connected: bool = False
+    connected_at: datetime.datetime | None = None
+    last_message_at: datetime.datetime | None = None
+    messages: int = 0
+    "Relevant messages received"
+    connections: int = 0
+    last_error: str | None = None
+    _task: asyncio.Task | None = None
+
+    def __init__(self, url: str, watched: dict[str, set[str]], on_change: Callable[[str, float | None], None]):
+        self.url = url
+        self.watched = {address.lower(): keys for address, keys in watched.items()}
+        self.on_change = on_change
+
+    def start(self) -> None:
+        """Subscribe in the background, if not already running"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self.run(), name="aggregate-subscriber")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        self.connected = False
+
+    async def run(self) -> None:
+        """Stay subscribed, reconnecting with a backoff"""
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self.subscribe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Message stream subscription failed: %r", e)
+                self.last_error = repr(e)
+            if self.connected_at is not None:
+                # It was connected, start again from the shortest delay
+                delay = RECONNECT_DELAY
+            self.connected = False
+            self.connected_at = None
+            await asyncio.sleep(delay)
+            delay = min(RECONNECT_MAX_DELAY, delay * 2)
+
+    async def subscribe(self) -> None:
+        """Receive the messages until the connection closes"""
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.url, heartbeat=HEARTBEAT) as ws:
+                logger.info("Subscribed to the message stream %s", self.url)
+                self.connected = True
+                self.connected_at = datetime.datetime.now(datetime.UTC)
+                self.connections += 1
+                # Messages may have been missed while disconnected
+                for keys in self.watched.values():
+                    for key in keys:
+                        self.on_change(key, None)
+                async for ws_message in ws:
+                    if ws_message.type == aiohttp.WSMsgType.TEXT:
+                        self.handle(ws_message.data)
+                    elif ws_message.type == aiohttp.WSMsgType.ERROR:
+                        raise ws.exception() or aiohttp.ClientError("Websocket error")
+        logger.info("Message stream closed")
+
+    def handle(self, data: str) -> None:
+        """Signal the change of the aggregate if the message updates a watched one"""
+        try:
+            message = json.loads(data)
+            if message.get("type") != "AGGREGATE":
+                return
+            content = message["content"]
+            keys = self.watched.get(str(content["address"]).lower(), set())
+            key = content["key"]
+            updated = content.get("time")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.debug("Ignoring unexpected message: %.200s", data)
+            return
+        if key in keys:
+            logger.info("Aggregate %s updated by message %s", key, message.get("item_hash"))
+            self.messages += 1
+            self.last_message_at = datetime.datetime.now(datetime.UTC)
+            self.on_change(key, float(updated) if isinstance(updated, (int, float)) else None)
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "connected_at": self.connected_at,
+            "connections": self.connections,
+            "messages": self.messages,
+            "last_message_at": self.last_message_at,
+            "last_error": self.last_error,
+        }
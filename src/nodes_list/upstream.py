@@ -0,0 +1,233 @@
+"""Requests to the aleph API servers, with health and latency tracking, failover and hedging.
+
+The aggregates are requested from the healthiest and fastest host first. If it has not answered after the 95th
+percentile of its latency, the same request is sent to the next host, and the first fresh response wins. A host that
+fails is moved last for a backoff period. A host returning an aggregate older than one already seen lags behind the
+network: its response is only used if no other host answers."""
+
+import asyncio
+import datetime
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Sequence
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SAMPLES = 20
+"Number of recent latencies kept per host"
+
+
+class ApiUnavailable(aiohttp.ClientError):
+    """None of the API hosts answered"""
+
+
+def aggregate_time(response: dict, key: str) -> float | None:
+    """Timestamp of the last update of the aggregate key, from the info returned with `with_info=true`"""
+    try:
+        last_updated = response["info"][key]["last_updated"]
+        if isinstance(last_updated, (int, float)):
+            return float(last_updated)
+        return datetime.datetime.fromisoformat(last_updated).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class ApiHost:
+    url: str
+    latencies: deque[float]
+    "Duration of the last requests, in seconds. Includes the requests that lost a race, so slow hosts rank last"
+    requests: int = 0
+    failures: int = 0
+    "Consecutive failures"
+    stale: int = 0
+    "Number of responses older than an aggregate already seen"
+    retry_at: float = 0
+    "time.monotonic() before which the host is only used after the others, as it failed or lags behind"
+    last_error: str | None = None
+    last_success_at: datetime.datetime | None = None
+    last_updated: float | None = None
+    "Timestamp of the last update of the most recent aggregate returned by the host"
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def p95(self) -> float | None:
+        if not self.latencies:
+            return None
+        return sorted(self.latencies)[math.ceil(0.95 * len(self.latencies)) - 1]
+
+    def record_success(self, latency: float, last_updated: float | None) -> None:
+        self.latencies.append(latency)
+        self.failures = 0
+        self.retry_at = 0
+        self.last_success_at = datetime.datetime.now(datetime.UTC)
+        if last_updated is not None:
+            self.last_updated = max(last_updated, self.last_updated or last_updated)
+
+    def record_stale(self, latency: float, backoff: float) -> None:
+        """The host answered with an outdated aggregate: it is tried after the others for `backoff` seconds, without
+        counting as a failure"""
+        self.latencies.append(latency)
+        self.stale += 1
+        self.retry_at = time.monotonic() + backoff
+
+    def record_failure(self, error: Exception, latency: float, backoff: float, max_backoff: float) -> None:
+        self.latencies.append(latency)
+        self.failures += 1
+        self.retry_at = time.monotonic() + min(max_backoff, backoff * 2 ** (self.failures - 1))
+        self.last_error = repr(error)
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.retry_at
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.is_healthy(),
+            "requests": self.requests,
+            "latency_p95": self.p95(),
+            "failures": self.failures,
+            "stale": self.stale,
+            "last_error": self.last_error,
+            "last_success_at": self.last_success_at,
+            "last_updated": self.last_updated,
+        }
+
+
+class ApiHosts:
+    hosts: list[ApiHost]
+    timeout: aiohttp.ClientTimeout
+    hedge_min_delay: float
+    hedge_max_delay: float
+    "Delay before a hedged request, used as is while the latency of the host is unknown"
+    backoff: float
+    max_backoff: float
+    freshest: dict[str, float]
+    "Timestamp of the most recent update seen of each aggregate key, on any host"
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        timeout: float,
+        hedge_min_delay: float,
+        hedge_max_delay: float,
+        backoff: float,
+        max_backoff: float,
+    ):
+        if not urls:
+            raise ValueError("At least one API host is required")
+        self.hosts = [ApiHost(url) for url in urls]
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.freshest = {}
+
+    def ranked(self) -> list[ApiHost]:
+        """Hosts in the order they are tried: healthy first, then by latency and in the configured order"""
+        position = {id(host): i for i, host in enumerate(self.hosts)}
+        return sorted(
+            self.hosts,
+            key=lambda host: (not host.is_healthy(), host.p95() is None, host.p95() or 0, position[id(host)]),
+        )
+
+    def hedge_delay(self, host: ApiHost) -> float:
+        p95 = host.p95()
+        if p95 is None:
+            return self.hedge_max_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, p95))
+
+    async def get_json(self, path: str, key: str) -> dict[str, Any]:
+        """Response of the first host returning a fresh aggregate.
+
+        Args:
+            path: path of the aggregate request, with `with_info=true` to check the freshness.
+            key: aggregate key, of which the last update time is compared across the hosts.
+        Raises:
+            ApiUnavailable: no host answered.
+        """
+        hosts = self.ranked()
+        started: dict[asyncio.Task, tuple[ApiHost, float]] = {}
+        pending: set[asyncio.Task] = set()
+        stale: tuple[float, dict] | None = None
+        errors: list[str] = []
+
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+
+            def start_next() -> None:
+                host = hosts[len(started)]
+                host.requests += 1
+                task = asyncio.create_task(self._get(session, host.url + path), name=f"api-{host.url}")
+                started[task] = host, time.monotonic()
+                pending.add(task)
+
+            start_next()
+            try:
+                while pending:
+                    last_host = hosts[len(started) - 1]
+                    can_hedge = len(started) < len(hosts)
+                    done, _ = await asyncio.wait(
+                        pending,
+                        timeout=self.hedge_delay(last_host) if can_hedge else None,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    if not done:
+                        logger.info("%s is slow, hedging with %s", last_host.url, hosts[len(started)].url)
+                        start_next()
+                        continue
+                    for task in done:
+                        pending.discard(task)
+                        host, started_at = started[task]
+                        latency = time.monotonic() - started_at
+                        try:
+                            response = task.result()
+                        except Exception as e:
+                            logger.warning("Error fetching %s from %s: %r", path, host.url, e)
+                            host.record_failure(e, latency, self.backoff, self.max_backoff)
+                            errors.append(f"{host.url}: {e!r}")
+                            continue
+                        updated = aggregate_time(response, key)
+                        freshest = self.freshest.get(key)
+                        if updated is not None and freshest is not None and updated < freshest:
+                            logger.warning("%s returned an outdated %s aggregate", host.url, key)
+                            host.record_stale(latency, self.backoff)
+                            if stale is None or updated > stale[0]:
+                                stale = updated, response
+                            continue
+                        host.record_success(latency, updated)
+                        if updated is not None:
+                            self.freshest[key] = updated
+                        return response
+                    # Failed or outdated: fail over to the next host at once
+                    if len(started) < len(hosts):
+                        start_next()
+            finally:
+                for task in pending:
+                    task.cancel()
+                    # Lost the race: what it took so far is a lower bound of its latency
+                    host, started_at = started[task]
+                    host.latencies.append(time.monotonic() - started_at)
+                if pending:
+                    await asyncio.wait(pending)
+
+        if stale is not None:
+            return stale[1]
+        raise ApiUnavailable(f"No API host answered: {'; '.join(errors)}")
+
+    @staticmethod
+    async def _get(session: aiohttp.ClientSession, url: str) -> dict:
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    def stats(self) -> dict:
+        return {
+            "hosts": [host.to_dict() for host in self.ranked()],
+            "freshest": self.freshest,
+        }
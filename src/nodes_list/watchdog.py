@@ -0,0 +1,195 @@
+"""Event loop lag watchdog.
+
+A coroutine wakes up at a fixed interval and records how late it was scheduled: the loop lag. A thread checks
+that these wake-ups happen, and when the loop is blocked for longer than a threshold, takes a snapshot of the stack
+of the loop thread and of the running task. The snapshots are aggregated by task and blocking code location, to
+find the code that should move off the loop."""
+
+import asyncio
+import contextlib
+import datetime
+import re
+import sys
+import threading
+import time
+import traceback
+from typing import NamedTuple
+
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+"Upper bounds of the lag histogram buckets, in milliseconds"
+
+MAX_OFFENDERS = 50
+"Number of distinct blocking locations kept, the ones blocking the least are dropped first"
+
+
+class LagHistogram:
+    counts: list[int]
+    "Number of lags in each bucket of LAG_BUCKETS_MS, plus one for the larger lags"
+    total_ms: float = 0
+    max_ms: float = 0
+
+    def __init__(self):
+        self.counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+
+    def record(self, lag_ms: float) -> None:
+        self.counts[next((i for i, bound in enumerate(LAG_BUCKETS_MS) if lag_ms <= bound), len(LAG_BUCKETS_MS))] += 1
+        self.total_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+
+    def to_dict(self) -> dict:
+        samples = sum(self.counts)
+        labels = [f"<={bound}ms" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": samples,
+            "mean_ms": self.total_ms / samples if samples else None,
+            "max_ms": self.max_ms,
+            "histogram": dict(zip(labels, self.counts)),
+        }
+
+
+class Stall(NamedTuple):
+    task: str
+    location: str
+    "Innermost frame of the stack, where the loop was blocked"
+    stack: list[str]
+    started_at: datetime.datetime
+
+
+class Offender:
+    """Stalls of the same task at the same location"""
+
+    task: str
+    location: str
+    count: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+    last_stack: list[str]
+    last_at: datetime.datetime
+
+    def __init__(self, stall: Stall):
+        self.task = stall.task
+        self.location = stall.location
+        self.last_stack = stall.stack
+        self.last_at = stall.started_at
+
+    def record(self, stall: Stall, duration_ms: float) -> None:
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        self.last_stack = stall.stack
+        self.last_at = stall.started_at
+
+    def to_dict(self) -> dict:
+        return {
+            "task": self.task,
+            "location": self.location,
+            "count": self.count,
+            "total_ms": self.total_ms,
+            "max_ms": self.max_ms,
+            "last_at": self.last_at,
+            "last_stack": self.last_stack,
+        }
+
+
+def _task_name(task: asyncio.Task | None) -> str:
+    if task is None:
+        return "(callback)"
+    # Unnamed tasks are numbered: Task-123
+    return re.sub(r"-\d+$", "", task.get_name())
+
+
+class LoopWatchdog:
+    interval: float
+    "Seconds between two measures of the loop lag"
+    threshold: float
+    "Seconds the loop must be blocked for a stack snapshot to be taken"
+    lag: LagHistogram
+    offenders: dict[tuple[str, str], Offender]
+    _loop: asyncio.AbstractEventLoop | None = None
+    _loop_thread_id: int = 0
+    _due: float = 0
+    "time.monotonic() at which the measuring coroutine should wake up"
+    _stall: Stall | None = None
+    "Stall in progress, seen by the thread and not yet measured by the coroutine"
+    _task: asyncio.Task | None = None
+    _thread: threading.Thread | None = None
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = LagHistogram()
+        self.offenders = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        """Start watching the running loop, if not already started"""
+        if self._task and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._due = time.monotonic() + self.interval
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self._measure(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop_event.set()
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    async def _measure(self) -> None:
+        while True:
+            self._due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._due
+            self.lag.record(lag * 1000)
+            with self._lock:
+                stall, self._stall = self._stall, None
+                # The loop is running again, the next stall will be a new one
+                self._due = time.monotonic() + self.interval
+            if stall:
+                self._record_stall(stall, lag * 1000)
+
+    def _watch(self) -> None:
+        """Take a snapshot of the loop thread when it is blocked, runs in a thread"""
+        while not self._stop_event.wait(self.threshold / 2):
+            with self._lock:
+                if self._stall is not None or time.monotonic() - self._due < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                assert self._loop
+                stack = traceback.extract_stack(frame)
+                innermost = stack[-1]
+                self._stall = Stall(
+                    task=_task_name(asyncio.current_task(self._loop)),
+                    location=f"{innermost.filename}:{innermost.lineno} in {innermost.name}",
+                    stack=stack.format(),
+                    started_at=datetime.datetime.now(datetime.UTC),
+                )
+
+    def _record_stall(self, stall: Stall, duration_ms: float) -> None:
+        key = (stall.task, stall.location)
+        if key not in self.offenders and len(self.offenders) >= MAX_OFFENDERS:
+            least = min(self.offenders, key=lambda k: self.offenders[k].total_ms)
+            del self.offenders[least]
+        self.offenders.setdefault(key, Offender(stall)).record(stall, duration_ms)
+
+    def stats(self, limit: int = 10) -> dict:
+        """Lag histogram and the locations that blocked the loop the longest in total"""
+        worst = sorted(self.offenders.values(), key=lambda offender: offender.total_ms, reverse=True)[:limit]
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag": self.lag.to_dict(),
+            "slow_callbacks": [offender.to_dict() for offender in worst],
+        }
@@ -0,0 +1,24 @@
+import socket
+
+import pytest
+from aiohttp.abc import ResolveResult
+
+from nodes_list.resolver import CachedResolver
+
+
+@pytest.fixture(autouse=True)
+def fake_dns(monkeypatch):
+    """Resolve all the hostnames to 127.0.0.1, the CRN requests are mocked and the tests must not depend on DNS.
+
+    Hosts ending with .invalid cannot be resolved."""
+
+    async def getaddrinfo(self, host: str) -> list[ResolveResult]:
+        if host.endswith(".invalid"):
+            raise OSError(f"Name or service not known: {host}")
+        return [
+            ResolveResult(
+                hostname=host, host="127.0.0.1", port=0, family=socket.AF_INET, proto=socket.IPPROTO_TCP, flags=0
+            )
+        ]
+
+    monkeypatch.setattr(CachedResolver, "_getaddrinfo", getaddrinfo)
@@ -0,0 +1,129 @@
+import json
+import random
+import socket
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from nodes_list.health import RELATIVE_ERROR, CrnHealth, HealthWindow, LatencyMetric, Outcome, latency_bucket, quantiles
+from nodes_list.main import PATH_ABOUT_USAGE_SYSTEM, PATH_IPv6_CHECK, PATH_STATUS_CONFIG, DataCache, ResponseProfile
+
+from .test_parse_responses import mock_ipv6_check, mock_status_config, mock_usage_system
+
+
+def test_quantiles():
+    rng = random.Random(0)
+    latencies = sorted(rng.lognormvariate(-1, 1) for _ in range(10_000))
+    counts = [0] * (latency_bucket(max(latencies)) + 1)
+    for latency in latencies:
+        counts[latency_bucket(latency)] += 1
+    estimated = quantiles(counts)
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        exact = latencies[int(q * len(latencies))] * 1000
+        assert abs(estimated[name] - exact) <= RELATIVE_ERROR * exact * 1.1
+    assert quantiles([0, 0]) == {"p50": None, "p95": None, "p99": None}
+
+
+def test_rolling_windows():
+    health = CrnHealth()
+    now = 1_700_000_000.0
+    health.record(Outcome.ok, connect=0.01, ttfb=0.1, total=0.2, now=now)
+    health.record(Outcome.timeout, connect=0.01, now=now)
+    health.record(Outcome.unreachable, now=now)
+    health.record(Outcome.ok, ttfb=0.1, total=0.3, now=now + 1)
+    report = health.report(now + 2)
+    assert report["1h"]["requests"] == 4
+    assert report["1h"]["availability"] == 0.5
+    assert report["1h"]["outcomes"] == {"ok": 2, "error": 0, "timeout": 1, "unreachable": 1}
+    assert report["1h"]["latency_ms"]["ttfb"]["p50"] == pytest.approx(100, rel=RELATIVE_ERROR)
+
+    # Out of the last hour, still in the last day
+    later = now + 2 * 3600
+    health.record(Outcome.ok, total=0.2, now=later)
+    report = health.report(later)
+    assert report["1h"]["requests"] == 1
+    assert report["1h"]["latency_ms"]["connect"]["p50"] is None
+    assert report["24h"]["requests"] == 5
+    assert health.summary(later)["availability_24h"] == 0.6
+
+    # Constant memory: the slots are reused
+    sizes = [len(slots.counts) for slots in health.latency.values()]
+    for i in range(10_000):
+        health.record(Outcome.ok, 0.01, 0.1, 0.2, now=later + i * 60)
+    assert [len(slots.counts) for slots in health.latency.values()] == sizes
+    assert health.report(later + 10_000 * 60)["24h"]["requests"] < 24 * 60
+
+    # A copy is not modified by the requests recorded later
+    copy = health.copy()
+    health.record(Outcome.error, now=later + 10_000 * 60)
+    assert copy.report(later + 10_000 * 60) != health.report(later + 10_000 * 60)
+    assert copy.outcome_counts(HealthWindow.hour, later + 10_000 * 60)["error"] == 0
+
+
+@pytest.mark.asyncio
+async def test_request_timings():
+    """The connect time and time to first byte are measured on the requests to a local stand-in CRN"""
+
+    def endpoint(body: str):
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(text=body, content_type="application/json")
+
+        return handler
+
+    app = web.Application()
+    app.router.add_get(PATH_STATUS_CONFIG, endpoint(mock_status_config))
+    app.router.add_get(PATH_ABOUT_USAGE_SYSTEM, endpoint(mock_usage_system))
+    app.router.add_get(PATH_IPv6_CHECK, endpoint(mock_ipv6_check))
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    try:
+        cache = DataCache()
+        cache.crn_infos["a"].node_url = f"http://crn.example.org:{server.port}/"
+        await cache.fetch_crns(["a"])
+    finally:
+        await server.close()
+
+    crn = cache.crn_infos["a"]
+    assert crn.system.data == json.loads(mock_usage_system)
+    report = crn.health.window_report(HealthWindow.hour)
+    assert report["outcomes"]["ok"] == 3
+    for metric in ("connect", "ttfb", "total"):
+        assert report["latency_ms"][metric]["p99"] is not None
+    # The connection of the config probe is reused: no connect time for that request
+    counts = crn.health.latency[HealthWindow.hour].totals(time.time())
+    connects = sum(counts[: len(counts) // len(LatencyMetric)])
+    assert 1 <= connects < 3
+
+
+@pytest.mark.asyncio
+async def test_unreachable_crn_counts_all_endpoints():
+    """A CRN that cannot be reached counts as many requests as one that answers"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+    cache = DataCache()
+    cache.crn_infos["a"].node_url = f"http://crn.example.org:{closed_port}/"
+    await cache.fetch_crns(["a"])
+    report = cache.crn_infos["a"].health.window_report(HealthWindow.hour)
+    assert report["requests"] == 3
+    assert report["outcomes"]["unreachable"] == 3
+
+    cache.crn_infos["b"].set_error(OSError("Name or service not known"))
+    assert cache.crn_infos["b"].health.window_report(HealthWindow.hour)["outcomes"]["unreachable"] == 3
+
+
+@pytest.mark.asyncio
+async def test_health_reports_are_built_from_the_snapshot():
+    cache = DataCache()
+    node = {"hash": "a", "score": 1, "inactive_since": None}
+    cache.node_list.set_data({"data": {"corechannel": {"resource_nodes": [node]}}})  # type: ignore
+    cache.crn_infos["a"].health.record(Outcome.ok, total=0.1)
+    cache.update_sorted_views()
+
+    # Recorded by a refresh in progress: only in the next snapshot
+    cache.crn_infos["a"].health.record(Outcome.timeout)
+    reports = await cache.health_reports()
+    assert reports["a"]["1h"]["outcomes"]["timeout"] == 0
+    assert cache.sorted_views.entries[ResponseProfile.compact]["a"]["health"]["availability_1h"] == 1
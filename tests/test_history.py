@@ -0,0 +1,84 @@
+import datetime
+import json
+
+from nodes_list.history import CRN_BYTES, SAMPLE_BYTES, UsageHistory, UsageHistoryStore
+
+from .test_parse_responses import mock_usage_system
+
+START = datetime.datetime(2025, 2, 10, 13, 43, tzinfo=datetime.UTC)
+
+
+def sample(timestamp: int, load1: float) -> dict:
+    return {
+        "timestamp": timestamp,
+        "load1": load1,
+        "load5": 1.0,
+        "load15": float("nan"),
+        "mem_available_MiB": 1024,
+        "disk_available_MiB": 2**32 - 1,
+        "gpu_available": 1,
+    }
+
+
+def test_ring_buffer_keeps_last_samples():
+    history = UsageHistory(capacity=3)
+    for i in range(5):
+        history.append(sample(1000 + i * 60, load1=i))
+
+    assert len(history) == 3
+    assert history.last_timestamp == 1240
+    result = history.downsample()
+    assert result["timestamp"] == [1120, 1180, 1240]
+    assert result["load1"] == [2, 3, 4]
+    assert result["load15"] == [None, None, None]
+    assert result["disk_available_MiB"] == [None, None, None]
+
+    history.resize(2)
+    assert history.downsample()["load1"] == [3, 4]
+
+
+def test_downsample():
+    history = UsageHistory(capacity=10)
+    for i in range(6):
+        history.append(sample(1200 + i * 60, load1=i))
+
+    result = history.downsample(step=180, since=1260)
+    assert result["timestamp"] == [1260, 1440]
+    assert result["load1"] == [2, 4.5]
+    assert result["mem_available_MiB"] == [1024, 1024]
+
+
+def test_store_records_at_interval():
+    store = UsageHistoryStore(interval=60, max_samples=1440, max_bytes=2**20)
+    store.set_crns(["a", "b"])
+    system = json.loads(mock_usage_system)
+
+    assert store.record("a", system, START)
+    assert not store.record("a", system, START + datetime.timedelta(seconds=31))
+    assert store.record("a", system, START + datetime.timedelta(seconds=62))
+    assert store.histories["a"].downsample()["mem_available_MiB"] == [40022, 40022]
+    assert store.histories["a"].downsample()["gpu_available"] == [0, 0]
+
+    store.set_crns(["b"])
+    assert list(store.histories) == ["b"]
+
+
+def test_store_memory_cap():
+    store = UsageHistoryStore(interval=60, max_samples=1440, max_bytes=128 * 1024 * 1024)
+    store.set_crns(str(i) for i in range(3000))
+    # 24h of samples every minute for 3000 CRNs
+    assert store.capacity == 1440
+    assert (store.capacity * SAMPLE_BYTES + CRN_BYTES) * 3000 < 128 * 1024 * 1024
+
+    store.set_crns(str(i) for i in range(10000))
+    assert (store.capacity * SAMPLE_BYTES + CRN_BYTES) * 10000 <= 128 * 1024 * 1024
+
+
+def test_store_memory_cap_when_full():
+    store = UsageHistoryStore(interval=60, max_samples=1440, max_bytes=100_000)
+    store.set_crns(str(i) for i in range(50))
+    for history in store.histories.values():
+        for i in range(store.capacity):
+            history.append(sample(1000 + i * 60, load1=i))
+    assert len(store.histories["0"]) == store.capacity
+    assert store.memory_bytes() <= 100_000
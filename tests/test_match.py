@@ -0,0 +1,40 @@
+from nodes_list.match import MatchIndex, Rank
+
+GPU = {"device_id": "10de:2684"}
+
+
+def make_index() -> MatchIndex:
+    columns = {
+        "hash": ["big", "small", "gpu", "inactive", "dead"],
+        "inactive_since": [None, None, None, 1234.0, None],
+        "score": [0.5, 0.9, 0.7, 1, 1],
+        "cpu_count": [32, 4, 16, 64, None],
+        "load5": [8.0, 0.0, 2.0, 0.0, None],
+        "mem_total_kB": [128 * 2**20, 8 * 2**20, 64 * 2**20, 256 * 2**20, None],
+        "mem_available_kB": [64 * 2**20, 6 * 2**20, 32 * 2**20, 256 * 2**20, None],
+        "disk_total_kB": [2**30, 2**28, 2**30, 2**30, None],
+        "disk_available_kB": [2**29, 2**27, 2**29, 2**30, None],
+        "confidential_support": [True, False, False, True, None],
+        "ipv6_vm": [True, True, False, True, None],
+    }
+    available_gpus = [[], [], [GPU], [GPU], []]
+    return MatchIndex(columns, available_gpus, {"10de:2684": "RTX 4090"})
+
+
+def test_match_capacity():
+    index = make_index()
+    assert index.hashes == ["big", "small", "gpu"]
+
+    assert [crn_hash for crn_hash, _ in index.match(rank=Rank.score)] == ["small", "gpu", "big"]
+    assert [crn_hash for crn_hash, _ in index.match(vcpus=8, rank=Rank.score)] == ["gpu", "big"]
+    assert [crn_hash for crn_hash, _ in index.match(memory_mb=40 * 1024)] == ["big"]
+    assert [crn_hash for crn_hash, _ in index.match(confidential=True)] == ["big"]
+    assert [crn_hash for crn_hash, _ in index.match(ipv6=True, rank=Rank.load)] == ["small", "big"]
+    assert index.match(rank=Rank.load, limit=1) == [("small", 0)]
+
+
+def test_match_gpu_model():
+    index = make_index()
+    assert index.match(gpu_model="rtx 4090") == [("gpu", 0.5)]
+    assert index.match(gpu_model="RTX 4090", vcpus=15) == []
+    assert index.match(gpu_model="H100") == []
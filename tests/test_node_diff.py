@@ -0,0 +1,52 @@
+import datetime
+
+from nodes_list.main import DataCache
+from nodes_list.node_diff import diff_nodes
+
+
+def node(crn_hash: str, address: str, score: float = 0.9) -> dict:
+    return {"hash": crn_hash, "address": address, "score": score, "inactive_since": None}
+
+
+def test_diff_nodes():
+    previous = [node("a", "https://a.example.org"), node("b", "https://b.example.org"), node("c", "https://c.org")]
+    current = [node("a", "https://a.example.org", 0.5), node("b", "https://b2.example.org"), node("d", "https://d.org")]
+
+    diff = diff_nodes(previous, current)
+    assert diff.added == {"d"}
+    assert diff.removed == {"c"}
+    assert diff.address_changed == {"b"}
+    assert diff.metadata_changed == set()
+    assert diff.score_changed == {"a"}
+    assert diff.counts() == {
+        "added": 1,
+        "removed": 1,
+        "address_changed": 1,
+        "metadata_changed": 0,
+        "score_changed": 1,
+    }
+    assert diff_nodes(previous, [{**previous[0], "name": "renamed", "score": 0.5}]).metadata_changed == {"a"}
+
+
+def test_apply_node_list_diff():
+    cache = DataCache()
+    previous = [node("a", "https://a.example.org"), node("b", "https://b.example.org"), node("c", "ftp://c.org")]
+    cache.apply_node_list_diff(diff_nodes([], previous), previous)
+    assert not cache.crn_infos["c"].is_valid
+    crn_a, crn_b = cache.crn_infos["a"], cache.crn_infos["b"]
+    crn_b.config.set_data({})
+    cache.usage_history.set_crns(["a", "b"])
+    cache.usage_history.record("b", {}, datetime.datetime.now(datetime.UTC))
+    assert len(cache.usage_history.histories["b"]) == 1
+
+    current = [node("a", "https://a.example.org", 0.5), node("b", "https://b2.example.org")]
+    cache.apply_node_list_diff(diff_nodes(previous, current), current)
+    # Unchanged address: the data and the URL validation are kept
+    assert cache.crn_infos["a"] is crn_a
+    # New address: the data and the history are reset
+    assert cache.crn_infos["b"] is not crn_b
+    assert cache.crn_infos["b"].node_url == "https://b2.example.org"
+    assert cache.crn_infos["b"].config.data is None
+    assert len(cache.usage_history.histories["b"]) == 0
+    # Removed from the node list: evicted
+    assert "c" not in cache.crn_infos
@@ -1,6 +1,11 @@
+import json
+import threading
+
+import aiohttp
 import pytest
 from aioresponses import aioresponses
-from nodes_list.main import DataCache, _fetch_node_list
+from nodes_list import main
+from nodes_list.main import API_HOST, NODE_AGGREGATE_PATH, CRNData, DataCache, _fetch_node_list
 
 mock_node_aggr = """
 {
@@ -151,7 +156,7 @@ mock_ipv6_check = """{"host": true, "vm": true}"""
 async def test_fetch_node_list():
     with aioresponses() as mock_responses:
         mock_responses.get(
-            "https://api2.aleph.im/api/v0/aggregates/0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10.json?keys=corechannel",
+            f"{API_HOST}{NODE_AGGREGATE_PATH}",
             body=mock_node_aggr,
         )
         await _fetch_node_list()
@@ -161,7 +166,7 @@ async def test_fetch_node_list():
 async def test_fetch_node_data():
     with aioresponses() as mock_responses:
         mock_responses.get(
-            "https://api2.aleph.im/api/v0/aggregates/0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10.json?keys=corechannel",
+            f"{API_HOST}{NODE_AGGREGATE_PATH}",
             body=mock_node_aggr,
         )
         mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
@@ -180,3 +185,119 @@ async def test_fetch_node_data():
             ]
             == 67219543
         )
+
+
+@pytest.mark.asyncio
+async def test_unreachable_crn_fails_all_endpoints():
+    with aioresponses() as mock_responses:
+        mock_responses.get(
+            "https://gpu-test-02.nergame.app/status/config",
+            exception=aiohttp.ClientConnectionError("Connection refused"),
+        )
+        crn = CRNData()
+        crn.node_url = "https://gpu-test-02.nergame.app/"
+        await crn.fetch_all()
+
+        # Only the probe was sent
+        assert len(mock_responses.requests) == 1
+        assert isinstance(crn.config.error, aiohttp.ClientConnectionError)
+        assert crn.system.error is crn.config.error
+        assert crn.check_ipv6.error is crn.config.error
+
+
+@pytest.mark.asyncio
+async def test_reachable_crn_with_invalid_config_fetches_other_endpoints():
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://gpu-test-02.nergame.app/status/config", status=404)
+        mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
+        mock_responses.get("https://gpu-test-02.nergame.app/status/check/ipv6", body=mock_ipv6_check)
+        crn = CRNData()
+        crn.node_url = "https://gpu-test-02.nergame.app/"
+        await crn.fetch_all()
+
+        assert isinstance(crn.config.error, aiohttp.ClientResponseError)
+        assert crn.system.error is None
+        assert crn.check_ipv6.data == {"host": True, "vm": True}
+
+
+@pytest.mark.asyncio
+async def test_too_large_response_is_aborted(monkeypatch):
+    monkeypatch.setitem(main.CRN_MAX_RESPONSE_BYTES, main.PATH_IPv6_CHECK, 100)
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://gpu-test-02.nergame.app/status/config", body=mock_status_config)
+        mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
+        mock_responses.get(
+            "https://gpu-test-02.nergame.app/status/check/ipv6",
+            body=mock_ipv6_check + " " * 100,
+        )
+        crn = CRNData("https://gpu-test-02.nergame.app/")
+        await crn.fetch_all()
+
+    assert isinstance(crn.check_ipv6.error, main.ResponseTooLarge)
+    assert crn.system.error is None
+
+
+@pytest.mark.asyncio
+async def test_content_length_is_checked_before_reading(monkeypatch):
+    with aioresponses() as mock_responses:
+        mock_responses.get(
+            "https://gpu-test-02.nergame.app/status/check/ipv6",
+            body=mock_ipv6_check,
+            headers={"Content-Length": str(10 * 1024 * 1024)},
+        )
+        with pytest.raises(main.ResponseTooLarge, match="Content-Length"):
+            await main.fetch_crn_endpoint("https://gpu-test-02.nergame.app/", main.PATH_IPv6_CHECK)
+
+
+@pytest.mark.asyncio
+async def test_slow_response_is_aborted(monkeypatch):
+    monkeypatch.setattr(main, "CRN_THROUGHPUT_GRACE_PERIOD", -1)
+    monkeypatch.setattr(main, "CRN_MIN_THROUGHPUT", float("inf"))
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://gpu-test-02.nergame.app/status/config", body=mock_status_config)
+        crn = CRNData("https://gpu-test-02.nergame.app/")
+        await crn.fetch_all()
+
+    assert isinstance(crn.config.error, main.SlowResponse)
+    # Counts as unreachable, the other endpoints are not queried
+    assert crn.system.error is crn.config.error
+
+
+@pytest.mark.asyncio
+async def test_large_response_is_decoded_in_a_thread(monkeypatch):
+    monkeypatch.setattr(main, "CRN_THREAD_DECODE_BYTES", 100)
+    decoded_in = []
+    json_loads = json.loads
+
+    def loads(body):
+        decoded_in.append(threading.current_thread())
+        return json_loads(body)
+
+    monkeypatch.setattr(main.json, "loads", loads)
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
+        data = await main.fetch_crn_system("https://gpu-test-02.nergame.app/")
+
+    assert data["cpu"]["count"]
+    assert decoded_in and decoded_in[0] is not threading.main_thread()
+
+
+def test_crn_timeout():
+    # Not enough latencies yet
+    assert main.crn_timeout([0.1, 0.2]).total == main.CRN_MAX_TIMEOUT
+    # Clamped to the minimum
+    assert main.crn_timeout([0.1, 0.2, 0.1]).total == main.CRN_MIN_TIMEOUT
+    timeout = main.crn_timeout([1, 2, 1, 4])
+    assert timeout.total == 4 * main.CRN_TIMEOUT_FACTOR
+    assert timeout.sock_connect == main.CRN_CONNECT_TIMEOUT
+    assert main.crn_timeout([20, 20, 20]).total == main.CRN_MAX_TIMEOUT
+
+
+@pytest.mark.asyncio
+async def test_timeouts_are_recorded_as_latency():
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://gpu-test-02.nergame.app/status/config", exception=TimeoutError())
+        crn = CRNData("https://gpu-test-02.nergame.app/")
+        await crn.fetch_all()
+
+    assert list(crn.latencies[main.PATH_STATUS_CONFIG]) == [main.CRN_MAX_TIMEOUT]
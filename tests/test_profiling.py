@@ -0,0 +1,88 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from nodes_list.profiling import Profiler, ProfileTarget
+
+
+def busy_loop(seconds: float) -> None:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_profile_next_calls():
+    profiler = Profiler(ring_size=2)
+
+    @profiler.profiled(ProfileTarget.refresh)
+    async def refresh():
+        busy_loop(0.05)
+        await asyncio.sleep(0)
+
+    # Not armed: nothing is sampled
+    await refresh()
+    assert not profiler.profiles
+
+    profile = profiler.arm(ProfileTarget.refresh, count=2, interval=0.001)
+    with pytest.raises(RuntimeError):
+        profiler.arm(ProfileTarget.requests, count=1, interval=0.001)
+    await refresh()
+    assert profiler.armed is profile
+    await refresh()
+    assert profiler.armed is None
+    assert profile.profiled == 2
+    # Available once the sampler merged its samples, the event loop does not wait for it
+    for _ in range(100):
+        if profiler.get(profile.id):
+            break
+        await asyncio.sleep(0.01)
+    assert profiler.get(profile.id) is profile
+    # Only the armed calls are profiled
+    await refresh()
+    assert profile.profiled == 2
+
+    assert sum(profile.stacks.values()) > 10
+    assert any(stack[-1] == "tests.test_profiling:busy_loop" for stack in profile.stacks)
+    line = profile.collapsed().splitlines()[0]
+    assert "test_profile_next_calls.<locals>.refresh;tests.test_profiling:busy_loop" in line
+    speedscope = profile.speedscope()
+    assert speedscope["profiles"][0]["type"] == "sampled"
+    assert len(speedscope["profiles"][0]["samples"]) == len(profile.stacks)
+
+
+@pytest.mark.asyncio
+async def test_profile_other_target_is_not_captured():
+    profiler = Profiler(ring_size=2)
+
+    @profiler.profiled(ProfileTarget.requests)
+    async def request():
+        pass
+
+    profiler.arm(ProfileTarget.refresh, count=1, interval=0.001)
+    await request()
+    assert profiler.armed.profiled == 0
+
+
+@pytest.mark.asyncio
+async def test_profile_worker_threads():
+    profiler = Profiler(ring_size=2, worker_prefixes=("builder",))
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="builder")
+
+    @profiler.profiled(ProfileTarget.refresh)
+    async def refresh():
+        await asyncio.get_running_loop().run_in_executor(executor, busy_loop, 0.05)
+
+    profile = profiler.arm(ProfileTarget.refresh, count=1, interval=0.001)
+    await refresh()
+    executor.shutdown()
+    for _ in range(100):
+        if profiler.get(profile.id):
+            break
+        await asyncio.sleep(0.01)
+    # The stacks of the worker start with the thread name, the event loop was waiting for it
+    assert any(
+        stack[0] == "[thread builder_0]" and stack[-1] == "tests.test_profiling:busy_loop" for stack in profile.stacks
+    )
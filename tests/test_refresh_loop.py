@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import aiohttp
+
+import pytest
+from nodes_list import main
+from nodes_list.main import DataCache
+from nodes_list.node_diff import diff_nodes
+
+
+@pytest.mark.asyncio
+async def test_refresh_loop_restarts_after_crash(monkeypatch):
+    cache = DataCache()
+    calls = 0
+
+    async def crashing_loop():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("boom")
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(cache, "refresh_loop", crashing_loop)
+    monkeypatch.setattr(main, "REFRESH_RESTART_DELAY", 0)
+    cache.start()
+    await asyncio.sleep(0.01)
+    assert calls == 2
+    assert not cache.loop_task.done()
+
+    await cache.stop()
+    assert cache.loop_task is None
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_fetch_in_flight(monkeypatch):
+    cache = DataCache()
+    fetch_cancelled = asyncio.Event()
+
+    async def slow_fetch():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            fetch_cancelled.set()
+            raise
+
+    monkeypatch.setattr(cache, "fetch_node_list_and_node_data", slow_fetch)
+    cache.start()
+    await asyncio.sleep(0.01)
+    assert cache.refresh_task_is_running()
+
+    await cache.stop()
+    assert fetch_cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_deadline_carries_over_slow_crns(monkeypatch):
+    cache = DataCache()
+    fetched = []
+
+    async def fetch_endpoints(self, session):
+        if self.node_url == "https://slow.example.org/":
+            await asyncio.sleep(10)
+        fetched.append(self.node_url)
+
+    monkeypatch.setattr(main.CRNData, "_fetch_endpoints", fetch_endpoints)
+    monkeypatch.setattr(main, "CRN_CONNECTIONS_PER_HOST", 1)
+    for crn_hash in ("fast", "slow"):
+        cache.crn_infos[crn_hash].node_url = f"https://{crn_hash}.example.org/"
+
+    await cache.fetch_crns(["fast", "slow"], deadline=time.monotonic() + 0.05)
+    assert fetched == ["https://fast.example.org/"]
+    assert cache.carried_over == {"slow"}
+
+    # The CRNs carried over are fetched first in the next refresh
+    nodes = [
+        {"hash": crn_hash, "address": f"https://{crn_hash}.example.org/", "score": 0.9, "inactive_since": None}
+        for crn_hash in ("fast", "slow")
+    ]
+    assert cache.refresh_schedule(nodes, diff_nodes(nodes, nodes)) == ["slow", "fast"]
+
+
+@pytest.mark.asyncio
+async def test_deadline_times_out_crns_being_fetched(monkeypatch):
+    cache = DataCache()
+
+    async def fetch_crn_endpoint(node_url, endpoint, *args):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(main, "fetch_crn_endpoint", fetch_crn_endpoint)
+    crn = cache.crn_infos["slow"]
+    crn.node_url = "https://slow.example.org/"
+    await cache.fetch_crns(["slow"], deadline=time.monotonic() + 0.05)
+    # Not carried over: it counts as a timeout and a failure, so it is backed off
+    assert cache.carried_over == set()
+    assert crn.failures == 1
+    assert isinstance(crn.config.error, main.RefreshDeadline)
+    assert not crn.fetching
+    assert crn.health.summary(time.time())["availability_1h"] == 0
+
+
+@pytest.mark.asyncio
+async def test_refresh_schedule(monkeypatch):
+    async def fetch_endpoints(self, session):
+        if "failing" in self.node_url:
+            self.config.set_error(aiohttp.ClientConnectionError())
+        else:
+            self.config.set_data({})
+
+    monkeypatch.setattr(main.CRNData, "_fetch_endpoints", fetch_endpoints)
+    monkeypatch.setattr(main, "INACTIVE_POLL_CYCLES", 3)
+    cache = DataCache()
+
+    def node(crn_hash: str, score: float, inactive: bool = False) -> dict:
+        return {
+            "hash": crn_hash,
+            "address": f"https://{crn_hash}.example.org/",
+            "score": score,
+            "inactive_since": 1234 if inactive else None,
+        }
+
+    nodes = [node("inactive", 0.9, inactive=True), node("failing", 0.9), node("low", 0.2), node("high", 0.8)]
+    schedules = []
+    previous: list[dict] = []
+    for _ in range(8):
+        diff = diff_nodes(previous, nodes)
+        cache.apply_node_list_diff(diff, nodes)
+        schedules.append(cache.refresh_schedule(nodes, diff))
+        await cache.fetch_crns(schedules[-1])
+        cache.schedule_next_refresh(nodes, schedules[-1])
+        cache.generation += 1
+        previous = nodes
+
+    # New CRNs are all fetched, the active and reachable ones first, by score
+    assert schedules[0] == ["failing", "high", "low", "inactive"]
+    # Failing CRNs are fetched after 1, 2, 4... cycles, after the reachable ones
+    assert [i for i, schedule in enumerate(schedules) if "failing" in schedule] == [0, 1, 3, 7]
+    assert schedules[1] == ["high", "low", "failing"]
+    # Inactive CRNs every 3 cycles
+    assert [i for i, schedule in enumerate(schedules) if "inactive" in schedule] == [0, 3, 6]
+
+    # A change in the node list makes the CRN due and first, except a change of the score only
+    changed = [{**nodes[0], "name": "renamed"}, *nodes[1:3], {**nodes[3], "score": 0.1}]
+    assert cache.refresh_schedule(changed, diff_nodes(nodes, changed)) == ["inactive", "low", "high"]
@@ -0,0 +1,89 @@
+import asyncio
+import socket
+
+import pytest
+from aioresponses import aioresponses
+
+from nodes_list.main import DataCache
+from nodes_list.resolver import CachedResolver, UnresolvableHost, host_port
+
+from .test_parse_responses import mock_ipv6_check, mock_status_config, mock_usage_system
+
+
+def test_host_port():
+    assert host_port("https://crn.example.org/") == ("crn.example.org", 443)
+    assert host_port("http://crn.example.org:4020") == ("crn.example.org", 4020)
+    assert host_port("https:///") is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_all_caches_lookups(monkeypatch):
+    lookups = []
+
+    async def getaddrinfo(self, host):
+        lookups.append(host)
+        if host.endswith(".invalid"):
+            raise OSError("Name or service not known")
+        return [dict(hostname=host, host="10.0.0.1", port=0, family=socket.AF_INET, proto=6, flags=0)]
+
+    monkeypatch.setattr(CachedResolver, "_getaddrinfo", getaddrinfo)
+    resolver = CachedResolver(ttl=60, negative_ttl=60, concurrency=2)
+
+    errors = await resolver.resolve_all(["a.example.org", "a.example.org", "b.invalid", "10.0.0.2"])
+    assert sorted(lookups) == ["a.example.org", "b.invalid"]
+    assert isinstance(errors["b.invalid"], UnresolvableHost)
+    assert resolver.address("a.example.org") == "10.0.0.1"
+    # The connector gets the cached addresses with the requested port
+    assert (await resolver.resolve("a.example.org", 443))[0]["port"] == 443
+
+    # Failures are cached too
+    await resolver.resolve_all(["a.example.org", "b.invalid"])
+    assert len(lookups) == 2
+
+    # Only the hosts that are not in the node list anymore are forgotten, not the ones left out of a cycle
+    await resolver.resolve_all(["b.invalid"])
+    resolver.retain(["a.example.org", "b.invalid"])
+    assert resolver.address("a.example.org") == "10.0.0.1"
+    resolver.retain(["b.invalid"])
+    assert resolver.address("a.example.org") == "a.example.org"
+
+
+@pytest.mark.asyncio
+async def test_unresolvable_crns_are_skipped():
+    cache = DataCache()
+    cache.crn_infos["a"].node_url = "https://crn.example.org/"
+    cache.crn_infos["b"].node_url = "https://crn.invalid/"
+    with aioresponses() as mock_responses:
+        mock_responses.get("https://crn.example.org/status/config", body=mock_status_config)
+        mock_responses.get("https://crn.example.org/about/usage/system", body=mock_usage_system)
+        mock_responses.get("https://crn.example.org/status/check/ipv6", body=mock_ipv6_check)
+        await cache.fetch_crns(["a", "b"])
+
+        assert len(mock_responses.requests) == 3
+    assert cache.crn_infos["a"].config.data
+    assert isinstance(cache.crn_infos["b"].config.error, UnresolvableHost)
+    assert cache.crn_infos["b"].system.error is cache.crn_infos["b"].config.error
+    # Polled less often, like the CRNs that cannot be reached
+    assert (cache.crn_infos["a"].failures, cache.crn_infos["b"].failures) == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_co_hosted_crns_share_the_host_cap(monkeypatch):
+    monkeypatch.setattr("nodes_list.main.CRN_CONNECTIONS_PER_HOST", 2)
+    cache = DataCache()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fetch_endpoints(self, session):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    monkeypatch.setattr("nodes_list.main.CRNData._fetch_endpoints", fetch_endpoints)
+    # All the hostnames resolve to 127.0.0.1, see conftest.py
+    for i in range(6):
+        cache.crn_infos[str(i)].node_url = f"https://crn-{i}.example.org/"
+    await cache.fetch_crns([str(i) for i in range(6)])
+    assert max_in_flight == 2
@@ -1,10 +1,12 @@
+import asyncio
 import datetime
+import time
 
 import pytest
 from aioresponses import aioresponses
 from fastapi.testclient import TestClient
 from nodes_list import main
-from nodes_list.main import app, SETTING_AGGREGATE_URL
+from nodes_list.main import app, API_HOST, NODE_AGGREGATE_PATH, SETTINGS_AGGREGATE_PATH
 from .test_gpu_aggregate import FAKE_GPU_AGGREGATE
 
 from .test_parse_responses import (
@@ -35,6 +37,23 @@ def test_index():
     response = client.get("/")
     assert response.status_code == 200
     assert "<h1>" in response.text
+    # Served compressed (and decompressed by the client) when accepted
+    assert response.headers["Content-Encoding"] == "gzip"
+    response = client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_ready():
+    main.data_cache = main.DataCache()
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["ready"] is False
+    # Also configured without the lifespan events
+    assert main.configure_logging.cache_info().currsize == 1
+    fill_data_cache()
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["startup"]["first_snapshot_at_seconds"] > 0
 
 
 def test_crn():
@@ -49,17 +68,19 @@ def test_mock_data(patch_datetime_now):
     with aioresponses() as mock_responses:
         main.data_cache = main.DataCache()
         mock_responses.get(
-            "https://api2.aleph.im/api/v0/aggregates/0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10.json?keys=corechannel",
+            f"{API_HOST}{NODE_AGGREGATE_PATH}",
             body=mock_node_aggr,
         )
         mock_responses.get(
-            SETTING_AGGREGATE_URL,
+            f"{API_HOST}{SETTINGS_AGGREGATE_PATH}",
             body=FAKE_GPU_AGGREGATE,
         )
         mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
         mock_responses.get("https://gpu-test-02.nergame.app/status/config", body=mock_status_config)
         mock_responses.get("https://gpu-test-02.nergame.app/status/check/ipv6", body=mock_ipv6_check)
         "Basic check that the endpoint don't crash"
+        # The refresh loop is not started by the TestClient, fill the cache directly
+        asyncio.run(main.data_cache.fetch_node_list_and_node_data())
         response = client.get("/crns.json")
         assert response.status_code == 200
         expected_response = {
@@ -82,6 +103,8 @@ def test_mock_data(patch_datetime_now):
                     "config_from_crn": True,
                     "debug_config_from_crn_at": "2020-12-25T17:05:55+00:00",
                     "debug_config_from_crn_error": "None",
+                    "debug_usage_from_crn_at": "2020-12-25T17:05:55+00:00",
+                    "usage_from_crn_error": "None",
                     "decentralization": 0.8393111079955136,
                     "description": "This is a test CRN, please don't use it",
                     "gpu_support": True,
@@ -149,4 +172,231 @@ def test_mock_data(patch_datetime_now):
             ],
             "last_refresh": "2020-12-25T17:05:55+00:00",
         }
-        assert response.json() == expected_response
+        data = response.json()
+        # The latencies depend on the machine running the tests
+        health = data["crns"][0].pop("health")
+        assert health["availability_1h"] == health["availability_24h"] == 1
+        assert health["latency_p50_ms"] > 0
+        assert data == expected_response
+        assert response.headers["Age"] == "0"
+        assert response.headers["Last-Modified"] == "Fri, 25 Dec 2020 17:05:55 GMT"
+        assert response.headers["X-Data-Generation"] == "1"
+        assert "max-age=31" in response.headers["Cache-Control"]
+
+
+def test_no_data_before_the_first_snapshot():
+    main.data_cache = main.DataCache()
+    for path in ("/crns.json", "/stats.json", "/crns/match"):
+        response = client.get(path)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(main.REFRESH_INTERVAL)
+        assert response.headers["Cache-Control"] == "no-store"
+
+
+def test_stale_data_is_not_served(monkeypatch):
+    fill_data_cache()
+    main.data_cache.sorted_views.last_refresh = datetime.datetime.now(datetime.UTC) - datetime.timedelta(
+        seconds=main.MAX_DATA_AGE + 1
+    )
+
+    # A refresh cycle that fails to build the snapshot does not make the old one look fresh
+    def fail(*args):
+        raise RuntimeError("build failed")
+
+    monkeypatch.setattr(main.data_cache, "build_sorted_views", fail)
+    with aioresponses() as mock_responses:
+        mock_responses.get(f"{API_HOST}{NODE_AGGREGATE_PATH}", body=mock_node_aggr)
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.data_cache.fetch_node_list_and_node_data())
+    # The node list of the failed cycle was not stored, it is fetched again by the next one
+    assert main.data_cache.aggregate_is_due("corechannel", main.REFRESH_INTERVAL)
+    response = client.get("/crns.json")
+    assert response.status_code == 503
+    assert response.headers["Cache-Control"] == "no-store"
+
+
+def test_force_refresh_is_rate_limited(monkeypatch):
+    main.data_cache = main.DataCache()
+
+    async def slow_fetch():
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(main.data_cache, "fetch_node_list_and_node_data", slow_fetch)
+    response = client.get("/debug/node")
+    assert response.status_code == 202
+    assert response.json() == {"status": "running", "generation": 0, "wait_for_generation": 1}
+
+    # The refresh has just started, another one is not allowed before the minimum interval
+    response = client.get("/debug/node")
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= main.FORCE_REFRESH_MIN_INTERVAL
+
+
+def test_force_refresh_after_refresh_loop_cycle(monkeypatch):
+    main.data_cache = main.DataCache()
+    refreshes = []
+
+    async def fetch():
+        refreshes.append(time.monotonic())
+
+    monkeypatch.setattr(main.data_cache, "fetch_node_list_and_node_data", fetch)
+
+    async def refresh_loop_cycle():
+        await main.data_cache.start_refresh()
+
+    asyncio.run(refresh_loop_cycle())
+    # The refresh loop just ran a cycle: it does not prevent a forced refresh
+    response = client.get("/debug/node")
+    assert response.status_code == 202
+    assert len(refreshes) == 2
+
+
+def fill_data_cache():
+    """Replace the data cache by one refreshed with the mock data"""
+    with aioresponses() as mock_responses:
+        main.data_cache = main.DataCache()
+        mock_responses.get(
+            f"{API_HOST}{NODE_AGGREGATE_PATH}",
+            body=mock_node_aggr,
+        )
+        mock_responses.get(f"{API_HOST}{SETTINGS_AGGREGATE_PATH}", body=FAKE_GPU_AGGREGATE)
+        mock_responses.get("https://gpu-test-02.nergame.app/about/usage/system", body=mock_usage_system)
+        mock_responses.get("https://gpu-test-02.nergame.app/status/config", body=mock_status_config)
+        mock_responses.get("https://gpu-test-02.nergame.app/status/check/ipv6", body=mock_ipv6_check)
+        asyncio.run(main.data_cache.fetch_node_list_and_node_data())
+
+
+def test_compact_profile():
+    fill_data_cache()
+    response = client.get("/crns.json?profile=compact")
+    assert response.status_code == 200
+    crn = response.json()["crns"][0]
+    assert not [key for key in crn if key.startswith("debug_")]
+    assert "usage_from_crn_error" not in crn
+    assert "system_usage" not in crn
+    assert crn["usage"] == {
+        "cpu_count": 20,
+        "load1": 2.283203125,
+        "load5": 2.27490234375,
+        "load15": 2.27001953125,
+        "mem_total_kB": 67219543,
+        "mem_available_kB": 40982622,
+        "disk_total_kB": 1853812338,
+        "disk_available_kB": 1450697875,
+        "gpu_count": 1,
+        "gpu_available_count": 0,
+        "active": True,
+    }
+
+    crn = client.get("/crns.json?profile=debug").json()["crns"][0]
+    assert crn["debug_ipv6_check_error"] == "None"
+    assert crn["system_usage"]["cpu"]["count"] == 20
+
+
+def test_arrow_export():
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    fill_data_cache()
+    response = client.get("/crns.arrow")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.num_rows == 1
+    row = table.to_pylist()[0]
+    assert row["hash"] == "e9423d9f9fd27cdc9c4c27d5cf3120ef573eece260d44e6df76b3c27569a3154"
+    assert row["cpu_count"] == 20
+    assert row["mem_available_kB"] == 40982622
+    assert row["compatible_gpu_count"] == 1
+    assert row["ipv6_vm"] is True
+
+    response = client.get("/crns.parquet")
+    assert response.status_code == 200
+    assert pq.read_table(pa.BufferReader(response.content)).to_pylist() == table.to_pylist()
+
+
+def test_msgpack_format():
+    msgpack = pytest.importorskip("msgpack")
+
+    fill_data_cache()
+    response = client.get("/crns.json", headers={"Accept": "application/msgpack"})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert "Accept" in response.headers["Vary"]
+    content = msgpack.unpackb(response.content, timestamp=3)
+    assert isinstance(content["last_refresh"], datetime.datetime)
+    assert content["crns"][0]["system_usage"] == client.get("/crns.json").json()["crns"][0]["system_usage"]
+
+    response = client.get("/crns.json?format=msgpack")
+    assert response.headers["Content-Type"] == "application/msgpack"
+
+
+def test_crn_history():
+    fill_data_cache()
+    crn_hash = "e9423d9f9fd27cdc9c4c27d5cf3120ef573eece260d44e6df76b3c27569a3154"
+    response = client.get(f"/crns/{crn_hash}/history")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"].startswith("public")
+    assert "Last-Modified" in response.headers
+    history = response.json()
+    assert history["mem_available_MiB"] == [40022]
+    assert history["load5"] == [2.27490234375]
+
+    assert client.get("/crns/unknown/history").status_code == 404
+    assert client.get("/debug/history").json()["samples"] == 1
+
+
+def test_stats():
+    fill_data_cache()
+    response = client.get("/stats.json")
+    assert response.status_code == 200
+    assert "X-Data-Generation" in response.headers
+    stats = response.json()
+    # The only CRN of the mock data is inactive
+    assert stats["crns"] == {"total": 1, "active": 0, "reachable": 0}
+    assert stats["gpus"]["by_model"] == {}
+
+
+def test_crns_match():
+    fill_data_cache()
+    response = client.get("/crns/match?vcpus=2&memory_mb=2048&rank=load")
+    assert response.status_code == 200
+    # The only CRN of the mock data is inactive
+    assert response.json() == {"rank": "load", "crns": []}
+    assert client.get("/crns/match?limit=0").status_code == 422
+
+
+def test_profile(monkeypatch):
+    fill_data_cache()
+    monkeypatch.setattr(main, "PROFILE_TOKEN", None)
+    assert client.post("/debug/profile?target=requests").status_code == 404
+
+    monkeypatch.setattr(main, "PROFILE_TOKEN", "secret")
+    assert client.post("/debug/profile?target=requests").status_code == 401
+    headers = {"Authorization": "Bearer secret"}
+    response = client.post("/debug/profile?target=requests&count=1&interval_ms=1", headers=headers)
+    assert response.status_code == 202
+    profile_id = response.json()["id"]
+    assert client.post("/debug/profile?target=refresh", headers=headers).status_code == 409
+    assert client.get(f"/debug/profile/{profile_id}", headers=headers).status_code == 404
+
+    assert client.get("/crns.json").status_code == 200
+    assert client.get("/debug/profile", headers=headers).json()["armed"] is None
+    response = client.get(f"/debug/profile/{profile_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["profiles"][0]["type"] == "sampled"
+    response = client.get(f"/debug/profile/{profile_id}?format=collapsed", headers=headers)
+    assert response.headers["Content-Type"].startswith("text/plain")
+
+
+def test_crns_health():
+    fill_data_cache()
+    response = client.get("/crns/health?window=1h&sort=p95&order=desc")
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["window"], data["sort"], data["order"]) == ("1h", "p95", "desc")
+    crn = data["crns"][0]
+    assert crn["hash"] == "e9423d9f9fd27cdc9c4c27d5cf3120ef573eece260d44e6df76b3c27569a3154"
+    assert crn["1h"]["outcomes"]["ok"] == 3
+    assert crn["24h"]["availability"] == 1
+    assert client.get("/crns/health?sort=latency").status_code == 422
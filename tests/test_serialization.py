@@ -0,0 +1,27 @@
+import datetime
+import json
+
+from fastapi.encoders import jsonable_encoder
+from nodes_list.serialization import ResponseFormat, dumps_json, negotiate_format
+
+from .test_parse_responses import mock_usage_system
+
+
+def test_dumps_json_matches_jsonable_encoder():
+    content = {
+        "last_refresh": datetime.datetime(2020, 12, 25, 17, 5, 55, 123, tzinfo=datetime.UTC),
+        "crns": [{"system_usage": json.loads(mock_usage_system), "version": None, "error": "None"}],
+    }
+    assert json.loads(dumps_json(content)) == jsonable_encoder(content)
+
+
+def test_dumps_json_large_integers():
+    assert json.loads(dumps_json({"total_kB": 2**70})) == {"total_kB": 2**70}
+
+
+def test_negotiate_format():
+    assert negotiate_format(None) == ResponseFormat.json
+    assert negotiate_format("*/*") == ResponseFormat.json
+    assert negotiate_format("application/x-msgpack") == ResponseFormat.msgpack
+    assert negotiate_format("application/msgpack;q=0.5, application/cbor") == ResponseFormat.cbor
+    assert negotiate_format("application/cbor;q=0, application/json") == ResponseFormat.json
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+from nodes_list.main import (
+    PREBUILT_RESPONSES,
+    Cursor,
+    DataCache,
+    ExpiredCursor,
+    InvalidCursor,
+    ResponseProfile,
+    SortKey,
+    SortOrder,
+    version_key,
+)
+from nodes_list.serialization import ResponseFormat, dumps
+
+from .test_parse_responses import mock_status_config, mock_usage_system
+
+
+def make_cache(scores: dict[str, float], memory: dict[str, int]) -> DataCache:
+    cache = DataCache()
+    # CRNs with a null score are inactive
+    nodes = [
+        {"hash": crn_hash, "score": score, "inactive_since": None if score else 1234}
+        for crn_hash, score in scores.items()
+    ]
+    cache.node_list.set_data({"data": {"corechannel": {"resource_nodes": nodes}}})  # type: ignore
+    for crn_hash, available_kB in memory.items():
+        system = json.loads(mock_usage_system)
+        system["mem"]["available_kB"] = available_kB
+        cache.crn_infos[crn_hash].system.set_data(system)
+        cache.crn_infos[crn_hash].config.set_data(json.loads(mock_status_config))
+    cache.update_sorted_views()
+    return cache
+
+
+def test_sorted_views():
+    cache = make_cache(scores={"c": 0.5, "a": 0.9, "b": 0.5}, memory={"a": 10, "c": 30})
+
+    # Ties are ordered by hash in both orders
+    assert cache.sorted_views.orders[SortKey.score, SortOrder.desc, False] == ["a", "b", "c"]
+    assert cache.sorted_views.orders[SortKey.score, SortOrder.asc, False] == ["b", "c", "a"]
+    # CRNs without data come last in both orders
+    assert cache.sorted_views.orders[SortKey.memory, SortOrder.desc, False] == ["c", "a", "b"]
+    assert cache.sorted_views.orders[SortKey.memory, SortOrder.asc, False] == ["a", "c", "b"]
+    assert cache.sorted_views.orders[SortKey.version, SortOrder.asc, False] == ["a", "c", "b"]
+
+
+def test_version_key():
+    assert version_key("1.3.0") < version_key("1.3.0-41-g7303587") < version_key("1.4.0")
+    assert version_key("0.9.10") > version_key("0.9.2")
+
+
+@pytest.mark.asyncio
+async def test_pagination_is_consistent_across_refreshes():
+    cache = make_cache(scores={"a": 0.9, "b": 0.8, "c": 0.7, "d": 0}, memory={})
+
+    page = await cache.format_response(filter_inactive=True, limit=2)
+    assert [crn["hash"] for crn in page["crns"]] == ["a", "b"]
+    assert page["total"] == 3
+
+    # A refresh lands between two pages: the new node and new scores don't affect the next page
+    cache.node_list.data["data"]["corechannel"]["resource_nodes"].append(
+        {"hash": "0", "score": 1, "inactive_since": None}
+    )
+    cache.node_list.data["data"]["corechannel"]["resource_nodes"][0]["score"] = 0.1
+    cache.generation += 1
+    cache.update_sorted_views()
+
+    page = await cache.format_response(filter_inactive=True, limit=2, cursor=page["next_cursor"])
+    assert [crn["hash"] for crn in page["crns"]] == ["c"]
+    assert page["next_cursor"] is None
+
+    with pytest.raises(InvalidCursor):
+        await cache.format_response(filter_inactive=False, limit=2, cursor="invalid")
+    # Offsets outside of the view
+    for offset in (-1, 4):
+        cursor = Cursor(cache.generation, SortKey.score, SortOrder.desc, True, offset).encode()
+        with pytest.raises(InvalidCursor):
+            await cache.format_response(filter_inactive=True, limit=2, cursor=cursor)
+
+
+@pytest.mark.asyncio
+async def test_cursor_expires():
+    cache = make_cache(scores={"a": 0.9, "b": 0.8}, memory={})
+    page = await cache.format_response(filter_inactive=False, limit=1)
+    for _ in range(3):
+        cache.generation += 1
+        cache.update_sorted_views()
+
+    with pytest.raises(ExpiredCursor):
+        await cache.format_response(filter_inactive=False, limit=1, cursor=page["next_cursor"])
+
+
+@pytest.mark.asyncio
+async def test_prebuilt_responses():
+    cache = make_cache(scores={"a": 0.9, "b": 0.8, "c": 0}, memory={"a": 10})
+    for kwargs in PREBUILT_RESPONSES:
+        body = await cache.get_encoded_response(ResponseFormat.json, **kwargs)
+        # Served as is, not encoded again
+        assert body is await cache.get_encoded_response(ResponseFormat.json, **kwargs)
+        assert body == dumps(await cache.format_response(**kwargs), ResponseFormat.json)
+    assert not cache.encoded_responses
+
+    # Other variants are encoded in the response builder thread, and kept for the generation
+    body = await cache.get_encoded_response(ResponseFormat.json, filter_inactive=False, sort=SortKey.memory)
+    assert [crn["hash"] for crn in json.loads(body)["crns"]] == ["a", "b", "c"]
+    assert len(cache.encoded_responses) == 1
+    page = json.loads(await cache.get_encoded_response(ResponseFormat.json, filter_inactive=True, limit=1))
+    assert [crn["hash"] for crn in page["crns"]] == ["a"]
+    assert page["total"] == 2
+
+
+@pytest.mark.asyncio
+async def test_snapshot_is_not_modified_by_refresh():
+    cache = make_cache(scores={"a": 0.9}, memory={"a": 10})
+    kwargs = PREBUILT_RESPONSES[0]
+    body = await cache.get_encoded_response(ResponseFormat.json, **kwargs)
+
+    # A refresh in progress updates the CRN data: the snapshot stays the same until the next one is published
+    config = json.loads(mock_status_config)
+    config["version"] = "9.9.9"
+    cache.crn_infos["a"].config.set_data(config)
+    compact = await cache.format_response(filter_inactive=False, profile=ResponseProfile.compact)
+    assert compact["crns"][0]["version"] != "9.9.9"
+    assert await cache.get_encoded_response(ResponseFormat.json, **kwargs) is body
+
+    views = cache.build_sorted_views(cache.generation + 1, cache.node_list.data, cache.node_list.fetched_at)
+    assert cache.sorted_views.generation == cache.generation
+    cache.generation = views.generation
+    cache.publish_sorted_views(views)
+    page = json.loads(await cache.get_encoded_response(ResponseFormat.json, **kwargs))
+    assert page["crns"][0]["version"] == "9.9.9"
+    assert cache.sorted_views.columns["version"] == ["9.9.9"]
+
+
+def test_fleet_data_is_built_with_the_snapshot():
+    cache = make_cache(scores={"a": 0.9, "b": 0.5}, memory={"a": 10})
+    columns, stats = cache.sorted_views.columns, cache.sorted_views.stats
+    assert columns["hash"] == ["a", "b"]
+    # Only "a" has its usage
+    assert cache.sorted_views.match_index.hashes == ["a"]
+
+    # A CRN removed from the node list is not looked up again, nor added back to the CRN data
+    del cache.crn_infos["b"]
+    cache.crn_infos["a"].system.set_error(TimeoutError())
+    assert cache.sorted_views.columns is columns and cache.sorted_views.stats is stats
+    assert "b" not in cache.crn_infos
@@ -0,0 +1,22 @@
+import time
+
+from nodes_list.startup import StartupTimes, process_started_at
+
+
+def test_process_started_at():
+    started_at = process_started_at()
+    # Only available on Linux
+    if started_at is not None:
+        assert started_at <= time.monotonic()
+
+
+def test_startup_times():
+    startup = StartupTimes()
+    startup.process_started_at = time.monotonic() - 1
+    startup.mark("imported_at")
+    imported_at = startup.imported_at
+    startup.mark("imported_at")
+    assert startup.imported_at == imported_at
+    times = startup.to_dict()
+    assert 1 <= times["imported_at_seconds"] < 2
+    assert times["first_response_at_seconds"] is None
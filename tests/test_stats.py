@@ -0,0 +1,49 @@
+import json
+from array import array
+
+from nodes_list.main import gpu_models
+from nodes_list.stats import compute_stats, count_gpus_by_model, percentiles
+
+from .test_gpu_aggregate import FAKE_GPU_AGGREGATE, _sample_system_info_with_gpu
+
+
+def test_percentiles():
+    assert percentiles(array("d", [4, 1, 3, 2, 5])) == {"p10": 1.4, "p50": 3, "p90": 4.6, "p99": 4.96}
+    assert percentiles(array("d")) == {"p10": None, "p50": None, "p90": None, "p99": None}
+
+
+def test_count_gpus_by_model():
+    devices = json.loads(_sample_system_info_with_gpu)["gpu"]["devices"]
+    gpus_by_model = count_gpus_by_model(
+        [(devices[:2], devices[:1]), ([], [])], gpu_models(json.loads(FAKE_GPU_AGGREGATE))
+    )
+    assert gpus_by_model == {"A100": {"total": 1, "available": 0}, "RTX 4000 ADA": {"total": 1, "available": 1}}
+
+
+def test_compute_stats():
+    columns = {
+        "inactive_since": [None, None, 1234.0, None],
+        "cpu_count": [8, 16, 32, None],
+        "load5": [2.0, 20.0, 1.0, None],
+        "mem_total_kB": [100, 200, 400, None],
+        "mem_available_kB": [50, 150, 400, None],
+        "disk_total_kB": [1000, 2000, 4000, None],
+        "disk_available_kB": [10, 20, 40, None],
+        "compatible_gpu_count": [1, 0, 4, None],
+        "compatible_available_gpu_count": [1, 0, 4, None],
+        "gpu_support": [True, False, True, None],
+        "confidential_support": [False, True, True, None],
+        "qemu_support": [True, True, True, None],
+        "ipv6_host": [True, True, True, None],
+        "ipv6_vm": [True, False, True, None],
+        "version": ["1.3.0", "1.4.0", "1.3.0", None],
+    }
+    stats = compute_stats(columns, {})
+    assert stats["crns"] == {"total": 4, "active": 3, "reachable": 2}
+    assert stats["vcpus"]["total"] == 24
+    assert stats["vcpus"]["available"]["total"] == 6
+    assert stats["memory_kB"]["total"] == 300
+    assert stats["memory_kB"]["available"]["p50"] == 100
+    assert stats["gpus"]["total"] == 1
+    assert stats["support"] == {"gpu": 1, "confidential": 1, "qemu": 2, "ipv6_host": 2, "ipv6_vm": 1}
+    assert stats["versions"] == {"1.3.0": 1, "1.4.0": 1, "unknown": 1}
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import json
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from nodes_list import subscriber as subscriber_module
+from nodes_list.main import NODE_AGGREGATE_ADDRESS, SETTINGS_AGGREGATE_ADDRESS, DataCache
+from nodes_list.subscriber import AggregateSubscriber
+
+
+@contextlib.asynccontextmanager
+async def message_stream():
+    """Local stand-in of the aleph message stream, sending the messages put in the queue, None to disconnect"""
+    queue: asyncio.Queue[dict | str | None] = asyncio.Queue()
+
+    async def stream(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        while (message := await queue.get()) is not None:
+            await ws.send_str(message if isinstance(message, str) else json.dumps(message))
+        await ws.close()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/api/ws0/messages", stream)
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    try:
+        yield server.make_url("/api/ws0/messages").with_scheme("ws"), queue
+    finally:
+        await server.close()
+
+
+def aggregate_message(address: str, key: str) -> dict:
+    return {
+        "type": "AGGREGATE",
+        "item_hash": "f" * 64,
+        "sender": address,
+        "content": {"address": address, "key": key, "content": {}, "time": 1714564800},
+    }
+
+
+async def wait_for(condition, timeout: float = 2) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_subscriber(monkeypatch):
+    monkeypatch.setattr(subscriber_module, "RECONNECT_DELAY", 0.01)
+    changes: list[tuple[str, float | None]] = []
+    async with message_stream() as (url, queue):
+        subscriber = AggregateSubscriber(
+            str(url),
+            {NODE_AGGREGATE_ADDRESS: {"corechannel"}, SETTINGS_AGGREGATE_ADDRESS: {"settings"}},
+            lambda key, updated: changes.append((key, updated)),
+        )
+        subscriber.start()
+        try:
+            # Messages may have been missed before the connection: all the aggregates changed
+            await wait_for(lambda: subscriber.connected)
+            assert sorted(changes) == [("corechannel", None), ("settings", None)]
+            changes.clear()
+
+            await queue.put("not json")
+            await queue.put({"type": "POST", "content": {"address": NODE_AGGREGATE_ADDRESS, "key": "corechannel"}})
+            await queue.put(aggregate_message("0x0000000000000000000000000000000000000000", "corechannel"))
+            await queue.put(aggregate_message(NODE_AGGREGATE_ADDRESS, "profile"))
+            await queue.put(aggregate_message(NODE_AGGREGATE_ADDRESS.lower(), "corechannel"))
+            await wait_for(lambda: subscriber.messages == 1)
+            assert changes == [("corechannel", 1714564800)]
+
+            # Reconnected after the stream closes
+            changes.clear()
+            await queue.put(None)
+            await wait_for(lambda: subscriber.connections == 2 and subscriber.connected)
+            assert sorted(changes) == [("corechannel", None), ("settings", None)]
+        finally:
+            await subscriber.stop()
+    assert not subscriber.connected
+
+
+@pytest.mark.asyncio
+async def test_aggregates_are_fetched_when_changed():
+    cache = DataCache()
+    cache.subscriber = AggregateSubscriber("ws://localhost/", {}, cache.aggregate_changed)
+    # Never fetched
+    assert cache.aggregate_is_due("corechannel", 0)
+    cache.aggregate_fetched_at["corechannel"] = time.monotonic()
+    # Not subscribed: polled
+    assert cache.aggregate_is_due("corechannel", 0)
+
+    cache.subscriber.connected = True
+    assert not cache.aggregate_is_due("corechannel", 0)
+    node_list = {"data": {"corechannel": {"resource_nodes": []}}}
+    cache.node_list.set_data(node_list)  # type: ignore
+    # Not requested from the API
+    assert await cache.fetch_node_list() is node_list
+    cache.subscriber.on_change("corechannel", None)
+    assert cache.aggregate_is_due("corechannel", 0)
+    # Reconciled from time to time
+    cache.changed_aggregates.clear()
+    cache.aggregate_fetched_at["corechannel"] -= 3600
+    assert cache.aggregate_is_due("corechannel", 0)
+
+
+def test_changed_aggregate_is_kept_until_fetched_with_the_update():
+    cache = DataCache()
+    cache.aggregate_changed("corechannel", 1714564800)
+    cache.aggregate_changed("corechannel", None)
+    assert cache.changed_aggregates == {"corechannel": 1714564800}
+
+    # Answered by an API server that did not process the update message yet
+    cache.aggregate_fetched("corechannel", {"info": {"corechannel": {"last_updated": "2024-05-01T11:00:00+00:00"}}})
+    assert "corechannel" in cache.changed_aggregates
+    cache.aggregate_fetched("corechannel", {"info": {"corechannel": {"last_updated": "2024-05-01T12:00:00+00:00"}}})
+    assert "corechannel" not in cache.changed_aggregates
+
+    # The time of the update is not known after a reconnection: any fetch includes it
+    cache.aggregate_changed("settings", None)
+    cache.aggregate_fetched("settings", {"info": {"settings": {"last_updated": 0}}})
+    assert not cache.changed_aggregates
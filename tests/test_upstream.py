@@ -0,0 +1,115 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from nodes_list.main import NODE_AGGREGATE_PATH
+from nodes_list.upstream import ApiHosts, ApiUnavailable, aggregate_time
+
+
+@contextlib.asynccontextmanager
+async def api_server(last_updated: str = "2024-05-01T12:00:00+00:00", delay: float = 0, status: int = 200):
+    """Local stand-in of an aleph API server, serving the node aggregate"""
+
+    async def aggregate(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        if status != 200:
+            return web.Response(status=status)
+        return web.json_response(
+            {
+                "address": request.match_info["address"],
+                "data": {"corechannel": {"resource_nodes": [], "served_by": request.url.port}},
+                "info": {"corechannel": {"last_updated": last_updated}},
+            }
+        )
+
+    app = web.Application()
+    app.router.add_get("/api/v0/aggregates/{address}.json", aggregate)
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    try:
+        yield server
+    finally:
+        await server.close()
+
+
+def make_api(*servers: TestServer, hedge_delay: float = 5) -> ApiHosts:
+    urls = [str(server.make_url("")) for server in servers]
+    return ApiHosts(
+        urls, timeout=5, hedge_min_delay=hedge_delay, hedge_max_delay=hedge_delay, backoff=30, max_backoff=60
+    )
+
+
+def served_by(response: dict) -> int:
+    return response["data"]["corechannel"]["served_by"]
+
+
+def test_aggregate_time():
+    assert aggregate_time({"info": {"corechannel": {"last_updated": "1970-01-01T00:01:00+00:00"}}}, "corechannel") == 60
+    assert aggregate_time({"info": {"settings": {"last_updated": 60}}}, "settings") == 60
+    assert aggregate_time({"data": {}}, "corechannel") is None
+
+
+@pytest.mark.asyncio
+async def test_failover():
+    async with api_server(status=500) as failing, api_server() as backup:
+        api = make_api(failing, backup)
+        response = await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert served_by(response) == backup.port
+
+        failing_host, backup_host = api.hosts
+        assert failing_host.failures == 1
+        assert not failing_host.is_healthy()
+        # The failing host is tried last until its backoff ends
+        assert api.ranked() == [backup_host, failing_host]
+        await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert failing_host.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_request():
+    async with api_server(delay=2) as slow, api_server() as fast:
+        api = make_api(slow, fast, hedge_delay=0.05)
+        started_at = time.monotonic()
+        response = await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert time.monotonic() - started_at < 1
+        assert served_by(response) == fast.port
+
+        slow_host, fast_host = api.hosts
+        # The time the slow host took before losing the race counts as its latency
+        assert slow_host.p95() > fast_host.p95()
+        assert api.ranked()[0] is fast_host
+
+
+@pytest.mark.asyncio
+async def test_outdated_host_is_skipped():
+    async with api_server("2024-05-01T11:00:00+00:00") as lagging, api_server() as fresh:
+        api = make_api(lagging, fresh)
+        api.freshest["corechannel"] = aggregate_time(
+            {"info": {"corechannel": {"last_updated": "2024-05-01T12:00:00+00:00"}}}, "corechannel"
+        )
+        response = await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert served_by(response) == fresh.port
+        lagging_host, fresh_host = api.hosts
+        assert lagging_host.stale == 1
+        # Tried after the others for a while, without counting as a failure
+        assert api.ranked() == [fresh_host, lagging_host]
+        assert lagging_host.failures == 0
+
+    # Still better than nothing when no other host answers
+    async with api_server("2024-05-01T11:00:00+00:00") as lagging, api_server(status=503) as failing:
+        api.hosts = make_api(lagging, failing).hosts
+        response = await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert served_by(response) == lagging.port
+
+
+@pytest.mark.asyncio
+async def test_all_hosts_fail():
+    async with api_server(status=500) as first, api_server(status=502) as second:
+        api = make_api(first, second)
+        with pytest.raises(ApiUnavailable):
+            await api.get_json(NODE_AGGREGATE_PATH, "corechannel")
+        assert [host.failures for host in api.hosts] == [1, 1]
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+
+from nodes_list.watchdog import LagHistogram, LoopWatchdog
+
+
+def test_lag_histogram():
+    histogram = LagHistogram()
+    for lag_ms in (0.5, 3, 3, 7000):
+        histogram.record(lag_ms)
+    stats = histogram.to_dict()
+    assert stats["samples"] == 4
+    assert stats["max_ms"] == 7000
+    assert stats["histogram"]["<=1ms"] == 1
+    assert stats["histogram"]["<=5ms"] == 2
+    assert stats["histogram"][">5000ms"] == 1
+
+
+def blocking_step():
+    time.sleep(0.2)
+
+
+@pytest.mark.asyncio
+async def test_watchdog_reports_blocking_steps():
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.05)
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.05)
+
+        async def slow_task():
+            blocking_step()
+
+        await asyncio.create_task(slow_task(), name="slow-task")
+        await asyncio.sleep(0.05)
+    finally:
+        await watchdog.stop()
+
+    stats = watchdog.stats()
+    assert stats["lag"]["max_ms"] >= 100
+    [offender] = stats["slow_callbacks"]
+    assert offender["task"] == "slow-task"
+    assert offender["location"].endswith("in blocking_step")
+    assert offender["count"] == 1
+    assert offender["max_ms"] >= 100
+    assert any("slow_task" in frame for frame in offender["last_stack"])